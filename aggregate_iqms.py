@@ -0,0 +1,176 @@
+# aggregate_iqms.py
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from bids_entities import ENTITIES, parse_bids_paths
+from collect_files import DEFAULT_THREADS, crawl_bids_trees
+from manifest import read_table, write_table
+
+MODALITIES = ('T1w', 'T2w', 'bold')
+# Columns before the IQMs in every table; 'run' is -1 for files without one
+META_COLUMNS = ['path', 'mtime_ns'] + ENTITIES
+DEFAULT_WORKERS = 8
+
+
+def table_path(out_dir, modality):
+    """Return the path of a modality's group table, named like MRIQC's."""
+    return os.path.join(out_dir, f'group_{modality}.npz')
+
+
+def is_iqm_file(file_name):
+    """Return True for participant-level JSON files (MRIQC's IQM files)."""
+    return file_name.startswith('sub-') and file_name.endswith('.json')
+
+
+def read_iqms(json_path):
+    """
+    Read the numeric top-level values of one IQM JSON.
+
+    Nested blocks (bids_meta, provenance) and non-numeric values are left
+    out.
+
+    Returns
+    -------
+    tuple of (str, dict or None)
+        The path and its {IQM: float}, or None if it could not be read.
+    """
+    try:
+        with open(json_path) as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return json_path, None
+    if not isinstance(data, dict):
+        return json_path, None
+    return json_path, {name: float(value) for name, value in data.items()
+                       if isinstance(value, (int, float))
+                       and not isinstance(value, bool)}
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_group_table(out_dir, modality):
+    """Return a modality's group table as a DataFrame (empty if missing)."""
+    path = table_path(out_dir, modality)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=META_COLUMNS)
+    return pd.DataFrame(read_table(path))
+
+
+def _write_group_table(out_dir, modality, frame):
+    iqm_columns = sorted(column for column in frame.columns
+                         if column not in META_COLUMNS)
+    frame = frame.sort_values('path', kind='mergesort')
+    columns = {'path': frame['path'].astype(str).values,
+               'mtime_ns': frame['mtime_ns'].astype(np.int64).values}
+    for entity in ENTITIES:
+        if entity == 'run':
+            columns[entity] = frame[entity].fillna(-1).astype(np.int64).values
+        else:
+            columns[entity] = frame[entity].fillna('').astype(str).values
+    for column in iqm_columns:
+        columns[column] = frame[column].astype(np.float64).values
+    write_table(table_path(out_dir, modality), columns)
+
+
+def aggregate_iqms(mriqc_dirs, out_dir, workers=DEFAULT_WORKERS,
+                   threads=DEFAULT_THREADS):
+    """
+    Gather the IQM JSONs of MRIQC output trees into one table per modality.
+
+    Each table (``group_<modality>.npz``, see manifest.write_table) has a
+    row per IQM file, with its path, mtime, BIDS entities and one float
+    column per IQM (NaN where a file lacks it). Existing tables are updated:
+    only files that are new or whose mtime changed are read, by a process
+    pool, and rows of files that are gone are dropped.
+
+    Parameters
+    ----------
+    mriqc_dirs : list of str
+        MRIQC output directories.
+    out_dir : str
+        Directory for the group tables.
+    workers : int
+        Number of processes parsing JSONs.
+    threads : int
+        Number of threads listing directories and stat-ing files.
+
+    Returns
+    -------
+    dict
+        Modality -> (rows in the table, files read).
+    """
+    paths = list(crawl_bids_trees(mriqc_dirs, is_iqm_file, threads))
+    entities = parse_bids_paths(paths)
+    # Rather than emptying the tables, stop if none of the files parse
+    # (e.g. an unexpected layout)
+    if paths and not len(entities):
+        raise ValueError(f"None of the {len(paths)} IQM files found are "
+                         f"sub-*/ses-*/<anat|func>/ files")
+    entities = entities[entities['suffix'].isin(MODALITIES)]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        mtimes = dict(zip(entities['path'],
+                          executor.map(_mtime_ns, entities['path'])))
+
+    old_tables = {modality: load_group_table(out_dir, modality)
+                  for modality in MODALITIES}
+    known = {}
+    for table in old_tables.values():
+        known.update(zip(table['path'], table['mtime_ns']))
+    to_read = [path for path in entities['path']
+               if mtimes[path] is not None and known.get(path) != mtimes[path]]
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = dict(executor.map(read_iqms, to_read, chunksize=64))
+
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for modality in MODALITIES:
+        files = entities[entities['suffix'] == modality]
+        old = old_tables[modality]
+        keep = old[old['path'].isin(set(files['path']))
+                   & ~old['path'].isin(set(results))]
+        rows = []
+        for _, file in files[files['path'].isin(set(results))].iterrows():
+            iqms = results[file['path']]
+            if iqms is None:
+                continue
+            row = {'path': file['path'], 'mtime_ns': mtimes[file['path']]}
+            row.update((entity, file[entity]) for entity in ENTITIES)
+            row.update(iqms)
+            rows.append(row)
+        new = pd.DataFrame(rows) if rows else \
+            pd.DataFrame(columns=META_COLUMNS)
+        frame = pd.concat([keep, new], ignore_index=True, sort=False)
+        if len(frame) or os.path.exists(table_path(out_dir, modality)):
+            _write_group_table(out_dir, modality, frame)
+        counts[modality] = (len(frame), len(rows))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Aggregate MRIQC IQM JSONs into one group table per "
+                    "modality, updating existing tables incrementally.")
+    parser.add_argument("mriqc_dirs", nargs='+',
+                        help="MRIQC output directories.")
+    parser.add_argument("-o", "--out_dir", required=True,
+                        help="Directory for the group_<modality>.npz tables.")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of processes parsing JSONs.")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="Number of threads listing directories.")
+    args = parser.parse_args()
+
+    counts = aggregate_iqms(args.mriqc_dirs, args.out_dir, args.workers,
+                            args.threads)
+    for modality, (rows, read) in counts.items():
+        print(f"{modality}: {rows} rows ({read} files read)")
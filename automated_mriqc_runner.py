@@ -6,6 +6,25 @@ import logging
 from datetime import datetime
 import uuid
 
+from lsf import lsf_command
+from job_registry import open_registry, record_submission
+from resource_predictor import (DEFAULT_RESOURCES, predict_session_resources,
+                                predict_pack_resources, combine_resources,
+                                mriqc_mem_gb)
+from session_packing import pack_sessions
+from submission_index import append_submission
+from work_queue import DEFAULT_LEASE_SECONDS, open_queue, claim, complete, fail
+
+RUN_MRIQC_SCRIPT = '/data/predict1/home/rez3/bin/code/mriqc_pipeline' \
+                   '/run_mriqc.py'
+
+DEFAULT_CSV_DIR = '/data/predict1/home/rez3/bin/csv_files/generated_csvs'
+DEFAULT_RAWDATA_DIR = '/data/predict1/data_from_nda/MRI_ROOT/rawdata/'
+DEFAULT_MRIQC_OUTDIR_ROOT = '/data/predict1/data_from_nda/MRI_ROOT' \
+                            '/rez3_derivatives/mriqc'
+DEFAULT_LOGS_ROOT_DIR = '/data/predict1/home/rez3/bin/logs'
+DEFAULT_RERUN_CSV = '/data/predict1/home/rez3/bin/csv_files/reran_cases.csv'
+
 # Set up logging
 logging.basicConfig(filename='mriqc_job_submission.log', filemode='a',
                     format='%(asctime)s - %(message)s', level=logging.INFO)
@@ -13,33 +32,201 @@ logging.basicConfig(filename='mriqc_job_submission.log', filemode='a',
 
 def create_csv(subject_id, session_id, csv_dir):
     """Create a CSV file for the given subject and session with a precise timestamp."""
+    return create_caselist_csv([(subject_id, session_id)], csv_dir)
+
+
+def create_caselist_csv(pairs, csv_dir, prefix='temp'):
+    """
+    Create a CSV file of subject-session pairs with a precise timestamp, and
+    add it to the submission index (see submission_index.py).
+    """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S%f")
     unique_id = str(uuid.uuid4())[:8]  # Short unique identifier
-    filename = f"{csv_dir}/temp_{timestamp}_{unique_id}.csv"
+    filename = f"{csv_dir}/{prefix}_{timestamp}_{unique_id}.csv"
     with open(filename, mode='w', newline='') as file:
         fieldnames = ['Subject', 'Session']
         writer = csv.DictWriter(file, fieldnames=fieldnames)
         writer.writeheader()
-        writer.writerow({'Subject': subject_id, 'Session': session_id})
+        for subject_id, session_id in pairs:
+            writer.writerow({'Subject': subject_id, 'Session': session_id})
+    append_submission(csv_dir, filename, pairs, timestamp)
     return filename
 
 
+def bsub_resource_options(resources):
+    """Build the bsub memory, core, queue and walltime options."""
+    return (f"-M {resources['mem_mb']} -n {resources['cores']} "
+            f"-R \"span[hosts=1]\" -R \"rusage[mem={resources['mem_mb']}]\" "
+            f"-q {resources['queue']} -W {resources['walltime']}")
+
+
+def run_mriqc_command(job_csv_path, rawdata_dir, mriqc_outdir_root,
+                      resources, stage=False, pack_minutes=None):
+    """Build the run_mriqc.py call of a job, sized to its resources."""
+    return (f"python {RUN_MRIQC_SCRIPT} {job_csv_path} "
+            f"{rawdata_dir} {mriqc_outdir_root} "
+            f"--nprocs {resources['cores']} "
+            f"--mem_gb {mriqc_mem_gb(resources)}"
+            + (" --stage" if stage else "")
+            + (f" --pack_minutes {pack_minutes}" if pack_minutes else ""))
+
+
 def submit_job(job_csv_path, rawdata_dir, mriqc_outdir_root, logs_root_dir,
-               subject_id, session_id):
+               subject_id, session_id, registry=None, resources=None,
+               stage=False):
+    resources = resources or DEFAULT_RESOURCES
     subject_logs_dir = Path(logs_root_dir, subject_id, session_id)
     subject_logs_dir.mkdir(parents=True, exist_ok=True)
     log_out_path = subject_logs_dir / f'%J.out'
     log_err_path = subject_logs_dir / f'%J.err'
+    mriqc_call = run_mriqc_command(job_csv_path, rawdata_dir,
+                                   mriqc_outdir_root, resources, stage)
     command = f"""
-    /usr/share/lsf/9.1/linux2.6-glibc2.3-x86_64/bin/bsub -o {log_out_path} \
+    {lsf_command('bsub')} -o {log_out_path} \
          -e {log_err_path} \
-         -M 18000 -n 2 -R "span[hosts=1]" -R "rusage[mem=18000]" -q pri_pnl -W 72:00 \
-         "python /data/predict1/home/rez3/bin/code/mriqc_pipeline/run_mriqc.py {job_csv_path} \
-         {rawdata_dir} {mriqc_outdir_root}"
+         {bsub_resource_options(resources)} \
+         "{mriqc_call}"
+    """
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    job_id = parse_job_id(stdout.decode())
+    if registry is not None and job_id is not None:
+        record_submission(registry, job_id, subject_id, session_id,
+                          resources)
+    return job_id
+
+
+def submit_pack_job(job_csv_path, pack, rawdata_dir, mriqc_outdir_root,
+                    logs_root_dir, pack_minutes, registry=None,
+                    resources=None, stage=False):
+    """
+    Submit one job running MRIQC once over a pack of subject-session pairs.
+
+    The LSF logs go to the first pair's log directory, and are linked into
+    the log directories of the other pairs (see ``link_pack_logs``). When a
+    ``registry`` connection is given, every pair is recorded under the job's
+    ID.
+
+    Returns
+    -------
+    str or None
+        The job ID, or None if bsub did not report one.
+    """
+    resources = resources or DEFAULT_RESOURCES
+    subject_logs_dir = Path(logs_root_dir, *pack[0])
+    subject_logs_dir.mkdir(parents=True, exist_ok=True)
+    mriqc_call = run_mriqc_command(job_csv_path, rawdata_dir,
+                                   mriqc_outdir_root, resources, stage,
+                                   pack_minutes)
+    command = f"""
+    {lsf_command('bsub')} -o {subject_logs_dir}/%J.out \
+         -e {subject_logs_dir}/%J.err \
+         {bsub_resource_options(resources)} \
+         "{mriqc_call}"
+    """
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    job_id = parse_job_id(stdout.decode())
+    if job_id is not None:
+        link_pack_logs(pack, logs_root_dir, job_id)
+    if registry is not None and job_id is not None:
+        for subject_id, session_id in pack:
+            record_submission(registry, job_id, subject_id, session_id,
+                              resources)
+    return job_id
+
+
+def link_pack_logs(pack, logs_root_dir, job_id):
+    """
+    Give every pair of a pack its own ``<subject>/<session>/`` log directory.
+
+    The job writes a single report to the first pair's directory, so the
+    other pairs get ``<job_id>.out|.err`` symlinks to it. The links dangle
+    until LSF writes the report, and get_status ignores dangling links, so
+    the pairs show as running until then and share the report afterwards.
+    """
+    first_logs_dir = Path(logs_root_dir, *pack[0]).resolve()
+    for subject_id, session_id in pack[1:]:
+        subject_logs_dir = Path(logs_root_dir, subject_id, session_id)
+        subject_logs_dir.mkdir(parents=True, exist_ok=True)
+        for extension in ('out', 'err'):
+            link = subject_logs_dir / f'{job_id}.{extension}'
+            if link.is_symlink():
+                link.unlink()
+            link.symlink_to(first_logs_dir / f'{job_id}.{extension}')
+
+
+def link_array_logs(pairs, logs_root_dir, array_name):
+    """
+    Point the per-element LSF logs of a job array at the usual
+    ``<logs_root_dir>/<subject>/<session>/`` directories.
+
+    bsub can only template an array log path with %J and %I, so each
+    ``arrays/<array_name>/<index>.out|.err`` is created as a symlink to
+    ``<subject>/<session>/<array_name>_<index>.out|.err``. LSF writes
+    through the link, and the report lands where get_status and the log
+    harvesters look for it, only once the job actually writes it.
+
+    Returns
+    -------
+    pathlib.Path
+        The directory holding the links.
+    """
+    array_logs_dir = Path(logs_root_dir, 'arrays', array_name)
+    array_logs_dir.mkdir(parents=True, exist_ok=True)
+    for index, (subject_id, session_id) in enumerate(pairs, start=1):
+        subject_logs_dir = Path(logs_root_dir, subject_id,
+                                session_id).resolve()
+        subject_logs_dir.mkdir(parents=True, exist_ok=True)
+        for extension in ('out', 'err'):
+            link = array_logs_dir / f'{index}.{extension}'
+            if link.is_symlink():
+                link.unlink()
+            link.symlink_to(
+                subject_logs_dir / f'{array_name}_{index}.{extension}')
+    return array_logs_dir
+
+
+def submit_array_job(job_csv_path, pairs, rawdata_dir, mriqc_outdir_root,
+                     logs_root_dir, slot_limit=None, registry=None,
+                     resources=None, stage=False):
+    """
+    Submit one LSF job array with an element per row of ``job_csv_path``.
+
+    Each element runs run_mriqc.py on the whole caselist, which then picks
+    its own row from ``LSB_JOBINDEX``. ``slot_limit`` caps how many
+    elements run at once (``%K`` in the array name). When a ``registry``
+    connection is given, every element is recorded as ``<job ID>[<index>]``.
+    All elements share ``resources``, so they should cover the largest
+    session (see ``resource_predictor.combine_resources``).
+
+    Returns
+    -------
+    str or None
+        The array job ID, or None if bsub did not report one.
+    """
+    resources = resources or DEFAULT_RESOURCES
+    array_name = Path(job_csv_path).stem
+    array_logs_dir = link_array_logs(pairs, logs_root_dir, array_name)
+    array_spec = f'mriqc[1-{len(pairs)}]'
+    if slot_limit:
+        array_spec += f'%{slot_limit}'
+    mriqc_call = run_mriqc_command(job_csv_path, rawdata_dir,
+                                   mriqc_outdir_root, resources, stage)
+    command = f"""
+    {lsf_command('bsub')} -J "{array_spec}" \
+         -o {array_logs_dir}/%I.out \
+         -e {array_logs_dir}/%I.err \
+         {bsub_resource_options(resources)} \
+         "{mriqc_call}"
     """
     process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
     stdout, _ = process.communicate()
     job_id = parse_job_id(stdout.decode())
+    if registry is not None and job_id is not None:
+        for index, (subject_id, session_id) in enumerate(pairs, start=1):
+            record_submission(registry, f'{job_id}[{index}]', subject_id,
+                              session_id, resources)
     return job_id
 
 
@@ -72,56 +259,192 @@ def manage_csv_files(input_csv, rerun_csv, csv_dir, processed_entries):
             writer.writerow({'Subject': entry[0], 'Session': entry[1]})
 
 
-def main(csv_file, csv_dir, rawdata_dir, mriqc_outdir_root, logs_root_dir,
-         rerun_csv, num_subjects):
-    Path(logs_root_dir).mkdir(parents=True, exist_ok=True)
-    Path(csv_dir).mkdir(parents=True, exist_ok=True)
-    processed_entries = []
+def read_batch(csv_file, num_subjects):
+    """Read up to ``num_subjects`` unique subject-session pairs from ``csv_file``."""
+    pairs = []
     with open(csv_file, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
-        count = 0
         for row in reader:
-            if count < num_subjects:
-                job_csv = create_csv(row['Subject'], row['Session'], csv_dir)
-                job_id = submit_job(job_csv, rawdata_dir, mriqc_outdir_root,
-                                    logs_root_dir, row['Subject'],
-                                    row['Session'])
-                logging.info(
-                    f"Submitted {row['Subject']} {row['Session']} with job ID {job_id}")
-                processed_entries.append((row['Subject'], row['Session']))
-                count += 1
-            else:
+            if len(pairs) >= num_subjects:
                 break
-    manage_csv_files(csv_file, rerun_csv, csv_dir, processed_entries)
+            pair = (row['Subject'], row['Session'])
+            if pair not in pairs:
+                pairs.append(pair)
+    return pairs
+
+
+def submit_pairs(pairs, job_ids, csv_dir, rawdata_dir, mriqc_outdir_root,
+                 logs_root_dir, array=False, slot_limit=None, registry=None,
+                 predict=False, stage=False, pack_minutes=None):
+    """
+    Submit MRIQC for ``pairs``, as single jobs, one job array or packs.
+
+    ``job_ids`` is filled with {(subject, session): job ID or None} as each
+    job is submitted, so the caller knows what was submitted even if a
+    later submission raises.
+    """
+    def resources_for(subject_id, session_id):
+        if not predict:
+            return DEFAULT_RESOURCES
+        return predict_session_resources(rawdata_dir, subject_id, session_id)
+
+    if array:
+        job_csv = create_caselist_csv(pairs, csv_dir, prefix='array')
+        resources = combine_resources(resources_for(*pair) for pair in pairs)
+        job_id = submit_array_job(job_csv, pairs, rawdata_dir,
+                                  mriqc_outdir_root, logs_root_dir,
+                                  slot_limit, registry, resources, stage)
+        for index, (subject_id, session_id) in enumerate(pairs, start=1):
+            logging.info(
+                f"Submitted {subject_id} {session_id} with job ID "
+                f"{job_id}[{index}]")
+            job_ids[(subject_id, session_id)] = \
+                job_id and f'{job_id}[{index}]'
+    elif pack_minutes:
+        for pack in pack_sessions(pairs, rawdata_dir, pack_minutes):
+            job_csv = create_caselist_csv(pack, csv_dir, prefix='pack')
+            resources = predict_pack_resources(rawdata_dir, pack) \
+                if predict else DEFAULT_RESOURCES
+            job_id = submit_pack_job(job_csv, pack, rawdata_dir,
+                                     mriqc_outdir_root, logs_root_dir,
+                                     pack_minutes, registry, resources, stage)
+            for subject_id, session_id in pack:
+                logging.info(
+                    f"Submitted {subject_id} {session_id} with job ID "
+                    f"{job_id}")
+                job_ids[(subject_id, session_id)] = job_id
+    else:
+        for subject_id, session_id in pairs:
+            job_csv = create_csv(subject_id, session_id, csv_dir)
+            job_id = submit_job(job_csv, rawdata_dir, mriqc_outdir_root,
+                                logs_root_dir, subject_id, session_id,
+                                registry,
+                                resources_for(subject_id, session_id), stage)
+            logging.info(
+                f"Submitted {subject_id} {session_id} with job ID {job_id}")
+            job_ids[(subject_id, session_id)] = job_id
+
+
+def main(csv_file, csv_dir, rawdata_dir, mriqc_outdir_root, logs_root_dir,
+         rerun_csv, num_subjects, array=False, slot_limit=None,
+         registry_path=None, predict=False, stage=False, pack_minutes=None,
+         work_queue_path=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Submit MRIQC for the next ``num_subjects`` subject-session pairs.
+
+    Pairs are taken from the top of ``csv_file``, which is rewritten without
+    them while they are appended to ``rerun_csv``. With ``work_queue_path``
+    they are claimed from the work queue instead (see work_queue.py), and
+    marked done once submitted or put back if bsub gave no job ID.
+
+    If a submission raises, the pairs submitted so far are still taken off
+    the caselist or marked done, and the rest are left in the caselist or
+    put back in the queue, before the error propagates.
+
+    Returns
+    -------
+    int
+        Number of pairs taken.
+    """
+    Path(logs_root_dir).mkdir(parents=True, exist_ok=True)
+    Path(csv_dir).mkdir(parents=True, exist_ok=True)
+    registry = open_registry(registry_path) if registry_path else None
+    work_queue = open_queue(work_queue_path) if work_queue_path else None
+    pairs, job_ids = [], {}
+    error = 'bsub reported no job ID'
+    finished = False
+    try:
+        if work_queue is not None:
+            claim_id, pairs = claim(work_queue, num_subjects, lease_seconds)
+        else:
+            pairs = read_batch(csv_file, num_subjects)
+        if pairs:
+            submit_pairs(pairs, job_ids, csv_dir, rawdata_dir,
+                         mriqc_outdir_root, logs_root_dir, array, slot_limit,
+                         registry, predict, stage, pack_minutes)
+        finished = True
+    except BaseException as exc:
+        error = f'Submission failed: {type(exc).__name__}: {exc}'
+        raise
+    finally:
+        try:
+            submitted = [pair for pair in pairs if job_ids.get(pair)]
+            if work_queue is not None:
+                if pairs:
+                    complete(work_queue, claim_id, submitted, job_ids)
+                    fail(work_queue, claim_id,
+                         [pair for pair in pairs if not job_ids.get(pair)],
+                         error)
+            elif pairs:
+                # Pairs bsub gave no job ID are still taken, as before, once
+                # the whole batch went through
+                manage_csv_files(csv_file, rerun_csv, csv_dir,
+                                 pairs if finished else submitted)
+        finally:
+            if work_queue is not None:
+                work_queue.close()
+            if registry is not None:
+                registry.close()
+    return len(pairs)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Submit MRIQC jobs for each subject-session pair.")
-    parser.add_argument("-c", "--csv_file", required=True,
+    parser.add_argument("-c", "--csv_file",
                         help="Path to the CSV file containing subject-session "
                              "pairs.")
     parser.add_argument("-d", "--csv_dir",
-                        default='/data/predict1/home/rez3/bin/csv_files'
-                                '/generated_csvs',
+                        default=DEFAULT_CSV_DIR,
                         help="Path to save created CSV files.")
     parser.add_argument("-r", "--rawdata_dir",
-                        default='/data/predict1/data_from_nda/MRI_ROOT/rawdata/',
+                        default=DEFAULT_RAWDATA_DIR,
                         help="Path to the BIDS dataset root directory.")
     parser.add_argument("-o", "--mriqc_outdir_root",
-                        default='/data/predict1/data_from_nda/MRI_ROOT'
-                                '/rez3_derivatives/mriqc',
+                        default=DEFAULT_MRIQC_OUTDIR_ROOT,
                         help="Path to save MRIQC outputs.")
     parser.add_argument("-l", "--logs_root_dir",
-                        default='/data/predict1/home/rez3/bin/logs',
+                        default=DEFAULT_LOGS_ROOT_DIR,
                         help="Root directory for logs.")
     parser.add_argument("-N", "--num_subjects", type=int, default=float('inf'),
                         help="Maximum number of subjects to process.")
     parser.add_argument("-R", "--rerun_csv",
-                        default='/data/predict1/home/rez3/bin/csv_files'
-                                '/reran_cases.csv',
+                        default=DEFAULT_RERUN_CSV,
                         help="Path to the CSV file for tracking rerun cases.")
+    parser.add_argument("-A", "--array", action="store_true",
+                        help="Submit the batch as one LSF job array instead "
+                             "of one job per subject-session pair.")
+    parser.add_argument("-K", "--slot_limit", type=int,
+                        help="With --array, maximum number of array "
+                             "elements running at once.")
+    parser.add_argument("-g", "--registry",
+                        help="Path to the SQLite job registry to record "
+                             "submitted jobs in (see job_registry.py).")
+    parser.add_argument("-P", "--predict_resources", action="store_true",
+                        help="Size each job's memory, cores and walltime "
+                             "from its NIfTI headers (see "
+                             "resource_predictor.py).")
+    parser.add_argument("-S", "--stage", action="store_true",
+                        help="Have jobs run MRIQC in node-local scratch and "
+                             "sync only the final outputs back.")
+    parser.add_argument("-k", "--pack_minutes", type=float,
+                        help="Pack small sessions into shared jobs of about "
+                             "this many estimated MRIQC minutes (see "
+                             "session_packing.py).")
+    parser.add_argument("-w", "--work_queue",
+                        help="Claim pairs from this SQLite work queue (see "
+                             "work_queue.py) instead of --csv_file.")
+    parser.add_argument("--lease_seconds", type=int,
+                        default=DEFAULT_LEASE_SECONDS,
+                        help="With --work_queue, seconds after which pairs "
+                             "claimed but not submitted are queued again.")
     args = parser.parse_args()
+    if args.array and args.pack_minutes:
+        parser.error("--array and --pack_minutes cannot be combined")
+    if not args.csv_file and not args.work_queue:
+        parser.error("one of --csv_file and --work_queue is required")
 
     main(args.csv_file, args.csv_dir, args.rawdata_dir, args.mriqc_outdir_root,
-         args.logs_root_dir, args.rerun_csv, args.num_subjects)
+         args.logs_root_dir, args.rerun_csv, args.num_subjects, args.array,
+         args.slot_limit, args.registry, args.predict_resources, args.stage,
+         args.pack_minutes, args.work_queue, args.lease_seconds)
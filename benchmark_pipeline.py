@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import random
+import struct
+import shutil
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCALES = [1000, 10000, 100000]
+DEFAULT_SESSIONS_PER_SUBJECT = 2
+DEFAULT_BOLD_RUNS = 2
+DEFAULT_MISSING_FRACTION = 0.1
+# Stages that submit or run sessions one by one only get this many
+DEFAULT_SUBMIT_SESSIONS = 1000
+DEFAULT_MRIQC_SESSIONS = 10
+# Keys does_json_have_keys() looks for in anatomical IQM files
+ANAT_IQMS = ["cjv", "cnr", "efc", "fber", "fwhm_avg", "fwhm_x", "fwhm_y",
+             "fwhm_z", "icvs_csf", "icvs_gm", "icvs_wm", "inu_med",
+             "inu_range"]
+BOLD_IQMS = ["dvars_nstd", "fd_mean", "gsr_x", "gsr_y", "snr", "tsnr"]
+
+FAKE_BSUB = """#!/bin/bash
+# Fake bsub: hands out increasing job IDs and remembers them for bjobs
+dir=$(dirname "$0")
+id=$(( $(cat "$dir/last_job_id" 2>/dev/null || echo 1000) + 1 ))
+echo $id > "$dir/last_job_id"
+echo $id >> "$dir/job_ids"
+echo "Job <$id> is submitted to queue <pri_pnl>."
+"""
+FAKE_BJOBS = """#!/bin/bash
+# Fake bjobs -o ... delimiter='|': reports every submitted job as DONE
+dir=$(dirname "$0")
+[ -s "$dir/job_ids" ] || { echo "No job found" >&2; exit 255; }
+awk '{print $1 "|-|DONE|-|cn001|-|-|-"}' "$dir/job_ids"
+"""
+FAKE_SINGULARITY = """#!/bin/bash
+# Fake MRIQC container: writes a stub IQM file per requested session
+out=""; data=""; subs=""; sess=""; mode=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -B) case "$2" in *:/out) out=${2%:/out};; *:/data:ro) data=${2%:/data:ro};; esac; shift;;
+    --participant-label) mode=sub;;
+    --session-id) mode=ses;;
+    -*) mode="";;
+    *) if [ "$mode" = sub ]; then subs="$subs $1"; elif [ "$mode" = ses ]; then sess="$sess ses-$1"; fi;;
+  esac
+  shift
+done
+for sub in $subs; do for ses in $sess; do
+  [ -d "$data/$sub/$ses" ] || continue
+  mkdir -p "$out/$sub/$ses/anat"
+  echo '{"cjv": 0.4}' > "$out/$sub/$ses/anat/${sub}_${ses}_T1w.json"
+done; done
+"""
+# get_status is a library function, so its stage runs this snippet
+GET_STATUS_SNIPPET = """
+import sys, csv
+sys.path.insert(0, sys.argv[1])
+from get_status import get_statuses
+with open(sys.argv[2], newline='') as file:
+    pairs = [(row['Subject'], row['Session']) for row in csv.DictReader(file)]
+statuses = get_statuses(pairs, *sys.argv[3:6])
+print(len(statuses), 'statuses')
+"""
+
+
+def nifti_header(shape, pixdim=(1.0, 1.0, 1.0, 2.0)):
+    """Return a gzipped NIfTI-1 header (no image data) of the given shape."""
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, len(shape), *shape,
+                     *([1] * (7 - len(shape))))
+    struct.pack_into('<8f', header, 76, 1.0, *pixdim,
+                     *([0.0] * (7 - len(pixdim))))
+    struct.pack_into('<f', header, 108, 352.0)
+    header[344:348] = b'n+1\0'
+    return gzip.compress(bytes(header))
+
+
+def session_files(subject, session, bold_runs):
+    """Return the (folder, file name stem, kind) of a synthetic session."""
+    prefix = f'{subject}_{session}'
+    files = [('anat', f'{prefix}_rec-norm_run-1_T1w', 'anat'),
+             ('anat', f'{prefix}_rec-norm_run-1_T2w', 'anat')]
+    for direction in ('AP', 'PA'):
+        for run in range(1, bold_runs + 1):
+            files.append(('func', f'{prefix}_task-rest_dir-{direction}'
+                                  f'_run-{run}_bold', 'bold'))
+    return files
+
+
+def _write(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def build_trees(root, sessions, sessions_per_subject=DEFAULT_SESSIONS_PER_SUBJECT,
+                bold_runs=DEFAULT_BOLD_RUNS,
+                missing_fraction=DEFAULT_MISSING_FRACTION, header_only=False,
+                seed=0):
+    """
+    Build a synthetic rawdata tree, MRIQC output tree and LSF logs tree.
+
+    Every session has a T1w, a T2w and ``bold_runs`` BOLD runs per phase
+    encoding direction, as empty or header-only NIfTIs. A
+    ``missing_fraction`` of sessions has no MRIQC outputs; half of those
+    have LSF logs (failed runs) and half none (never run).
+
+    Returns
+    -------
+    dict
+        Paths of the trees and caselists, and counts of what was written.
+    """
+    rng = random.Random(seed)
+    trees = {name: os.path.join(root, name)
+             for name in ('rawdata', 'mriqc', 'logs')}
+    anat_nifti = nifti_header((176, 256, 256)) if header_only else b''
+    bold_nifti = nifti_header((104, 104, 72, 488)) if header_only else b''
+    anat_json = json.dumps({key: rng.random() for key in ANAT_IQMS}).encode()
+    bold_json = json.dumps({key: rng.random() for key in BOLD_IQMS}).encode()
+    report = b'Sender: LSF System\nSubject: Job 1: <mriqc> Done\n\n' \
+             b'Successfully completed.\n'
+
+    pairs, missing = [], []
+    nifti_count = json_count = 0
+    for index in range(sessions):
+        subject = f'sub-BM{index // sessions_per_subject:05d}'
+        session = f'ses-{index % sessions_per_subject + 1}'
+        pairs.append((subject, session))
+        has_output = rng.random() >= missing_fraction
+        if not has_output:
+            missing.append((subject, session))
+        for folder in ('anat', 'func'):
+            os.makedirs(os.path.join(trees['rawdata'], subject, session,
+                                     folder))
+            if has_output:
+                os.makedirs(os.path.join(trees['mriqc'], subject, session,
+                                         folder))
+        for folder, stem, kind in session_files(subject, session, bold_runs):
+            _write(os.path.join(trees['rawdata'], subject, session, folder,
+                                stem + '.nii.gz'),
+                   anat_nifti if kind == 'anat' else bold_nifti)
+            nifti_count += 1
+            if has_output:
+                _write(os.path.join(trees['mriqc'], subject, session, folder,
+                                    stem + '.json'),
+                       anat_json if kind == 'anat' else bold_json)
+                json_count += 1
+        if has_output or rng.random() < 0.5:
+            logs_dir = os.path.join(trees['logs'], subject, session)
+            os.makedirs(logs_dir)
+            _write(os.path.join(logs_dir, '1.out'), report)
+            _write(os.path.join(logs_dir, '1.err'), b'')
+
+    trees['pairs_csv'] = os.path.join(root, 'all_pairs.csv')
+    trees['missing_csv'] = os.path.join(root, 'missing_pairs.csv')
+    for path, rows in ((trees['pairs_csv'], pairs),
+                       (trees['missing_csv'], missing)):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['Subject', 'Session'])
+            writer.writerows(rows)
+    trees.update(sessions=sessions, missing=len(missing),
+                 nifti_files=nifti_count, json_files=json_count)
+    return trees
+
+
+def install_fake_tools(bin_dir):
+    """Write fake bsub, bjobs and singularity executables into ``bin_dir``."""
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, script in (('bsub', FAKE_BSUB), ('bjobs', FAKE_BJOBS),
+                         ('singularity', FAKE_SINGULARITY)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as file:
+            file.write(script)
+        os.chmod(path, 0o755)
+    for state_file in ('last_job_id', 'job_ids'):
+        if os.path.exists(os.path.join(bin_dir, state_file)):
+            os.remove(os.path.join(bin_dir, state_file))
+
+
+def run_stage(commands, env, cwd, log_path):
+    """
+    Run a stage's commands one after the other.
+
+    Returns
+    -------
+    dict
+        Wall seconds, peak RSS in MB (the largest of any process of the
+        stage, from wait4) and the first non-zero exit status.
+    """
+    start = time.perf_counter()
+    peak_kb = 0
+    status = 0
+    with open(log_path, 'ab') as log:
+        for command in commands:
+            log.write(f"$ {' '.join(command)}\n".encode())
+            log.flush()
+            process = subprocess.Popen(command, env=env, cwd=cwd, stdout=log,
+                                       stderr=subprocess.STDOUT)
+            _, wait_status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(wait_status) \
+                if os.WIFEXITED(wait_status) else -os.WTERMSIG(wait_status)
+            peak_kb = max(peak_kb, usage.ru_maxrss)
+            status = status or process.returncode
+    return {'seconds': time.perf_counter() - start,
+            'peak_rss_mb': peak_kb / 1024, 'returncode': status}
+
+
+def _head_csv(csv_path, rows, output_csv):
+    with open(csv_path, newline='') as file:
+        lines = file.readlines()[:rows + 1]
+    with open(output_csv, 'w', newline='') as file:
+        file.writelines(lines)
+    return len(lines) - 1
+
+
+def pipeline_stages(trees, work_dir, submit_sessions, mriqc_sessions):
+    """
+    Return the stages to time as (name, commands, items, unit), in order.
+
+    Each stage reads what the previous ones wrote, as in wrapper.py.
+    """
+    python = sys.executable
+    script = lambda name: os.path.join(REPO_DIR, name)
+    out = lambda name: os.path.join(work_dir, name)
+    submit_csv, mriqc_csv = out('submit_pairs.csv'), out('mriqc_pairs.csv')
+    submitted = _head_csv(trees['missing_csv'], submit_sessions, submit_csv)
+    mriqc_run = _head_csv(trees['missing_csv'], mriqc_sessions, mriqc_csv)
+    files = trees['nifti_files'] + trees['json_files']
+    registry = out('jobs.sqlite')
+    return [
+        ('collect_files', [[python, script('collect_files.py'),
+                            trees['rawdata'], trees['mriqc'],
+                            '-n', out('nifti_files.txt'),
+                            '-j', out('json_files.txt')]], files, 'files'),
+        ('txt_to_csv', [[python, script('txt_to_csv.py'),
+                         '-i', out(f'{kind}_files.txt'),
+                         '-o', out(f'{kind}_files.csv')]
+                        for kind in ('nifti', 'json')], files, 'files'),
+        ('find_missing_entries', [[python, script('find_missing_entries.py'),
+                                   '-n', out('nifti_files.csv'),
+                                   '-j', out('json_files.csv'),
+                                   '-o', out('missing_entries.csv')]],
+         files, 'files'),
+        ('aggregate_iqms', [[python, script('aggregate_iqms.py'),
+                             trees['mriqc'], '-o', out('group_tables')]],
+         trees['json_files'], 'files'),
+        ('get_status', [[python, '-c', GET_STATUS_SNIPPET,
+                         os.path.join(REPO_DIR, 'mriqc_gsheet_log_maker'),
+                         trees['pairs_csv'], trees['logs'] + '/',
+                         trees['rawdata'] + '/', trees['mriqc'] + '/']],
+         trees['sessions'], 'sessions'),
+        ('automated_mriqc_runner', [[python,
+                                     script('automated_mriqc_runner.py'),
+                                     '-c', submit_csv, '-N', str(submitted),
+                                     '-d', out('generated_csvs'),
+                                     '-r', trees['rawdata'],
+                                     '-o', out('mriqc_runs'),
+                                     '-l', out('submit_logs'),
+                                     '-R', out('reran_cases.csv'),
+                                     '-g', registry]],
+         submitted, 'sessions'),
+        ('job_registry_poll', [[python, script('job_registry.py'),
+                                '-g', registry, 'poll']],
+         submitted, 'jobs'),
+        ('run_mriqc', [[python, script('run_mriqc.py'), mriqc_csv,
+                        trees['rawdata'], out('mriqc_runs'),
+                        '--temp_dir', out('mriqc_tmp')]],
+         mriqc_run, 'sessions'),
+    ]
+
+
+def benchmark_scale(sessions, work_dir, args):
+    """Build the trees for ``sessions`` sessions and time every stage."""
+    scale_dir = os.path.join(work_dir, f'sessions-{sessions}')
+    if os.path.exists(scale_dir):
+        shutil.rmtree(scale_dir)
+    os.makedirs(scale_dir)
+    start = time.perf_counter()
+    trees = build_trees(os.path.join(scale_dir, 'trees'), sessions,
+                        args.sessions_per_subject, args.bold_runs,
+                        args.missing_fraction, args.header_only, args.seed)
+    result = {'build_seconds': time.perf_counter() - start,
+              'missing_sessions': trees['missing'],
+              'nifti_files': trees['nifti_files'],
+              'json_files': trees['json_files'], 'stages': {}}
+    print(f"{sessions} sessions: built {trees['nifti_files']} NIfTIs and "
+          f"{trees['json_files']} IQM JSONs in "
+          f"{result['build_seconds']:.1f} s")
+
+    bin_dir = os.path.join(scale_dir, 'bin')
+    install_fake_tools(bin_dir)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'],
+               MRIQC_SINGULARITY=os.path.join(bin_dir, 'singularity'),
+               PYTHONPATH=REPO_DIR)
+    stages = pipeline_stages(trees, scale_dir, args.submit_sessions,
+                             args.mriqc_sessions)
+    for name, commands, items, unit in stages:
+        if args.stages and name not in args.stages:
+            continue
+        stage = run_stage(commands, env, scale_dir,
+                          os.path.join(scale_dir, 'stages.log'))
+        stage.update(items=items, unit=unit,
+                     per_second=items / stage['seconds']
+                     if stage['seconds'] else None)
+        result['stages'][name] = stage
+        print(f"  {name:24}{stage['seconds']:9.2f} s "
+              f"{stage['per_second'] or 0:12.0f} {unit}/s "
+              f"{stage['peak_rss_mb']:8.0f} MB"
+              + (f"  (exit {stage['returncode']})"
+                 if stage['returncode'] else ''))
+    if not args.keep:
+        shutil.rmtree(scale_dir)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Print each stage's speedup over a previous results file."""
+    print(f"Compared with {baseline.get('commit')} "
+          f"({baseline.get('created')}): speedup, RSS ratio")
+    for scale, result in results['scales'].items():
+        old = baseline.get('scales', {}).get(scale)
+        if old is None:
+            continue
+        for name, stage in result['stages'].items():
+            old_stage = old['stages'].get(name)
+            if not old_stage or not stage['seconds']:
+                continue
+            print(f"  {scale:>7} {name:24}"
+                  f"{old_stage['seconds'] / stage['seconds']:8.2f}x "
+                  f"{stage['peak_rss_mb'] / (old_stage['peak_rss_mb'] or 1):8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline scripts on synthetic BIDS trees, with "
+                    "fake bsub, bjobs and singularity, and save wall time, "
+                    "throughput and peak RSS per stage as JSON.")
+    parser.add_argument("-s", "--sessions", type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help="Numbers of sessions to benchmark.")
+    parser.add_argument("-p", "--sessions_per_subject", type=int,
+                        default=DEFAULT_SESSIONS_PER_SUBJECT,
+                        help="Sessions of each synthetic subject.")
+    parser.add_argument("-b", "--bold_runs", type=int,
+                        default=DEFAULT_BOLD_RUNS,
+                        help="BOLD runs per phase encoding direction.")
+    parser.add_argument("-m", "--missing_fraction", type=float,
+                        default=DEFAULT_MISSING_FRACTION,
+                        help="Fraction of sessions without MRIQC outputs.")
+    parser.add_argument("--header_only", action="store_true",
+                        help="Write NIfTI headers instead of empty files.")
+    parser.add_argument("-n", "--submit_sessions", type=int,
+                        default=DEFAULT_SUBMIT_SESSIONS,
+                        help="Sessions submitted by the runner stage.")
+    parser.add_argument("-q", "--mriqc_sessions", type=int,
+                        default=DEFAULT_MRIQC_SESSIONS,
+                        help="Sessions run by the run_mriqc stage.")
+    parser.add_argument("-t", "--stages", nargs='+',
+                        help="Only run these stages.")
+    parser.add_argument("-w", "--work_dir", default='benchmark_work',
+                        help="Directory the synthetic trees are built in.")
+    parser.add_argument("-k", "--keep", action="store_true",
+                        help="Keep the trees and stage outputs.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic trees.")
+    parser.add_argument("-o", "--output_json",
+                        help="Results file (default: "
+                             "benchmark_<timestamp>.json).")
+    parser.add_argument("-c", "--compare",
+                        help="Previous results file to print speedups "
+                             "against.")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    created = datetime.now()
+    results = {'created': created.isoformat(timespec='seconds'),
+               'commit': _git_commit(), 'host': platform.node(),
+               'python': platform.python_version(),
+               'config': {key: value for key, value in vars(args).items()
+                          if key not in ('output_json', 'compare')},
+               'scales': {}}
+    for sessions in args.sessions:
+        results['scales'][str(sessions)] = benchmark_scale(sessions, work_dir,
+                                                           args)
+    output_json = args.output_json or \
+        f"benchmark_{created.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_json, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {output_json}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
@@ -0,0 +1,152 @@
+# bids_entities.py
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Entities extracted from participant-level file names; run is an integer,
+# the rest are labels. Columns of the parsed table follow this order.
+ENTITIES = ['sub', 'ses', 'task', 'acq', 'rec', 'dir', 'run']
+# 'extra' holds the entities after run (echo, part, ...) as written, so
+# that e.g. the echoes of a multi-echo run get keys of their own
+KEY_COLUMNS = ['sub', 'ses', 'folder', 'task', 'acq', 'ce', 'rec', 'dir',
+               'run', 'extra', 'suffix']
+
+# <...>/sub-X/ses-Y/<anat|func>/sub-X_ses-Y_[task-]..._<suffix><ext>, with
+# entities in the order the BIDS specification fixes for file names and the
+# name's sub/ses required to match its directories. Run indices are read
+# without leading zeros. Any other line matches the empty second branch, so
+# every path yields exactly one match.
+_LABEL = r'[a-zA-Z0-9]+'
+PARTICIPANT_PATTERN = re.compile(
+    r'^(?:[^\n/]*/)*?'
+    r'sub-(?P<sub>{label})/ses-(?P<ses>{label})'
+    r'/(?P<folder>anat|func)/'
+    r'sub-(?P=sub)_ses-(?P=ses)'
+    r'(?:_task-(?P<task>{label}))?'
+    r'(?:_acq-(?P<acq>{label}))?'
+    r'(?:_ce-(?P<ce>{label}))?'
+    r'(?:_rec-(?P<rec>{label}))?'
+    r'(?:_dir-(?P<dir>{label}))?'
+    r'(?:_run-0*(?P<run>[0-9]+))?'
+    r'(?P<extra>(?:_[a-zA-Z]+-{label})*)'
+    r'_(?P<suffix>{label})'
+    r'(?P<ext>\.nii\.gz|\.json)?$'
+    r'|^[^\n]*$'.format(label=_LABEL), re.MULTILINE)
+GROUPS = sorted(PARTICIPANT_PATTERN.groupindex,
+                key=PARTICIPANT_PATTERN.groupindex.get)
+# Rewrites a matched line into its canonical entity key
+KEY_TEMPLATE = '|'.join(r'\g<{}>'.format(name) for name in KEY_COLUMNS)
+_NO_KEY = '|' * (len(KEY_COLUMNS) - 1)
+_SUBJECT_DIR = re.compile(r'(?:^|/)sub-')
+
+
+def _buffer(paths):
+    """
+    Join paths into one buffer for the multi-line pattern, minus the
+    directory prefix they all share, which the pattern would only skip.
+
+    The prefix is only cut up to the first ``sub-`` directory, since the
+    pattern needs the sub/ses/folder directories: a single path, or paths
+    of a single subject, share all of those.
+    """
+    paths = [str(path) for path in paths]
+    if not paths:
+        return ''
+    prefix = os.path.commonprefix([min(paths), max(paths)])
+    subject_dir = _SUBJECT_DIR.search(prefix)
+    if subject_dir is not None:
+        prefix = prefix[:subject_dir.start()]
+    start = prefix.rfind('/') + 1
+    return '\n'.join(path[start:] for path in paths)
+
+
+def parse_bids_paths(paths):
+    """
+    Parse BIDS entities out of a whole array of paths at once.
+
+    The paths are joined into one buffer and a single compiled, multi-line
+    pattern is run over it with ``findall``, so the scan happens in C
+    instead of once per path in Python. Files that are not participant-level
+    ``sub-*/ses-*/{anat,func}/sub-*`` files, whose entities are not in BIDS
+    order, or whose name disagrees with their sub/ses directories, are
+    dropped.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        File paths; extensions are optional, so txt_to_csv.py
+        ``Subject/Session/Folder/File`` rows joined with '/' parse too.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per participant file, indexed by the position of the path in
+        ``paths``, with a 'path' column, the ``KEY_COLUMNS`` entities (labels
+        as strings, ``run`` as a nullable integer, absent entities as None)
+        and 'ext'.
+    """
+    paths = np.asarray(paths, dtype=object)
+    if len(paths) == 0:
+        return pd.DataFrame(columns=['path'] + KEY_COLUMNS + ['ext'])
+    matches = PARTICIPANT_PATTERN.findall(_buffer(paths))
+    columns = dict(zip(GROUPS, zip(*matches)))
+
+    keep = np.flatnonzero(np.array(columns['suffix'], dtype=object) != '')
+    table = pd.DataFrame({'path': paths[keep]}, index=keep)
+    for name in KEY_COLUMNS + ['ext']:
+        values = np.array(columns[name], dtype=object)[keep]
+        values[values == ''] = None
+        table[name] = values
+    table['run'] = pd.to_numeric(table['run']).astype('Int64')
+    return table
+
+
+def encode_entity_keys(*path_lists):
+    """
+    Encode the ``KEY_COLUMNS`` entity tuple of each path as one integer.
+
+    Every path is rewritten to a canonical 'sub|ses|folder|...|suffix'
+    string by one ``re.sub`` over the joined buffer, and the strings of all
+    lists are factorized together, so equal entity tuples get equal keys
+    across lists (e.g. ``run-01`` and ``run-1`` match).
+
+    Returns
+    -------
+    list of numpy.ndarray
+        One int64 key array per input list, with -1 for paths that are not
+        participant-level BIDS files.
+    """
+    canonical = []
+    sizes = []
+    for paths in path_lists:
+        keys = PARTICIPANT_PATTERN.sub(KEY_TEMPLATE, _buffer(paths)).split(
+            '\n') if len(paths) else []
+        canonical.extend(keys)
+        sizes.append(len(keys))
+    codes, uniques = pd.factorize(np.array(canonical, dtype=object))
+    codes = codes.astype(np.int64)
+    dropped = np.flatnonzero(np.asarray(uniques, dtype=object) == _NO_KEY)
+    if len(dropped):
+        codes[codes == dropped[0]] = -1
+    bounds = np.cumsum([0] + sizes)
+    return [codes[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def entity_diff(nifti_paths, json_paths):
+    """
+    Diff NIfTI and JSON paths with an integer join on entity keys.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        (missing, satisfied, orphan) boolean masks: NIfTI paths with no JSON,
+        NIfTI paths with a JSON, and JSON paths with no NIfTI. Paths that are
+        not participant-level files are False in all three.
+    """
+    nifti_keys, json_keys = encode_entity_keys(nifti_paths, json_paths)
+    valid_nifti, valid_json = nifti_keys >= 0, json_keys >= 0
+    satisfied = np.isin(nifti_keys, json_keys[valid_json]) & valid_nifti
+    orphan = ~np.isin(json_keys, nifti_keys[valid_nifti]) & valid_json
+    return valid_nifti & ~satisfied, satisfied, orphan
@@ -1,10 +1,169 @@
 # collect_files.py
 import os
+import heapq
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+from manifest import is_manifest, write_manifest
 
-def collect_nifti_files(rawdata_dir, output_txt):
+# Only these modality folders are followed below sub-*/ses-*/
+BIDS_FOLDERS = ('anat', 'func')
+DEFAULT_THREADS = 8
+
+
+def is_nifti_file(file_name):
+    """Return True for NIfTI files MRIQC should see (no auxiliary or sbref)."""
+    return file_name.endswith('.nii.gz') and not any(
+        x in file_name for x in ['auxiliary', 'sbref'])
+
+
+def is_json_file(file_name):
+    """Return True for JSON files."""
+    return file_name.endswith('.json')
+
+
+def _strip_extension(file_name):
+    """Drop the extensions that txt_to_csv.py strips from file names."""
+    return file_name.replace('.nii.gz', '').replace('.json', '')
+
+
+def entry_sort_key(file_path):
+    """
+    Sort key of a crawled path: its (Subject, Session, Folder, File) entry.
+
+    Ordering paths by this key gives the same order as sorting their
+    txt_to_csv.py rows, which find_missing_entries.py relies on.
+    """
+    parts = file_path.split(os.sep)[-4:]
+    parts[-1] = _strip_extension(parts[-1])
+    return tuple(parts)
+
+
+def _scan_dir(path, prefix=None, names=None, want_dirs=True):
+    """
+    List the entries of a single directory with ``os.scandir``.
+
+    Parameters
+    ----------
+    path : str
+        Directory to list.
+    prefix : str, optional
+        Only keep entries whose name starts with this prefix.
+    names : sequence of str, optional
+        Only keep entries whose name is one of these.
+    want_dirs : bool
+        Keep directories if True, regular files otherwise.
+
+    Returns
+    -------
+    list of os.DirEntry
+        Matching entries sorted by name (without extension). Missing or
+        unreadable directories yield an empty list.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = [entry for entry in it
+                       if (prefix is None or entry.name.startswith(prefix))
+                       and (names is None or entry.name in names)
+                       and entry.is_dir() == want_dirs]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    entries.sort(key=lambda entry: _strip_extension(entry.name))
+    return entries
+
+
+def _scan_subject(subject_dir, file_filter):
+    """Collect matching files under ``sub-*/ses-*/{anat,func}`` of one subject."""
+    collected = []
+    for session in _scan_dir(subject_dir, prefix='ses-'):
+        for folder in _scan_dir(session.path, names=BIDS_FOLDERS):
+            for entry in _scan_dir(folder.path, want_dirs=False):
+                if file_filter(entry.name):
+                    collected.append(entry.path)
+    return collected
+
+
+def crawl_bids_tree(root_dir, file_filter, threads=DEFAULT_THREADS):
+    """
+    Yield the paths of files in the ``sub-*/ses-*/{anat,func}`` layout of a
+    BIDS-like tree.
+
+    Only the BIDS layout is followed, so derivatives, ``figures/`` and work
+    trees are never descended into. Subject directories are listed
+    concurrently by a thread pool to hide per-directory metadata latency on
+    network file systems. Paths are yielded in sorted subject, session,
+    folder and file order.
+
+    Parameters
+    ----------
+    root_dir : str
+        Path to the root of the tree (rawdata or an MRIQC output directory).
+    file_filter : callable
+        Called with each file name; files are kept when it returns True.
+    threads : int
+        Number of subject directories listed concurrently.
+    """
+    subjects = [entry.path for entry in _scan_dir(root_dir, prefix='sub-')]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for subject_files in executor.map(
+                lambda subject_dir: _scan_subject(subject_dir, file_filter),
+                subjects):
+            for file_path in subject_files:
+                yield file_path
+
+
+def crawl_bids_trees(root_dirs, file_filter, threads=DEFAULT_THREADS):
+    """
+    Crawl several trees with ``crawl_bids_tree`` and merge their paths into
+    one stream sorted by ``entry_sort_key``, so the same entry found under
+    two roots comes out adjacent.
+    """
+    return heapq.merge(*(crawl_bids_tree(root_dir, file_filter, threads)
+                         for root_dir in root_dirs), key=entry_sort_key)
+
+
+def _collect(root_dirs, kind, file_filter, threads, index_path, changes_txt):
+    """
+    Collect matching files from several trees, either by a full crawl or by
+    refreshing the incremental crawl index at ``index_path``.
+    """
+    if index_path is None:
+        return list(crawl_bids_trees(root_dirs, file_filter, threads))
+
+    files_to_collect = []
+    from crawl_index import open_index, refresh_index, indexed_files
+    conn = open_index(index_path)
+    try:
+        for root_dir in root_dirs:
+            added, removed = refresh_index(conn, root_dir, kind, file_filter,
+                                           threads)
+            tqdm.write(f"{root_dir}: {len(added)} {kind} files added, "
+                       f"{len(removed)} removed")
+            if changes_txt is not None:
+                with open(changes_txt, 'a') as txt_file:
+                    for file_path in added:
+                        txt_file.write(f"+ {file_path}\n")
+                    for file_path in removed:
+                        txt_file.write(f"- {file_path}\n")
+            files_to_collect.append(indexed_files(conn, root_dir, kind))
+    finally:
+        conn.close()
+    return list(heapq.merge(*files_to_collect, key=entry_sort_key))
+
+
+def write_paths(files_to_collect, output_txt, desc):
+    """Write paths one per line, or as a compact manifest for .npz outputs."""
+    if is_manifest(output_txt):
+        write_manifest(output_txt, tqdm(files_to_collect, desc=desc))
+        return
+    with open(output_txt, 'w') as txt_file:
+        for file_path in tqdm(files_to_collect, desc=desc):
+            txt_file.write(file_path + '\n')
+
+
+def collect_nifti_files(rawdata_dir, output_txt, threads=DEFAULT_THREADS,
+                        index_path=None, changes_txt=None):
     """
     Collect all NIfTI files that match the specification (anat and func, excluding auxiliary and sbref)
     and write their paths to a text file.
@@ -14,22 +173,26 @@ def collect_nifti_files(rawdata_dir, output_txt):
     rawdata_dir : str
         Path to the rawdata directory.
     output_txt : str
-        Path to the output text file.
+        Path to the output text file, or to a compact manifest if it ends
+        with .npz.
+    threads : int
+        Number of subject directories listed concurrently.
+    index_path : str, optional
+        Path to an incremental crawl index (see ``crawl_index.py``). When
+        given, only sessions changed since the previous run are re-listed.
+    changes_txt : str, optional
+        Path to a text file that added ('+') and removed ('-') paths are
+        appended to when an index is used.
     """
-    files_to_collect = []
-    for root, _, files in os.walk(rawdata_dir):
-        if os.path.basename(root) in ['anat', 'func']:
-            for file in files:
-                if file.endswith('.nii.gz') and not any(
-                        x in file for x in ['auxiliary', 'sbref']):
-                    files_to_collect.append(os.path.join(root, file))
+    files_to_collect = _collect([rawdata_dir], 'nifti', is_nifti_file,
+                                threads, index_path, changes_txt)
 
-    with open(output_txt, 'w') as txt_file:
-        for file_path in tqdm(files_to_collect, desc="Collecting NIfTI files"):
-            txt_file.write(file_path + '\n')
+    write_paths(files_to_collect, output_txt, "Collecting NIfTI files")
 
 
-def collect_json_files(mriqc_output_dirs, output_txt):
+def collect_json_files(mriqc_output_dirs, output_txt,
+                       threads=DEFAULT_THREADS, index_path=None,
+                       changes_txt=None):
     """
     Collect all JSON files from multiple MRIQC output directories and write their paths to a text file.
 
@@ -38,18 +201,20 @@ def collect_json_files(mriqc_output_dirs, output_txt):
     mriqc_output_dirs : list of str
         List of paths to the MRIQC output directories.
     output_txt : str
-        Path to the output text file.
+        Path to the output text file, or to a compact manifest if it ends
+        with .npz.
+    threads : int
+        Number of subject directories listed concurrently.
+    index_path : str, optional
+        Path to an incremental crawl index (see ``crawl_index.py``).
+    changes_txt : str, optional
+        Path to a text file that added ('+') and removed ('-') paths are
+        appended to when an index is used.
     """
-    files_to_collect = []
-    for mriqc_output_dir in mriqc_output_dirs:
-        for root, _, files in os.walk(mriqc_output_dir):
-            for file in files:
-                if file.endswith('.json'):
-                    files_to_collect.append(os.path.join(root, file))
+    files_to_collect = _collect(mriqc_output_dirs, 'json', is_json_file,
+                                threads, index_path, changes_txt)
 
-    with open(output_txt, 'w') as txt_file:
-        for file_path in tqdm(files_to_collect, desc="Collecting JSON files"):
-            txt_file.write(file_path + '\n')
+    write_paths(files_to_collect, output_txt, "Collecting JSON files")
 
 
 if __name__ == "__main__":
@@ -59,10 +224,24 @@ if __name__ == "__main__":
     parser.add_argument("mriqc_output_dirs", nargs='+',
                         help="Paths to the MRIQC output directories.")
     parser.add_argument("-n", "--nifti_output_txt", default="nifti_files.txt",
-                        help="Path to output text file for NIfTI files.")
+                        help="Path to output text file for NIfTI files "
+                             "(.npz writes a compact manifest).")
     parser.add_argument("-j", "--json_output_txt", default="json_files.txt",
-                        help="Path to output text file for JSON files.")
+                        help="Path to output text file for JSON files "
+                             "(.npz writes a compact manifest).")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="Number of subject directories listed "
+                             "concurrently.")
+    parser.add_argument("-x", "--index",
+                        help="Path to an SQLite crawl index. When given, "
+                             "only sessions changed since the last run are "
+                             "re-listed.")
+    parser.add_argument("-c", "--changes_txt",
+                        help="Append added (+) and removed (-) paths to this "
+                             "file (requires --index).")
     args = parser.parse_args()
 
-    collect_nifti_files(args.rawdata_dir, args.nifti_output_txt)
-    collect_json_files(args.mriqc_output_dirs, args.json_output_txt)
+    collect_nifti_files(args.rawdata_dir, args.nifti_output_txt, args.threads,
+                        args.index, args.changes_txt)
+    collect_json_files(args.mriqc_output_dirs, args.json_output_txt,
+                       args.threads, args.index, args.changes_txt)
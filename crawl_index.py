@@ -0,0 +1,238 @@
+# crawl_index.py
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from collect_files import (BIDS_FOLDERS, DEFAULT_THREADS, _scan_dir,
+                           entry_sort_key)
+
+# Directories modified this recently are re-listed on the next run, since a
+# file written in the same mtime tick as our listing would otherwise be missed.
+MTIME_GRACE_NS = 2 * 10 ** 9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (
+    kind TEXT NOT NULL,
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER,
+    PRIMARY KEY (kind, path)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    kind TEXT NOT NULL,
+    subject_path TEXT NOT NULL,
+    path TEXT NOT NULL,
+    signature TEXT,
+    PRIMARY KEY (kind, path)
+);
+CREATE TABLE IF NOT EXISTS files (
+    kind TEXT NOT NULL,
+    session_path TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (kind, path)
+);
+CREATE INDEX IF NOT EXISTS subjects_root ON subjects (kind, root);
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions (kind, subject_path);
+CREATE INDEX IF NOT EXISTS files_session ON files (kind, session_path);
+"""
+
+
+def open_index(index_path):
+    """Open (and create if needed) the SQLite crawl index at ``index_path``."""
+    conn = sqlite3.connect(str(index_path))
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _mtime_ns(path):
+    """Return the mtime of ``path`` in nanoseconds, or None if it is missing."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+
+
+def _fresh(mtime_ns, now_ns):
+    """True if an mtime is old enough to be trusted as a change marker."""
+    return mtime_ns is not None and now_ns - mtime_ns > MTIME_GRACE_NS
+
+
+def _session_signature(session_path, now_ns):
+    """
+    Build the change signature of a session directory.
+
+    The session directory mtime only changes when its direct entries change,
+    so the mtimes of its modality folders are part of the signature as well.
+    Returns None when any of them is too recent to be trusted.
+    """
+    mtimes = [_mtime_ns(session_path)] + [
+        _mtime_ns(os.path.join(session_path, folder))
+        for folder in BIDS_FOLDERS]
+    if any(m is not None and not _fresh(m, now_ns) for m in mtimes):
+        return None
+    return ','.join('-' if m is None else str(m) for m in mtimes)
+
+
+def _list_session(session_path, file_filter):
+    """List the matching files of one session directory."""
+    collected = []
+    for folder in _scan_dir(session_path, names=BIDS_FOLDERS):
+        for entry in _scan_dir(folder.path, want_dirs=False):
+            if file_filter(entry.name):
+                collected.append(entry.path)
+    return collected
+
+
+def _refresh_subject(subject_path, known_mtime, known_sessions, file_filter,
+                     now_ns):
+    """
+    Re-check one subject directory against its indexed state.
+
+    Parameters
+    ----------
+    subject_path : str
+        Path to the ``sub-*`` directory.
+    known_mtime : int or None
+        Subject directory mtime recorded in the index.
+    known_sessions : dict
+        Indexed session path -> signature for this subject.
+    file_filter : callable
+        Called with each file name; files are kept when it returns True.
+    now_ns : int
+        Wall clock time of this refresh, in nanoseconds.
+
+    Returns
+    -------
+    tuple
+        (subject mtime to record, {session path: (signature, file list or
+        None if unchanged)}).
+    """
+    mtime = _mtime_ns(subject_path)
+    if mtime is not None and mtime == known_mtime:
+        session_paths = sorted(known_sessions)
+    else:
+        session_paths = [entry.path for entry in
+                         _scan_dir(subject_path, prefix='ses-')]
+    if not _fresh(mtime, now_ns):
+        mtime = None
+
+    sessions = {}
+    for session_path in session_paths:
+        signature = _session_signature(session_path, now_ns)
+        if signature is not None and signature == known_sessions.get(
+                session_path):
+            sessions[session_path] = (signature, None)
+        else:
+            sessions[session_path] = (
+                signature, _list_session(session_path, file_filter))
+    return mtime, sessions
+
+
+def refresh_index(conn, root_dir, kind, file_filter,
+                  threads=DEFAULT_THREADS):
+    """
+    Bring the index for one tree up to date and report what changed.
+
+    Only the ``sub-*/ses-*/{anat,func}`` layout is tracked. A subject is
+    re-listed only when its directory mtime changed, and a session only when
+    the mtime of the session directory or one of its modality folders
+    changed, so an unchanged tree costs a few stats per session.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by ``open_index``.
+    root_dir : str
+        Path to the rawdata or MRIQC output root.
+    kind : str
+        Name of the file class being tracked (e.g. 'nifti' or 'json'); the
+        same root can be tracked for several kinds.
+    file_filter : callable
+        Called with each file name; files are kept when it returns True.
+    threads : int
+        Number of subject directories checked concurrently.
+
+    Returns
+    -------
+    tuple of (list of str, list of str)
+        Paths added and removed since the previous refresh.
+    """
+    now_ns = int(time.time() * 1e9)
+    subjects = [entry.path for entry in _scan_dir(root_dir, prefix='sub-')]
+    known_mtimes = dict(conn.execute(
+        "SELECT path, mtime_ns FROM subjects WHERE kind = ? AND root = ?",
+        (kind, root_dir)))
+    known_sessions = {}
+    for subject_path, session_path, signature in conn.execute(
+            "SELECT s.subject_path, s.path, s.signature FROM sessions s "
+            "JOIN subjects j ON j.kind = s.kind AND j.path = s.subject_path "
+            "WHERE j.kind = ? AND j.root = ?", (kind, root_dir)):
+        known_sessions.setdefault(subject_path, {})[session_path] = signature
+
+    added, removed = [], []
+
+    def drop_sessions(session_paths):
+        for session_path in session_paths:
+            removed.extend(path for (path,) in conn.execute(
+                "SELECT path FROM files WHERE kind = ? AND session_path = ?",
+                (kind, session_path)))
+            conn.execute(
+                "DELETE FROM files WHERE kind = ? AND session_path = ?",
+                (kind, session_path))
+            conn.execute("DELETE FROM sessions WHERE kind = ? AND path = ?",
+                         (kind, session_path))
+
+    with conn:
+        for subject_path in set(known_mtimes) - set(subjects):
+            drop_sessions(known_sessions.get(subject_path, {}))
+            conn.execute("DELETE FROM subjects WHERE kind = ? AND path = ?",
+                         (kind, subject_path))
+
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            results = executor.map(
+                lambda subject_path: _refresh_subject(
+                    subject_path, known_mtimes.get(subject_path),
+                    known_sessions.get(subject_path, {}), file_filter,
+                    now_ns),
+                subjects)
+            for subject_path, (mtime, sessions) in zip(subjects, results):
+                conn.execute(
+                    "INSERT OR REPLACE INTO subjects (kind, root, path, "
+                    "mtime_ns) VALUES (?, ?, ?, ?)",
+                    (kind, root_dir, subject_path, mtime))
+                drop_sessions(set(known_sessions.get(subject_path, {}))
+                              - set(sessions))
+                for session_path, (signature, files) in sessions.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sessions (kind, subject_path, "
+                        "path, signature) VALUES (?, ?, ?, ?)",
+                        (kind, subject_path, session_path, signature))
+                    if files is None:
+                        continue
+                    old_files = {path for (path,) in conn.execute(
+                        "SELECT path FROM files WHERE kind = ? "
+                        "AND session_path = ?", (kind, session_path))}
+                    new_files = set(files)
+                    added.extend(sorted(new_files - old_files))
+                    removed.extend(sorted(old_files - new_files))
+                    conn.executemany(
+                        "DELETE FROM files WHERE kind = ? AND path = ?",
+                        [(kind, path) for path in old_files - new_files])
+                    conn.executemany(
+                        "INSERT INTO files (kind, session_path, path) "
+                        "VALUES (?, ?, ?)",
+                        [(kind, session_path, path)
+                         for path in new_files - old_files])
+    return added, removed
+
+
+def indexed_files(conn, root_dir, kind):
+    """Return the indexed file paths of one tree in crawl order."""
+    paths = [path for (path,) in conn.execute(
+        "SELECT f.path FROM files f "
+        "JOIN sessions s ON s.kind = f.kind AND s.path = f.session_path "
+        "JOIN subjects j ON j.kind = s.kind AND j.path = s.subject_path "
+        "WHERE j.kind = ? AND j.root = ?", (kind, root_dir))]
+    paths.sort(key=entry_sort_key)
+    return paths
@@ -43,42 +43,270 @@
 # find_missing_entries.py
 import argparse
 import csv
+import heapq
+
+from manifest import (is_manifest, read_entry_rows, read_table,
+                      write_entry_rows)
+
+MISSING, SATISFIED, ORPHAN = 'missing', 'satisfied', 'orphan'
 
 
 def read_csv_file(csv_file):
+    # csv_file may also be an .npz manifest
     entries = set()
-    with open(csv_file, 'r') as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip header
-        for row in reader:
-            entries.add(tuple(row))
+    for row in read_entry_rows(csv_file):
+        entries.add(tuple(row))
     return entries
 
 
-def find_missing_entries(nifti_csv, json_csv, output_diff_file):
-    nifti_entries = read_csv_file(nifti_csv)
-    json_entries = read_csv_file(json_csv)
+def _read_rooted(path):
+    if is_manifest(path):
+        table = read_table(path)
+        if 'Root' in table:
+            roots = (str(root) for root in table['Root'])
+        else:
+            roots = (path for _ in table['File'])
+        return zip((tuple(row) for row in read_entry_rows(path)), roots)
+    return ((tuple(row), path) for row in read_entry_rows(path))
+
+
+def read_rooted_entries(path, presort=False):
+    """
+    Yield ((Subject, Session, Folder, File), root) pairs from a CSV or an
+    .npz manifest.
+
+    The root is taken from the manifest 'Root' column when there is one, and
+    is the input path otherwise.
+
+    Parameters
+    ----------
+    path : str
+        Path to the CSV file or .npz manifest.
+    presort : bool
+        Load and sort the whole input first, for lists that were not written
+        in sorted order. This gives up the constant-memory streaming.
+    """
+    entries = _read_rooted(path)
+    if presort:
+        entries = sorted(entries)
+    return _ensure_sorted(entries, path)
+
+
+def _ensure_sorted(entries, label):
+    """Pass entries through, failing on the first out-of-order one."""
+    previous = None
+    for entry, root in entries:
+        if previous is not None and entry < previous:
+            raise ValueError(
+                f"{label} is not sorted by Subject, Session, Folder, File "
+                f"({entry} after {previous}); regenerate it with "
+                f"collect_files.py or pass --sort")
+        previous = entry
+        yield entry, root
+
+
+def merge_entries(nifti_entries, json_streams):
+    """
+    Sorted-merge join of NIfTI entries against one or more JSON streams.
+
+    Every input must be sorted by (Subject, Session, Folder, File). The JSON
+    streams are merged with a heap, so memory stays constant no matter how
+    large the lists are.
+
+    Parameters
+    ----------
+    nifti_entries : iterable of tuple
+        Sorted (Subject, Session, Folder, File) NIfTI entries.
+    json_streams : list of iterable
+        Sorted ((Subject, Session, Folder, File), root) streams, one per
+        JSON list. The order of the streams sets the order roots are
+        reported in.
+
+    Yields
+    ------
+    tuple of (str, tuple, list of str)
+        (status, entry, roots) where status is ``MISSING`` for NIfTIs with
+        no JSON, ``SATISFIED`` for NIfTIs with a JSON in ``roots``, and
+        ``ORPHAN`` for JSONs with no NIfTI.
+    """
+    tagged = [((entry, rank, root) for entry, root in stream)
+              for rank, stream in enumerate(json_streams)]
+    json_iter = heapq.merge(*tagged)
+    current = next(json_iter, None)
+    last_entry, last_roots = None, []
+    for entry in nifti_entries:
+        entry = tuple(entry)
+        if entry == last_entry:
+            # Repeated NIfTI entry (e.g. the same file listed twice)
+            yield (SATISFIED if last_roots else MISSING), entry, last_roots
+            continue
+        while current is not None and current[0] < entry:
+            yield ORPHAN, current[0], [current[2]]
+            current = next(json_iter, None)
+        roots = []
+        while current is not None and current[0] == entry:
+            if current[2] not in roots:
+                roots.append(current[2])
+            current = next(json_iter, None)
+        last_entry, last_roots = entry, roots
+        yield (SATISFIED if roots else MISSING), entry, roots
+    while current is not None:
+        yield ORPHAN, current[0], [current[2]]
+        current = next(json_iter, None)
+
+
+def entity_join_entries(nifti_entries, json_entries):
+    """
+    Diff NIfTI and JSON entries as an integer join on BIDS entity keys.
+
+    Unlike ``merge_entries`` this loads both lists, needs no sort order and
+    matches on parsed entities rather than raw names (so ``run-01`` matches
+    ``run-1``); non-participant files are dropped.
+
+    Parameters
+    ----------
+    nifti_entries : list of tuple
+        (Subject, Session, Folder, File) NIfTI entries.
+    json_entries : list of tuple
+        ((Subject, Session, Folder, File), root) JSON entries.
+
+    Yields
+    ------
+    tuple of (str, tuple, list of str)
+        (status, entry, roots) as in ``merge_entries``, NIfTI entries in
+        sorted order followed by orphans.
+    """
+    from bids_entities import encode_entity_keys
+
+    nifti_keys, json_keys = encode_entity_keys(
+        ['/'.join(entry) for entry in nifti_entries],
+        ['/'.join(entry) for entry, _ in json_entries])
+    roots_by_key = {}
+    for key, (_, root) in zip(json_keys.tolist(), json_entries):
+        if key >= 0:
+            roots = roots_by_key.setdefault(key, [])
+            if root not in roots:
+                roots.append(root)
+
+    for key, entry in sorted(set(zip(nifti_keys.tolist(), nifti_entries)),
+                             key=lambda item: item[1]):
+        if key < 0:
+            continue
+        roots = roots_by_key.pop(key, None)
+        if roots is None:
+            yield MISSING, entry, []
+        else:
+            roots_by_key[key] = roots
+            yield SATISFIED, entry, roots
+    nifti_key_set = set(nifti_keys.tolist())
+    for key, (entry, root) in zip(json_keys.tolist(), json_entries):
+        if key >= 0 and key not in nifti_key_set:
+            yield ORPHAN, entry, [root]
+
+
+def write_entries(entries, output_diff_file):
+    # An .npz output_diff_file is written as a compact manifest
+    write_entry_rows(output_diff_file, entries)
+
+
+def _open_rooted_csv(path):
+    if path is None:
+        return None, None
+    file = open(path, 'w', newline='')
+    writer = csv.writer(file)
+    writer.writerow(['Subject', 'Session', 'Folder', 'File', 'Root'])
+    return file, writer
+
+
+def find_missing_entries(nifti_csv, json_csv, output_diff_file,
+                         satisfied_csv=None, orphans_csv=None, presort=False,
+                         method='merge'):
+    """
+    Write the NIfTI entries that have no MRIQC JSON in any output root.
+
+    Parameters
+    ----------
+    nifti_csv : str
+        Path to the NIfTI CSV file or .npz manifest.
+    json_csv : str or list of str
+        Path(s) to the JSON CSV files or .npz manifests, one per MRIQC
+        output root or one for all of them.
+    output_diff_file : str
+        Path to the output CSV file (or .npz manifest) for missing entries.
+    satisfied_csv : str, optional
+        Path to a CSV of NIfTI entries that have a JSON, with the root(s)
+        that provided it.
+    orphans_csv : str, optional
+        Path to a CSV of JSON entries with no NIfTI.
+    presort : bool
+        Sort unsorted inputs in memory instead of failing on them.
+    method : str
+        'merge' for the constant-memory sorted merge on raw names, or
+        'entities' for an in-memory integer join on parsed BIDS entities.
+    """
+    if isinstance(json_csv, str):
+        json_csv = [json_csv]
+    if method == 'entities':
+        results = entity_join_entries(
+            [entry for entry, _ in _read_rooted(nifti_csv)],
+            [item for path in json_csv for item in _read_rooted(path)])
+    else:
+        nifti_entries = (entry for entry, _ in
+                         read_rooted_entries(nifti_csv, presort))
+        json_streams = [read_rooted_entries(path, presort)
+                        for path in json_csv]
+        results = merge_entries(nifti_entries, json_streams)
 
-    missing_entries = nifti_entries - json_entries
+    satisfied_file, satisfied_writer = _open_rooted_csv(satisfied_csv)
+    orphans_file, orphans_writer = _open_rooted_csv(orphans_csv)
+    try:
+        def missing_entries():
+            for status, entry, roots in results:
+                if status == MISSING:
+                    yield entry
+                elif status == SATISFIED and satisfied_writer is not None:
+                    satisfied_writer.writerow(list(entry) + [';'.join(roots)])
+                elif status == ORPHAN and orphans_writer is not None:
+                    orphans_writer.writerow(list(entry) + roots)
 
-    with open(output_diff_file, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Subject', 'Session', 'Folder', 'File'])
-        for entry in sorted(missing_entries):
-            writer.writerow(entry)
+        write_entries(missing_entries(), output_diff_file)
+    finally:
+        for file in (satisfied_file, orphans_file):
+            if file is not None:
+                file.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Find missing entries between NIfTI paths and JSON paths in CSV files.")
     parser.add_argument("-n", "--nifti_csv",
-                        help="Path to the CSV file containing NIfTI paths.")
-    parser.add_argument("-j", "--json_csv",
-                        help="Path to the CSV file containing JSON paths.")
+                        help="Path to the CSV file (or .npz manifest) "
+                             "containing NIfTI paths.")
+    parser.add_argument("-j", "--json_csv", nargs='+',
+                        help="Path(s) to the CSV files (or .npz manifests) "
+                             "containing JSON paths, e.g. one per MRIQC "
+                             "output root.")
     parser.add_argument("-o", "--output_diff_file",
                         help="Path to the output CSV file for missing entries.")
+    parser.add_argument("-s", "--satisfied_csv",
+                        help="Path to an output CSV of NIfTI entries that "
+                             "have a JSON, with the root that provided it.")
+    parser.add_argument("-r", "--orphans_csv",
+                        help="Path to an output CSV of JSON entries that "
+                             "have no NIfTI.")
+    parser.add_argument("-m", "--method", choices=['merge', 'entities'],
+                        default='merge',
+                        help="'merge': constant-memory sorted merge on file "
+                             "names (default). 'entities': in-memory integer "
+                             "join on parsed BIDS entities, for unsorted "
+                             "lists.")
+    parser.add_argument("--sort", action="store_true",
+                        help="Sort inputs in memory first, for lists that "
+                             "were not written in sorted order.")
     args = parser.parse_args()
 
-    find_missing_entries(args.nifti_csv, args.json_csv, args.output_diff_file)
+    find_missing_entries(args.nifti_csv, args.json_csv, args.output_diff_file,
+                         args.satisfied_csv, args.orphans_csv, args.sort,
+                         args.method)
 
     print(f"Missing entries have been written to {args.output_diff_file}")
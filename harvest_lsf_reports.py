@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_LOGS_ROOT_DIR = '/data/predict1/home/rez3/bin/logs'
+DEFAULT_THREADS = 16
+PERCENTILES = (50, 90, 95, 99, 100)
+ERROR_TAIL_LENGTH = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    job_id TEXT,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    exec_host TEXT,
+    queue TEXT,
+    exit_code INTEGER,
+    term_reason TEXT,
+    cpu_sec REAL,
+    max_mem_mb REAL,
+    avg_mem_mb REAL,
+    req_mem_mb REAL,
+    max_swap_mb REAL,
+    max_processes INTEGER,
+    max_threads INTEGER,
+    run_sec REAL,
+    turnaround_sec REAL,
+    error_tail TEXT,
+    harvested_time REAL
+);
+CREATE INDEX IF NOT EXISTS reports_job ON reports (job_id, subject, session);
+"""
+
+JOB_RE = re.compile(r'^Subject: Job (\d+(?:\[\d+\])?):', re.MULTILINE)
+HOST_RE = re.compile(r'^Job was executed on host\(s\) <(?:\d+\*)?([^>]+)>, '
+                     r'in queue <([^>]+)>', re.MULTILINE)
+EXIT_RE = re.compile(r'^Exited with exit code (\d+)\.', re.MULTILINE)
+DONE_RE = re.compile(r'^Successfully completed\.', re.MULTILINE)
+TERM_RE = re.compile(r'^(TERM_[A-Z_]+):', re.MULTILINE)
+# 'Resource usage summary' lines, e.g. '    Max Memory :   12345 MB'
+USAGE_FIELDS = {
+    'CPU time': 'cpu_sec',
+    'Max Memory': 'max_mem_mb',
+    'Average Memory': 'avg_mem_mb',
+    'Total Requested Memory': 'req_mem_mb',
+    'Max Swap': 'max_swap_mb',
+    'Max Processes': 'max_processes',
+    'Max Threads': 'max_threads',
+    'Run time': 'run_sec',
+    'Turnaround time': 'turnaround_sec',
+}
+USAGE_RE = re.compile(r'^\s*({}) :\s+([\d.]+)'.format(
+    '|'.join(map(re.escape, USAGE_FIELDS))), re.MULTILINE)
+
+
+def parse_report(text):
+    """
+    Parse an LSF job report (the -o file of a job).
+
+    Returns
+    -------
+    dict or None
+        Job ID, host, queue, exit code, TERM_ reason and the resource usage
+        summary fields (see ``USAGE_FIELDS``); None if ``text`` holds no
+        finished LSF report.
+    """
+    job = JOB_RE.search(text)
+    if job is None:
+        return None
+    report = {'job_id': job.group(1)}
+    host = HOST_RE.search(text)
+    report['exec_host'], report['queue'] = host.groups() if host \
+        else (None, None)
+    exited = EXIT_RE.search(text)
+    if exited:
+        report['exit_code'] = int(exited.group(1))
+    elif DONE_RE.search(text):
+        report['exit_code'] = 0
+    else:
+        report['exit_code'] = None
+    term = TERM_RE.search(text)
+    report['term_reason'] = term.group(1) if term else None
+    for name, value in USAGE_RE.findall(text):
+        report[USAGE_FIELDS[name]] = float(value)
+    return report
+
+
+def _error_tail(err_path):
+    """Return the last non-empty line of a job's .err file."""
+    try:
+        with open(err_path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(0, file.tell() - 4096))
+            lines = file.read().decode(errors='replace').splitlines()
+    except OSError:
+        return None
+    lines = [line.strip() for line in lines if line.strip()]
+    return lines[-1][:ERROR_TAIL_LENGTH] if lines else None
+
+
+def _harvest(task):
+    """Worker: parse one report and, for failed jobs, its .err."""
+    path, subject, session, size, mtime_ns = task
+    try:
+        with open(path, errors='replace') as file:
+            report = parse_report(file.read())
+    except OSError:
+        return None
+    if report is None:
+        return None
+    if report['exit_code']:
+        report['error_tail'] = _error_tail(path[:-len('.out')] + '.err')
+    report.update(path=path, subject=subject, session=session, size=size,
+                  mtime_ns=mtime_ns)
+    return report
+
+
+def _list_reports(subject_dir):
+    """Return (path, subject, session, size, mtime_ns) of a subject's .out files."""
+    found = []
+    subject = os.path.basename(subject_dir)
+    try:
+        with os.scandir(subject_dir) as sessions:
+            session_dirs = [entry for entry in sessions
+                            if entry.name.startswith('ses-') and entry.is_dir()]
+        for session in session_dirs:
+            with os.scandir(session.path) as files:
+                for entry in files:
+                    if entry.name.endswith('.out'):
+                        # stat() follows the links of job array and pack
+                        # logs; a pack's link dangles until LSF writes it
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        found.append((entry.path, subject, session.name,
+                                      stat.st_size, stat.st_mtime_ns))
+    except OSError:
+        pass
+    return found
+
+
+def open_telemetry(db_path):
+    """Open (and create if needed) the telemetry database."""
+    conn = sqlite3.connect(str(db_path), timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def harvest_reports(conn, logs_root_dir, threads=DEFAULT_THREADS):
+    """
+    Parse new and changed LSF reports under ``<logs_root_dir>/sub-*/ses-*/``.
+
+    Subject directories are listed and reports parsed by a thread pool.
+    Reports whose size and mtime match the table are skipped, so repeated
+    runs only read what LSF wrote since. Rows of reports that are gone are
+    kept, as the telemetry stays useful after logs are cleaned up.
+
+    Returns
+    -------
+    tuple of int
+        (reports parsed, reports skipped).
+    """
+    known = {row['path']: (row['size'], row['mtime_ns'])
+             for row in conn.execute("SELECT path, size, mtime_ns FROM reports")}
+    with os.scandir(logs_root_dir) as it:
+        subject_dirs = sorted(entry.path for entry in it
+                              if entry.name.startswith('sub-')
+                              and entry.is_dir())
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        listed = [task for tasks in executor.map(_list_reports, subject_dirs)
+                  for task in tasks]
+        tasks = [task for task in listed
+                 if known.get(task[0]) != (task[3], task[4])]
+        reports = [report for report in executor.map(_harvest, tasks)
+                   if report is not None]
+    columns = ['path', 'size', 'mtime_ns', 'job_id', 'subject', 'session',
+               'exec_host', 'queue', 'exit_code', 'term_reason'] + \
+        list(USAGE_FIELDS.values()) + ['error_tail']
+    now = time.time()
+    with conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO reports ({', '.join(columns)}, "
+            f"harvested_time) VALUES ({', '.join('?' * len(columns))}, ?)",
+            [tuple(report.get(column) for column in columns) + (now,)
+             for report in reports])
+    return len(tasks), len(listed) - len(tasks)
+
+
+def _walltime_sec(walltime):
+    hours, minutes = walltime.split(':')
+    return (int(hours) * 60 + int(minutes)) * 60
+
+
+def requested_resources(conn, registry_path):
+    """
+    Return {report path: (requested MB, requested walltime seconds)}.
+
+    Requests come from the job registry when it recorded the job's
+    resources; otherwise the memory is the report's 'Total Requested
+    Memory' and the walltime is unknown (NaN).
+    """
+    registry = {}
+    if registry_path:
+        from job_registry import open_registry
+        registry_conn = open_registry(registry_path)
+        for row in registry_conn.execute(
+                "SELECT job_id, subject, session, resources FROM jobs "
+                "WHERE resources IS NOT NULL"):
+            resources = json.loads(row['resources'])
+            registry[(row['job_id'], row['subject'], row['session'])] = (
+                resources['mem_mb'], _walltime_sec(resources['walltime']))
+        registry_conn.close()
+    requested = {}
+    for row in conn.execute("SELECT path, job_id, subject, session, "
+                            "req_mem_mb FROM reports"):
+        requested[row['path']] = registry.get(
+            (row['job_id'], row['subject'], row['session']),
+            (row['req_mem_mb'] if row['req_mem_mb'] is not None
+             else float('nan'), float('nan')))
+    return requested
+
+
+def summarize(conn, registry_path=None, since_days=None):
+    """Print percentiles of run time and peak memory, and their waste."""
+    query = "SELECT * FROM reports WHERE exit_code IS NOT NULL"
+    params = ()
+    if since_days:
+        query += " AND mtime_ns > ?"
+        params = (int((time.time() - since_days * 86400) * 1e9),)
+    # The sessions of a pack share its report, which counts once
+    rows = list({row['job_id'] or row['path']: row for row in
+                 conn.execute(query, params)}.values())
+    if not rows:
+        print("No reports")
+        return
+    requested = requested_resources(conn, registry_path)
+    run_sec = np.array([row['run_sec'] or np.nan for row in rows])
+    max_mem = np.array([row['max_mem_mb'] or np.nan for row in rows])
+    req_mem = np.array([requested[row['path']][0] for row in rows],
+                       dtype=float)
+    req_sec = np.array([requested[row['path']][1] for row in rows],
+                       dtype=float)
+
+    failed = sum(1 for row in rows if row['exit_code'])
+    reasons = {}
+    for row in rows:
+        if row['term_reason']:
+            reasons[row['term_reason']] = reasons.get(row['term_reason'],
+                                                      0) + 1
+    print(f"Jobs: {len(rows)} ({len(rows) - failed} done, {failed} exited"
+          + ''.join(f", {count} {reason}"
+                    for reason, count in sorted(reasons.items())) + ")")
+    print(f"{'':26}" + ''.join(f"{'p' + str(p) if p < 100 else 'max':>9}"
+                               for p in PERCENTILES))
+    for label, values in (
+            ('Run time (h)', run_sec / 3600),
+            ('Peak memory (GB)', max_mem / 1024),
+            ('Requested memory (GB)', req_mem / 1024),
+            ('Peak / requested memory', max_mem / req_mem),
+            ('Run time / walltime', run_sec / req_sec)):
+        values = values[np.isfinite(values)]
+        if not len(values):
+            continue
+        print(f"{label:26}" + ''.join(
+            f"{value:9.2f}" for value in np.percentile(values, PERCENTILES)))
+
+    reserved = np.isfinite(req_mem) & np.isfinite(max_mem) & \
+        np.isfinite(run_sec)
+    if reserved.any():
+        hours = run_sec[reserved] / 3600
+        total = np.sum(req_mem[reserved] / 1024 * hours)
+        unused = np.sum(np.clip(req_mem[reserved] - max_mem[reserved], 0,
+                                None) / 1024 * hours)
+        print(f"Reserved memory left unused: {unused:.0f} of {total:.0f} "
+              f"GB-hours ({100 * unused / total:.0f}%)")
+    walltime = np.isfinite(req_sec) & np.isfinite(run_sec)
+    if walltime.any():
+        print(f"Walltime left unused: "
+              f"{np.sum(req_sec[walltime] - run_sec[walltime]) / 3600:.0f} of "
+              f"{np.sum(req_sec[walltime]) / 3600:.0f} hours")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Harvest runtime and memory telemetry from MRIQC jobs' "
+                    "LSF reports and summarize it against what was "
+                    "requested.")
+    parser.add_argument("-l", "--logs_root_dir", default=DEFAULT_LOGS_ROOT_DIR,
+                        help="Root of the <subject>/<session> log dirs.")
+    parser.add_argument("-b", "--db",
+                        help="Telemetry database (default: "
+                             "lsf_telemetry.sqlite next to the logs root).")
+    parser.add_argument("-g", "--registry",
+                        help="Job registry (see job_registry.py) holding the "
+                             "requested memory and walltime of each job.")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="Number of directories and reports read "
+                             "concurrently.")
+    parser.add_argument("-d", "--since_days", type=float,
+                        help="Only summarize reports of the last N days.")
+    parser.add_argument("-n", "--no_harvest", action="store_true",
+                        help="Summarize the table without scanning the logs.")
+    args = parser.parse_args()
+
+    logs_root_dir = os.path.abspath(args.logs_root_dir)
+    db_path = args.db or os.path.join(os.path.dirname(logs_root_dir),
+                                      'lsf_telemetry.sqlite')
+    conn = open_telemetry(db_path)
+    if not args.no_harvest:
+        parsed, skipped = harvest_reports(conn, logs_root_dir, args.threads)
+        print(f"Parsed {parsed} reports, {skipped} unchanged")
+    summarize(conn, args.registry, args.since_days)
+    conn.close()
@@ -0,0 +1,205 @@
+# instrumentation.py
+import os
+import re
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import resource
+
+METRIC_PREFIX = 'mriqc_wrapper'
+# ru_inblock and ru_oublock count 512-byte blocks
+BLOCK_SIZE = 512
+PROFILE_TOP = 40
+
+# Prometheus metric -> (record field, scale, help text)
+STAGE_METRICS = {
+    'stage_wall_seconds': ('wall_seconds', 1,
+                           'Wall time of the stage in the last run.'),
+    'stage_cpu_seconds': ('cpu_seconds', 1,
+                          'User and system CPU time of the stage, its '
+                          'child processes included.'),
+    'stage_peak_rss_bytes': ('peak_rss_mb', 1024 * 1024,
+                             'Peak RSS of the wrapper process after the '
+                             'stage.'),
+    'stage_children_peak_rss_bytes': ('children_peak_rss_mb', 1024 * 1024,
+                                      'Largest peak RSS of any child process '
+                                      'finished by the end of the stage.'),
+    'stage_items': ('items', 1, 'Items (files, rows or pairs) the stage '
+                                'produced.'),
+    'stage_read_bytes': ('read_bytes', 1, 'Bytes read from storage by the '
+                                          'stage and its children.'),
+    'stage_write_bytes': ('write_bytes', 1, 'Bytes written to storage by the '
+                                            'stage and its children.'),
+}
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own, children
+
+
+def count_lines(*paths):
+    """
+    Count the lines of text files, less one header line for each CSV.
+
+    Returns None if any of them cannot be read (e.g. a .npz manifest).
+    """
+    total = 0
+    for path in paths:
+        if not str(path).endswith(('.txt', '.csv')):
+            return None
+        try:
+            with open(path, 'rb') as file:
+                lines = sum(block.count(b'\n') for block in
+                            iter(lambda: file.read(1 << 20), b''))
+        except OSError:
+            return None
+        total += lines - 1 if str(path).endswith('.csv') and lines else lines
+    return total
+
+
+def _slug(name):
+    return re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_').lower()
+
+
+class RunRecorder:
+    """
+    Measure the stages of one wrapper run.
+
+    Each stage gets its wall and CPU time, peak RSS, item count and block
+    I/O. CPU time and I/O include the child processes the stage waited for,
+    so the subprocess-per-script stages are measured as well as in-process
+    ones. RSS figures are high-water marks: the wrapper's own, and the
+    largest of any child so far. With a ``profile_dir``, each stage also
+    runs under cProfile, which only sees work done in this process (use
+    --in_process to profile the pipeline itself).
+    """
+
+    def __init__(self, run_log=None, metrics_textfile=None, profile_dir=None):
+        self.run_log = run_log
+        self.metrics_textfile = metrics_textfile
+        self.profile_dir = profile_dir
+        self.run_id = time.strftime('%Y%m%d_%H%M%S_') + uuid.uuid4().hex[:8]
+        self.records = []
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def run_stage(self, name, function, args, items=None):
+        """
+        Run ``function(*args)`` as the stage ``name`` and record it.
+
+        ``items`` is a callable counting what the stage produced, called
+        with its result; otherwise the length of a list or tuple result is
+        used. Exceptions are recorded and raised again.
+        """
+        own_before, children_before = _usage()
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        profiler = cProfile.Profile() if self.profile_dir else None
+        status = 'ok'
+        result = None
+        try:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = function(*args)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            own, children = _usage()
+            record = {
+                'run_id': self.run_id, 'stage': name,
+                'index': len(self.records),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'status': status, 'wall_seconds': wall,
+                'cpu_seconds': time.process_time() - cpu_before
+                + (children.ru_utime - children_before.ru_utime)
+                + (children.ru_stime - children_before.ru_stime),
+                # ru_maxrss is in kilobytes on Linux
+                'peak_rss_mb': own.ru_maxrss / 1024,
+                'children_peak_rss_mb': children.ru_maxrss / 1024,
+                'read_bytes': BLOCK_SIZE * (
+                    own.ru_inblock - own_before.ru_inblock
+                    + children.ru_inblock - children_before.ru_inblock),
+                'write_bytes': BLOCK_SIZE * (
+                    own.ru_oublock - own_before.ru_oublock
+                    + children.ru_oublock - children_before.ru_oublock),
+                'items': None,
+            }
+            if status == 'ok':
+                record['items'] = items(result) if items is not None else \
+                    len(result) if isinstance(result, (list, tuple)) else None
+            if profiler is not None:
+                record['profile'] = self._dump_profile(profiler, record)
+            self.records.append(record)
+            self._log(record)
+        return result
+
+    def _dump_profile(self, profiler, record):
+        path = os.path.join(self.profile_dir,
+                            f"{self.run_id}_{record['index']:02d}_"
+                            f"{_slug(record['stage'])}.prof")
+        profiler.dump_stats(path)
+        with open(path[:-len('.prof')] + '.txt', 'w') as file:
+            pstats.Stats(profiler, stream=file).sort_stats(
+                'cumulative').print_stats(PROFILE_TOP)
+        return path
+
+    def _log(self, record):
+        if not self.run_log:
+            return
+        # One write on an O_APPEND descriptor, so overlapping runs do not
+        # interleave their lines
+        fd = os.open(self.run_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, (json.dumps(record) + '\n').encode())
+        finally:
+            os.close(fd)
+
+    def write_metrics(self):
+        """
+        Write the run's stages as a Prometheus textfile (for the node
+        exporter's textfile collector), replacing the previous run's.
+        """
+        if not self.metrics_textfile:
+            return
+        lines = []
+        for metric, (field, scale, help_text) in STAGE_METRICS.items():
+            name = f'{METRIC_PREFIX}_{metric}'
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+            for record in self.records:
+                if record[field] is not None:
+                    stage = record['stage'].replace('\\', '\\\\') \
+                        .replace('"', '\\"')
+                    lines.append(f'{name}{{stage="{stage}",'
+                                 f'status="{record["status"]}"}} '
+                                 f'{record[field] * scale}')
+        name = f'{METRIC_PREFIX}_last_run_timestamp_seconds'
+        lines += [f'# HELP {name} End time of the last wrapper run.',
+                  f'# TYPE {name} gauge', f'{name} {time.time():.0f}']
+        temp_path = f'{self.metrics_textfile}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.metrics_textfile)
+
+    def summary(self):
+        """Return a table of the recorded stages, one line each."""
+        lines = [f"{'Stage':44}{'wall s':>9}{'cpu s':>9}{'items':>10}"
+                 f"{'RSS MB':>8}"]
+        for record in self.records:
+            rss = max(record['peak_rss_mb'], record['children_peak_rss_mb'])
+            items = '' if record['items'] is None else record['items']
+            lines.append(f"{record['stage'][:43]:44}"
+                         f"{record['wall_seconds']:9.2f}"
+                         f"{record['cpu_seconds']:9.2f}{items:>10}"
+                         f"{rss:8.0f}")
+        return '\n'.join(lines)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import logging
+import argparse
+import subprocess
+
+import automated_mriqc_runner as runner
+from lsf import lsf_command
+from job_registry import (DEFAULT_REGISTRY, ACTIVE_STATES, open_registry,
+                          poll, jobs_in_state)
+
+DEFAULT_STATE_FILE = '/data/predict1/home/rez3/bin/code/mriqc_pipeline' \
+                     '/controller_state.json'
+DEFAULT_TARGET = 20
+DEFAULT_MIN_TARGET = 2
+DEFAULT_INCREASE = 2
+DEFAULT_BACKOFF = 0.5
+DEFAULT_PENDING_GROWTH = 10
+DEFAULT_INTERVAL = 300
+
+
+def queue_pending(queue):
+    """
+    Return the number of pending jobs in an LSF queue, from ``bqueues``.
+
+    Returns None if bqueues fails or does not list the queue.
+    """
+    try:
+        result = subprocess.run([lsf_command('bqueues'), queue],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+    except OSError:
+        return None
+    lines = [line.split() for line in result.stdout.splitlines()
+             if line.strip()]
+    if len(lines) < 2 or 'PEND' not in lines[0]:
+        return None
+    column = lines[0].index('PEND')
+    for values in lines[1:]:
+        if values[0] == queue and len(values) > column:
+            try:
+                return int(values[column])
+            except ValueError:
+                return None
+    return None
+
+
+def load_state(state_file, target):
+    """Read the controller state, starting at the full target window."""
+    try:
+        with open(state_file) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {'window': target, 'pending': None}
+
+
+def save_state(state_file, state):
+    """Write the controller state atomically."""
+    temp_file = f'{state_file}.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(state, file)
+    os.replace(temp_file, state_file)
+
+
+def next_window(window, pending, last_pending, target, min_target, increase,
+                backoff, pending_growth):
+    """
+    Adjust the in-flight window additively up, multiplicatively down (AIMD).
+
+    The window is cut by ``backoff`` when the pending count of other users'
+    jobs in the queue grew by more than ``pending_growth`` since the previous
+    cycle, and otherwise grows by ``increase``, always staying within
+    [min_target, target].
+    """
+    if pending is not None and last_pending is not None \
+            and pending - last_pending > pending_growth:
+        window = window * backoff
+    else:
+        window = window + increase
+    return max(min_target, min(target, window))
+
+
+def run_cycle(conn, state, csv_file, submit_kwargs, target, min_target,
+              increase, backoff, pending_growth, queue, skip_poll=False):
+    """
+    Run one control cycle: refresh job states, adjust the window and top up.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Job registry connection (see job_registry.py).
+    state : dict
+        Controller state ('window', and 'pending', the other users' pending
+        jobs in the queue), updated in place.
+    csv_file : str
+        Caselist of subject-session pairs still to run (unused when
+        ``submit_kwargs`` has a 'work_queue_path').
+    submit_kwargs : dict
+        Remaining keyword arguments of ``automated_mriqc_runner.main``.
+    skip_poll : bool
+        Use the registry as it is, e.g. when the caller has just polled.
+
+    Returns
+    -------
+    int
+        Number of jobs submitted.
+    """
+    if not skip_poll:
+        poll(conn)
+    our_pending = len(jobs_in_state(conn, 'SUBMITTED', 'PEND'))
+    in_flight = len(jobs_in_state(conn, *ACTIVE_STATES))
+    # Only the backlog of other users signals congestion: our own pending
+    # jobs grow with every top-up
+    pending = queue_pending(queue)
+    if pending is not None:
+        pending = max(0, pending - our_pending)
+    state['window'] = next_window(state['window'], pending,
+                                  state.get('pending'), target, min_target,
+                                  increase, backoff, pending_growth)
+    state['pending'] = pending
+
+    top_up = int(state['window']) - in_flight
+    logging.info(f"Controller: {in_flight} in flight ({our_pending} "
+                 f"pending), {pending} others' jobs pending in {queue}, "
+                 f"window {state['window']:.1f}, submitting {max(0, top_up)}")
+    if top_up <= 0:
+        return 0
+    return runner.main(csv_file, num_subjects=top_up, **submit_kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep a target number of MRIQC jobs pending or running, "
+                    "topping up from the caselist as jobs finish and backing "
+                    "off while other users' pending backlog grows.")
+    parser.add_argument("-c", "--csv_file",
+                        help="Path to the CSV file containing subject-session "
+                             "pairs.")
+    parser.add_argument("-w", "--work_queue",
+                        help="Claim pairs from this SQLite work queue (see "
+                             "work_queue.py) instead of --csv_file.")
+    parser.add_argument("-d", "--csv_dir", default=runner.DEFAULT_CSV_DIR,
+                        help="Path to save created CSV files.")
+    parser.add_argument("-r", "--rawdata_dir",
+                        default=runner.DEFAULT_RAWDATA_DIR,
+                        help="Path to the BIDS dataset root directory.")
+    parser.add_argument("-o", "--mriqc_outdir_root",
+                        default=runner.DEFAULT_MRIQC_OUTDIR_ROOT,
+                        help="Path to save MRIQC outputs.")
+    parser.add_argument("-l", "--logs_root_dir",
+                        default=runner.DEFAULT_LOGS_ROOT_DIR,
+                        help="Root directory for logs.")
+    parser.add_argument("-R", "--rerun_csv", default=runner.DEFAULT_RERUN_CSV,
+                        help="Path to the CSV file for tracking rerun cases.")
+    parser.add_argument("-A", "--array", action="store_true",
+                        help="Submit each top-up as one LSF job array.")
+    parser.add_argument("-K", "--slot_limit", type=int,
+                        help="With --array, maximum number of array "
+                             "elements running at once.")
+    parser.add_argument("-g", "--registry", default=DEFAULT_REGISTRY,
+                        help="Path to the SQLite job registry.")
+    parser.add_argument("-s", "--state_file", default=DEFAULT_STATE_FILE,
+                        help="Path to the JSON file the window is kept in "
+                             "between cycles.")
+    parser.add_argument("-T", "--target", type=int, default=DEFAULT_TARGET,
+                        help="Maximum number of jobs pending or running.")
+    parser.add_argument("-m", "--min_target", type=int,
+                        default=DEFAULT_MIN_TARGET,
+                        help="Window size the backoff never goes below.")
+    parser.add_argument("-i", "--increase", type=float,
+                        default=DEFAULT_INCREASE,
+                        help="Jobs added to the window after each cycle "
+                             "without backlog growth.")
+    parser.add_argument("-b", "--backoff", type=float,
+                        default=DEFAULT_BACKOFF,
+                        help="Factor the window is multiplied by when the "
+                             "backlog grows.")
+    parser.add_argument("-p", "--pending_growth", type=int,
+                        default=DEFAULT_PENDING_GROWTH,
+                        help="Growth in other users' pending jobs between "
+                             "cycles that triggers a backoff.")
+    parser.add_argument("-q", "--queue",
+                        default=runner.DEFAULT_RESOURCES['queue'],
+                        help="LSF queue whose pending count is watched.")
+    parser.add_argument("-I", "--interval", type=int,
+                        default=DEFAULT_INTERVAL,
+                        help="Seconds between cycles.")
+    parser.add_argument("-P", "--predict_resources", action="store_true",
+                        help="Size each job from its NIfTI headers.")
+    parser.add_argument("-S", "--stage", action="store_true",
+                        help="Have jobs run MRIQC in node-local scratch.")
+    parser.add_argument("-k", "--pack_minutes", type=float,
+                        help="Pack small sessions into shared jobs of about "
+                             "this many estimated minutes.")
+    parser.add_argument("--once", action="store_true",
+                        help="Run a single cycle and exit (e.g. from cron).")
+    parser.add_argument("--skip_poll", action="store_true",
+                        help="With --once, do not poll bjobs first because "
+                             "the registry was just refreshed.")
+    args = parser.parse_args()
+    if args.array and args.pack_minutes:
+        parser.error("--array and --pack_minutes cannot be combined")
+    if not args.csv_file and not args.work_queue:
+        parser.error("one of --csv_file and --work_queue is required")
+
+    submit_kwargs = dict(
+        csv_dir=args.csv_dir, rawdata_dir=args.rawdata_dir,
+        mriqc_outdir_root=args.mriqc_outdir_root,
+        logs_root_dir=args.logs_root_dir, rerun_csv=args.rerun_csv,
+        array=args.array, slot_limit=args.slot_limit,
+        registry_path=args.registry, predict=args.predict_resources,
+        stage=args.stage, pack_minutes=args.pack_minutes,
+        work_queue_path=args.work_queue)
+    conn = open_registry(args.registry)
+    state = load_state(args.state_file, args.target)
+    while True:
+        submitted = run_cycle(conn, state, args.csv_file, submit_kwargs,
+                              args.target, args.min_target, args.increase,
+                              args.backoff, args.pending_growth, args.queue,
+                              args.skip_poll and args.once)
+        save_state(args.state_file, state)
+        print(f"Submitted {submitted} jobs (window {state['window']:.1f})")
+        if args.once:
+            break
+        time.sleep(args.interval)
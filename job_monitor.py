@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import time
+import signal
+import asyncio
+import subprocess
+import threading
+import argparse
+from pathlib import Path
+
+PROGRESS_DIR_NAME = 'mriqc_progress'
+DEFAULT_STALE_MINUTES = 60
+# Output is read in chunks and split into lines here, so lines of any length
+# pass through; lines longer than MAX_LINE_BYTES are echoed in pieces and not
+# parsed
+CHUNK_BYTES = 64 * 1024
+MAX_LINE_BYTES = 1024 * 1024
+# Seconds a command gets to exit after SIGTERM before it is killed
+TERM_GRACE_SECONDS = 30
+
+# nipype workflow log lines, e.g.
+#   [Node] Setting-up "mriqc_wf.anatMRIQCwf.SpatialNormalization" in "/work/..."
+#   [Node] Finished "SpatialNormalization", elapsed time 612.3s.
+#   [Node] Error on "mriqc_wf.funcMRIQCwf.fMRI_HMC" (/work/...)
+NODE_RE = re.compile(r'\[Node\] '
+                     r'(Setting-up|Running|Finished|Cached|Error on) '
+                     r'"([^"]+)"(?:.*?elapsed time ([\d.]+)s)?')
+FAILED_RE = re.compile(r'Node (\S+) failed to run on host (\S+)')
+CRASH_RE = re.compile(r'Saving crash info to (\S+)')
+NODE_EVENTS = {'Setting-up': 'setup', 'Running': 'start', 'Finished': 'finish',
+               'Cached': 'cached', 'Error on': 'error'}
+
+
+def progress_file(temp_dir, subject_id, session_id):
+    """Return the progress file of a session run under ``temp_dir``."""
+    return Path(temp_dir, PROGRESS_DIR_NAME,
+                f'{subject_id}_{session_id}.jsonl')
+
+
+def parse_line(line):
+    """
+    Turn one line of MRIQC output into a progress event.
+
+    Returns
+    -------
+    dict or None
+        ``{'event': ..., 'node': ...}`` plus ``elapsed`` (seconds) for
+        finished nodes, or ``host``/``crash_file`` for failures; None for
+        lines that are not about nodes.
+    """
+    match = NODE_RE.search(line)
+    if match:
+        event = {'event': NODE_EVENTS[match.group(1)], 'node': match.group(2)}
+        if match.group(3):
+            event['elapsed'] = float(match.group(3))
+        return event
+    match = FAILED_RE.search(line)
+    if match:
+        return {'event': 'failed', 'node': match.group(1),
+                'host': match.group(2).rstrip('.')}
+    match = CRASH_RE.search(line)
+    if match:
+        return {'event': 'crash', 'crash_file': match.group(1)}
+    return None
+
+
+class ProgressLog:
+    """
+    Append progress events to a JSONL file, one flushed line per event.
+
+    Node start times are kept so that finished nodes get an elapsed time
+    even when nipype does not print one. Nodes are tracked by their last
+    name component, as nipype only prints the full name on set-up.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fp = open(str(self.path), 'a')
+        self.started = {}
+
+    def record(self, event, stream='stdout'):
+        now = time.time()
+        node = event.get('node', '').split('.')[-1]
+        if event['event'] in ('setup', 'start'):
+            self.started.setdefault(node, now)
+        elif node in self.started and event['event'] in ('finish', 'cached',
+                                                          'error', 'failed'):
+            started = self.started.pop(node)
+            event.setdefault('elapsed', round(now - started, 1))
+        event = dict(event, time=round(now, 3), stream=stream)
+        self.fp.write(json.dumps(event) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def _emit(line, name, echo, progress, parse=True):
+    text = line.decode(errors='replace')
+    print(text, end='', file=echo, flush=True)
+    event = parse_line(text) if parse else None
+    if event is not None:
+        progress.record(event, name)
+
+
+async def _pump(stream, name, echo, progress):
+    pending = b''
+    while True:
+        chunk = await stream.read(CHUNK_BYTES)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            _emit(line + b'\n', name, echo, progress)
+        if len(pending) > MAX_LINE_BYTES:
+            _emit(pending, name, echo, progress, parse=False)
+            pending = b''
+    if pending:
+        _emit(pending, name, echo, progress)
+
+
+async def _run(command, progress, started):
+    # In a session of its own, so the whole command (shell, container and
+    # what it starts) can be stopped as one process group
+    process = await asyncio.create_subprocess_shell(
+        command, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    started.append(process)
+    await asyncio.gather(_pump(process.stdout, 'stdout', sys.stdout, progress),
+                         _pump(process.stderr, 'stderr', sys.stderr, progress))
+    return await process.wait()
+
+
+async def _stop(process):
+    """Terminate a command's process group, killing it if it lingers."""
+    for sig, timeout in ((signal.SIGTERM, TERM_GRACE_SECONDS),
+                         (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            return await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            continue
+
+
+def stop_process_groups(processes, grace=TERM_GRACE_SECONDS):
+    """
+    Terminate the process groups of ``subprocess.Popen`` commands started
+    with ``start_new_session``, killing those still up after ``grace``
+    seconds, as ``_stop`` does for the monitored command.
+    """
+    for sig, timeout in ((signal.SIGTERM, grace), (signal.SIGKILL, None)):
+        for process in processes:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, sig)
+                except ProcessLookupError:
+                    pass
+        deadline = None if timeout is None else time.time() + timeout
+        for process in processes:
+            try:
+                process.wait(None if deadline is None
+                             else max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                pass
+        if all(process.returncode is not None for process in processes):
+            return
+
+
+def _all_tasks(loop):
+    # asyncio.all_tasks is 3.7+, Task.all_tasks was removed in 3.9
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    return [task for task in all_tasks(loop) if not task.done()]
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def run_monitored(command, progress_path):
+    """
+    Run a shell command, echoing its stdout and stderr as they come and
+    logging nipype node events to ``progress_path``.
+
+    Both streams are read at the same time, so a chatty stderr cannot stall
+    the command. The run is bracketed by 'begin' and 'end' events, the
+    latter holding the exit code. If monitoring fails or is interrupted
+    (including by SIGTERM, e.g. from bkill), the command's process group is
+    stopped and waited for before the error is raised again.
+
+    Returns
+    -------
+    int
+        The command's exit code.
+    """
+    progress = ProgressLog(progress_path)
+    progress.record({'event': 'begin'})
+    # A loop of our own rather than asyncio.run, which Python 3.6 lacks
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    main_thread = threading.current_thread() is threading.main_thread()
+    if main_thread:
+        previous_handler = signal.signal(signal.SIGTERM, _raise_exit)
+    started = []
+    returncode = None
+    try:
+        returncode = loop.run_until_complete(_run(command, progress, started))
+    finally:
+        try:
+            if started and started[0].returncode is None:
+                returncode = loop.run_until_complete(_stop(started[0]))
+            pending = _all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            if main_thread:
+                signal.signal(signal.SIGTERM, previous_handler)
+            loop.close()
+            asyncio.set_event_loop(None)
+            progress.record({'event': 'end', 'returncode': returncode})
+            progress.close()
+    return returncode
+
+
+def summarize_progress(path, now=None):
+    """
+    Summarize a progress file.
+
+    Returns
+    -------
+    dict
+        ``finished`` node count, ``running`` {node: seconds since start},
+        ``failed`` node names, ``last_event`` time, ``returncode`` (None
+        while the run is going) and ``ended``.
+    """
+    now = time.time() if now is None else now
+    summary = {'finished': 0, 'running': {}, 'failed': [], 'last_event': None,
+               'returncode': None, 'ended': False}
+    with open(str(path)) as fp:
+        for line in fp:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            summary['last_event'] = event['time']
+            node = event.get('node', '').split('.')[-1]
+            if event['event'] == 'begin':
+                summary.update(running={}, ended=False, returncode=None)
+            elif event['event'] in ('setup', 'start'):
+                summary['running'].setdefault(node, event['time'])
+            elif event['event'] in ('finish', 'cached'):
+                summary['running'].pop(node, None)
+                summary['finished'] += 1
+            elif event['event'] in ('error', 'failed'):
+                summary['running'].pop(node, None)
+                if node not in summary['failed']:
+                    summary['failed'].append(node)
+            elif event['event'] == 'end':
+                summary['ended'] = True
+                summary['returncode'] = event.get('returncode')
+    summary['running'] = {node: now - started for node, started
+                          in summary['running'].items()}
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show the progress of MRIQC runs from their progress "
+                    "files, flagging runs that have gone quiet.")
+    parser.add_argument("paths", nargs='+',
+                        help="Progress files, or directories of them (e.g. "
+                             f"<temp_dir>/{PROGRESS_DIR_NAME}).")
+    parser.add_argument("-m", "--stale_minutes", type=float,
+                        default=DEFAULT_STALE_MINUTES,
+                        help="Flag running sessions with no event for this "
+                             "long.")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="Also list runs that have ended.")
+    args = parser.parse_args()
+
+    files = []
+    for path in map(Path, args.paths):
+        files.extend(sorted(path.glob('*.jsonl')) if path.is_dir() else [path])
+    now = time.time()
+    for path in files:
+        summary = summarize_progress(path, now)
+        if summary['ended'] and not args.all:
+            continue
+        quiet = (now - summary['last_event']) / 60 \
+            if summary['last_event'] else 0
+        if summary['ended']:
+            state = f"ended ({summary['returncode']})"
+        elif quiet > args.stale_minutes:
+            state = f"STALE, quiet for {quiet:.0f} min"
+        else:
+            state = 'running'
+        print(f"{path.stem}: {state}, {summary['finished']} nodes finished"
+              + (f", failed: {' '.join(summary['failed'])}"
+                 if summary['failed'] else ''))
+        for node, seconds in sorted(summary['running'].items(),
+                                    key=lambda item: -item[1]):
+            print(f"    {node}: "
+                  + ('never finished' if summary['ended']
+                     else f"running for {seconds / 60:.0f} min"))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import re
+import json
+import time
+import sqlite3
+import argparse
+import subprocess
+
+from lsf import lsf_command
+
+DEFAULT_REGISTRY = '/data/predict1/home/rez3/bin/code/mriqc_pipeline' \
+                   '/mriqc_jobs.sqlite'
+
+# LSF states of jobs that have not finished yet; 'SUBMITTED' is ours, for
+# jobs bjobs has not reported on so far
+ACTIVE_STATES = ('SUBMITTED', 'PEND', 'RUN', 'PSUSP', 'USUSP', 'SSUSP',
+                 'WAIT', 'PROV')
+# Active jobs bjobs no longer knows about (e.g. past CLEAN_PERIOD)
+MISSING_STATE = 'MISSING'
+BJOBS_FIELDS = ['jobid', 'jobindex', 'stat', 'exit_code', 'exec_host',
+                'submit_time', 'start_time', 'finish_time']
+BJOBS_DELIMITER = '|'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    submit_time REAL NOT NULL,
+    resources TEXT,
+    state TEXT NOT NULL DEFAULT 'SUBMITTED',
+    exit_code INTEGER,
+    exec_host TEXT,
+    start_time TEXT,
+    finish_time TEXT,
+    updated_time REAL,
+    PRIMARY KEY (job_id, subject, session)
+);
+CREATE INDEX IF NOT EXISTS jobs_subject ON jobs (subject, session);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_submit_time ON jobs (submit_time);
+"""
+
+
+def _migrate_job_key(conn):
+    """
+    Rebuild registries keyed on job_id alone, from before a job could run a
+    pack of several sessions.
+    """
+    key = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")
+           if row['pk']]
+    if key != ['job_id']:
+        return
+    with conn:
+        for index in ('jobs_subject', 'jobs_state', 'jobs_submit_time'):
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        conn.execute("ALTER TABLE jobs RENAME TO jobs_old")
+    conn.executescript(SCHEMA)
+    with conn:
+        conn.execute("INSERT INTO jobs SELECT * FROM jobs_old")
+        conn.execute("DROP TABLE jobs_old")
+
+
+def open_registry(registry_path=DEFAULT_REGISTRY):
+    """
+    Open (and create if needed) the job registry.
+
+    The database runs in WAL mode so the poller, submitters and readers can
+    use it at the same time. A job running a pack of sessions has a row per
+    session, all with the same job ID.
+    """
+    conn = sqlite3.connect(str(registry_path), timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    _migrate_job_key(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_submission(conn, job_id, subject_id, session_id, resources=None,
+                      submit_time=None):
+    """Record a submitted job (``job_id`` may be an array element 'N[i]')."""
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, subject, session, "
+            "submit_time, resources, updated_time) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(job_id), subject_id, session_id,
+             time.time() if submit_time is None else submit_time,
+             None if resources is None else json.dumps(resources),
+             time.time()))
+
+
+def query_bjobs():
+    """
+    Fetch the state of all of our recent jobs with a single bjobs call.
+
+    Uses ``bjobs -o`` with a delimiter rather than ``-json``, which the
+    cluster's LSF 9.1 does not have.
+
+    Returns
+    -------
+    dict
+        Job ID ('N' or 'N[i]' for array elements) -> {FIELD: value}, with
+        empty fields as ''.
+    """
+    result = subprocess.run(
+        [lsf_command('bjobs'), '-a', '-noheader', '-o',
+         ' '.join(BJOBS_FIELDS) + f" delimiter='{BJOBS_DELIMITER}'"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode != 0 and result.stdout.strip() == '' \
+            and 'No ' not in result.stderr:
+        raise subprocess.CalledProcessError(result.returncode, result.args,
+                                            result.stdout, result.stderr)
+    records = {}
+    for line in result.stdout.splitlines():
+        values = line.split(BJOBS_DELIMITER)
+        if len(values) != len(BJOBS_FIELDS):
+            continue
+        record = {field.upper(): '' if value.strip() == '-' else value.strip()
+                  for field, value in zip(BJOBS_FIELDS, values)}
+        job_id = record['JOBID']
+        if record['JOBINDEX'] not in ('', '0'):
+            job_id = f"{job_id}[{record['JOBINDEX']}]"
+        records[job_id] = record
+    return records
+
+
+def _exit_code(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_registry(conn, records):
+    """
+    Update every registered job from one set of bjobs records.
+
+    Jobs still active in the registry that bjobs no longer reports are marked
+    ``MISSING_STATE``.
+
+    Returns
+    -------
+    int
+        Number of jobs updated.
+    """
+    now = time.time()
+    updated = 0
+    with conn:
+        for job_id, record in records.items():
+            stat = record.get('STAT') or None
+            exit_code = _exit_code(record.get('EXIT_CODE'))
+            if stat == 'DONE' and exit_code is None:
+                exit_code = 0
+            updated += conn.execute(
+                "UPDATE jobs SET state = ?, exit_code = ?, exec_host = ?, "
+                "start_time = ?, finish_time = ?, updated_time = ? "
+                "WHERE job_id = ?",
+                (stat, exit_code, record.get('EXEC_HOST') or None,
+                 record.get('START_TIME') or None,
+                 record.get('FINISH_TIME') or None, now, job_id)).rowcount
+        placeholders = ', '.join('?' * len(ACTIVE_STATES))
+        for row in conn.execute(
+                f"SELECT DISTINCT job_id FROM jobs "
+                f"WHERE state IN ({placeholders})",
+                ACTIVE_STATES).fetchall():
+            if row['job_id'] not in records:
+                updated += conn.execute(
+                    "UPDATE jobs SET state = ?, updated_time = ? "
+                    "WHERE job_id = ?",
+                    (MISSING_STATE, now, row['job_id'])).rowcount
+    return updated
+
+
+def poll(conn):
+    """Refresh the registry with one bjobs call; returns the rows updated."""
+    return update_registry(conn, query_bjobs())
+
+
+def import_submission_log(conn, log_file):
+    """
+    Register the jobs of an existing mriqc_job_submission.log in one pass.
+
+    Jobs already in the registry are left alone.
+
+    Returns
+    -------
+    int
+        Number of jobs added.
+    """
+    pattern = re.compile(r'^(\S+ \S+) - Submitted (\S+) (\S+) with job ID '
+                         r'(\d+(?:\[\d+\])?)$')
+    added = 0
+    with open(log_file) as file, conn:
+        for line in file:
+            match = pattern.match(line.strip())
+            if not match:
+                continue
+            logged_at, subject_id, session_id, job_id = match.groups()
+            submit_time = time.mktime(time.strptime(
+                logged_at.split(',')[0], '%Y-%m-%d %H:%M:%S'))
+            added += conn.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, subject, session, "
+                "submit_time, updated_time) VALUES (?, ?, ?, ?, ?)",
+                (job_id, subject_id, session_id, submit_time,
+                 time.time())).rowcount
+    return added
+
+
+def jobs_for_subject(conn, subject_id, session_id=None):
+    """Return the jobs of a subject (and session), newest first."""
+    if session_id is None:
+        return conn.execute(
+            "SELECT * FROM jobs WHERE subject = ? ORDER BY submit_time DESC",
+            (subject_id,)).fetchall()
+    return conn.execute(
+        "SELECT * FROM jobs WHERE subject = ? AND session = ? "
+        "ORDER BY submit_time DESC", (subject_id, session_id)).fetchall()
+
+
+def jobs_in_state(conn, *states):
+    """Return the jobs in any of ``states``, oldest first."""
+    placeholders = ', '.join('?' * len(states))
+    return conn.execute(
+        f"SELECT * FROM jobs WHERE state IN ({placeholders}) "
+        "ORDER BY submit_time", states).fetchall()
+
+
+def jobs_older_than(conn, seconds, states=None):
+    """Return jobs submitted more than ``seconds`` ago, optionally by state."""
+    cutoff = time.time() - seconds
+    if not states:
+        return conn.execute(
+            "SELECT * FROM jobs WHERE submit_time < ? ORDER BY submit_time",
+            (cutoff,)).fetchall()
+    placeholders = ', '.join('?' * len(states))
+    return conn.execute(
+        f"SELECT * FROM jobs WHERE submit_time < ? "
+        f"AND state IN ({placeholders}) ORDER BY submit_time",
+        (cutoff,) + tuple(states)).fetchall()
+
+
+def active_subjects(conn):
+    """Return the subjects that have a pending or running job."""
+    return sorted({row['subject'] for row in
+                   jobs_in_state(conn, *ACTIVE_STATES)})
+
+
+def _print_jobs(rows):
+    for row in rows:
+        submitted = time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(row['submit_time']))
+        print(f"{row['job_id']}\t{row['subject']}\t{row['session']}\t"
+              f"{row['state']}\t{row['exit_code']}\t{submitted}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Registry of submitted MRIQC jobs, refreshed with one "
+                    "bjobs call per poll.")
+    parser.add_argument("-g", "--registry", default=DEFAULT_REGISTRY,
+                        help="Path to the SQLite job registry.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("poll", help="Update all jobs from bjobs.")
+    import_parser = subparsers.add_parser(
+        "import-log", help="Register the jobs of a submission log.")
+    import_parser.add_argument("log_file",
+                               help="Path to mriqc_job_submission.log.")
+    subparsers.add_parser("active-subjects",
+                          help="Print subjects with pending or running jobs.")
+    query_parser = subparsers.add_parser("query", help="List jobs.")
+    query_parser.add_argument("-s", "--subject", help="Subject ID.")
+    query_parser.add_argument("-e", "--session", help="Session ID.")
+    query_parser.add_argument("-t", "--state", nargs='+',
+                              help="LSF state(s), e.g. PEND RUN EXIT.")
+    query_parser.add_argument("-a", "--older_than_hours", type=float,
+                              help="Only jobs submitted before this many "
+                                   "hours ago.")
+    args = parser.parse_args()
+
+    conn = open_registry(args.registry)
+    if args.command == "poll":
+        print(f"Updated {poll(conn)} jobs")
+    elif args.command == "import-log":
+        print(f"Registered {import_submission_log(conn, args.log_file)} jobs")
+    elif args.command == "active-subjects":
+        for subject in active_subjects(conn):
+            print(subject)
+    elif args.command == "query":
+        if args.subject:
+            rows = jobs_for_subject(conn, args.subject, args.session)
+        elif args.older_than_hours is not None:
+            rows = jobs_older_than(conn, args.older_than_hours * 3600,
+                                   args.state)
+        elif args.state:
+            rows = jobs_in_state(conn, *args.state)
+        else:
+            rows = jobs_older_than(conn, 0)
+        if args.state and args.subject:
+            rows = [row for row in rows if row['state'] in args.state]
+        _print_jobs(rows)
+    else:
+        parser.print_help()
+    conn.close()
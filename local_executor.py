@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+from job_monitor import stop_process_groups
+from resource_predictor import predict_session_resources, mriqc_mem_gb
+
+MRIQC_SCRIPT = Path(__file__).resolve().parent / 'mriqc.py'
+DEFAULT_LOGS_ROOT_DIR = '/data/predict1/home/rez3/bin/logs'
+# Part of the node kept free for the system and the executor itself
+MEM_RESERVE_GB = 2
+POLL_SECONDS = 2
+
+# Trailer lines LSF appends to its job reports; get_status only counts a
+# session as finished once both of its .out and .err files exist
+LSF_DONE = 'Successfully completed.'
+LSF_EXITED = 'Exited with exit code {}.'
+
+
+def available_cores():
+    """Return the number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_mem_gb():
+    """Return the node's available memory in GB, from /proc/meminfo."""
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024 ** 2
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') \
+        // 1024 ** 3
+
+
+def lsf_exit_code(returncode):
+    """Map a Popen return code to LSF's convention: 128 + N for signal N."""
+    return 128 - returncode if returncode < 0 else returncode
+
+
+def make_tasks(pairs, rawdata_dir, nprocs, mem_gb, predict=False):
+    """
+    Return one task per subject-session pair, with the cores and memory
+    MRIQC will be given: ``nprocs`` and ``mem_gb``, or, with ``predict``,
+    the sizes resource_predictor.py predicts for the session.
+    """
+    tasks = []
+    for subject_id, session_id in pairs:
+        if predict:
+            resources = predict_session_resources(rawdata_dir, subject_id,
+                                                  session_id)
+            cores, mem = resources['cores'], mriqc_mem_gb(resources)
+        else:
+            cores, mem = nprocs, mem_gb
+        tasks.append({'subject': subject_id, 'session': session_id,
+                      'nprocs': cores, 'mem_gb': mem})
+    return tasks
+
+
+def _start_task(task, rawdata_dir, mriqc_outdir_root, temp_dir, logs_root_dir,
+                stage):
+    """
+    Start mriqc.py for one task, its output going to a pair of log files.
+
+    They are written as ``.out.part``/``.err.part`` and renamed when the
+    session finishes, as LSF only writes its report once a job ends.
+    """
+    logs_dir = Path(logs_root_dir, task['subject'], task['session'])
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    stem = logs_dir / f"local_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+    command = [sys.executable, str(MRIQC_SCRIPT), str(rawdata_dir),
+               task['subject'], task['session'], str(mriqc_outdir_root),
+               '--temp_dir', str(temp_dir),
+               '--nprocs', str(task['nprocs']),
+               '--mem_gb', str(task['mem_gb'])]
+    if stage:
+        command.append('--stage')
+    out_path, err_path = Path(f'{stem}.out.part'), Path(f'{stem}.err.part')
+    with open(out_path, 'w') as out, open(err_path, 'w') as err:
+        process = subprocess.Popen(command, stdout=out, stderr=err,
+                                   env=dict(os.environ, PYTHONUNBUFFERED='1'),
+                                   start_new_session=True)
+    return process, out_path, err_path
+
+
+def _finish_task(task, returncode, out_path, err_path, start_time):
+    """Append an LSF-style trailer to the logs and move them into place."""
+    exit_code = lsf_exit_code(returncode)
+    with open(out_path, 'a') as out:
+        out.write('\n------------------------------------------------------'
+                  '------\n')
+        out.write(f"Job <mriqc_{task['subject']}_{task['session']}> "
+                  f"ran locally on {os.uname()[1]} with {task['nprocs']} "
+                  f"cores and {task['mem_gb']} GB in "
+                  f"{time.time() - start_time:.0f} seconds.\n")
+        out.write((LSF_DONE if exit_code == 0
+                   else LSF_EXITED.format(exit_code)) + '\n')
+    # .err first, so the pair is complete as soon as the .out appears
+    os.replace(err_path, str(err_path)[:-len('.part')])
+    os.replace(out_path, str(out_path)[:-len('.part')])
+    return exit_code
+
+
+def run_local(tasks, rawdata_dir, mriqc_outdir_root, temp_dir,
+              logs_root_dir=DEFAULT_LOGS_ROOT_DIR, max_cores=None,
+              max_mem_gb=None, stage=False, poll_seconds=POLL_SECONDS):
+    """
+    Run MRIQC on several sessions at once within a core and memory budget.
+
+    Tasks are started in order whenever their ``nprocs`` and ``mem_gb`` fit
+    in what running tasks leave free; a task that does not fit is passed
+    over for later, smaller ones. A task larger than the whole budget runs
+    alone, shrunk to the budget. Each session runs mriqc.py in its own
+    process, which keeps the work-dir markers and exit codes of the LSF
+    path.
+
+    Parameters
+    ----------
+    tasks : list of dict
+        Tasks as returned by ``make_tasks``.
+    rawdata_dir, mriqc_outdir_root, temp_dir : str
+        As for run_mriqc.py.
+    logs_root_dir : str
+        Root of the ``<subject>/<session>/`` log directories.
+    max_cores : int, optional
+        Cores to use; all cores available to this process by default.
+    max_mem_gb : int, optional
+        Memory to use; the available memory less ``MEM_RESERVE_GB`` by
+        default.
+    stage : bool
+        Run each session in node-local scratch (see scratch_staging.py).
+
+    Returns
+    -------
+    list of int
+        LSF-style exit codes, in the order of ``tasks``.
+    """
+    max_cores = max_cores or available_cores()
+    max_mem_gb = max_mem_gb or max(1, available_mem_gb() - MEM_RESERVE_GB)
+    print(f"Running {len(tasks)} sessions locally on {max_cores} cores "
+          f"and {max_mem_gb} GB")
+    pending = list(enumerate(tasks))
+    running = {}
+    exit_codes = [None] * len(tasks)
+    free_cores, free_mem = max_cores, max_mem_gb
+    try:
+        while pending or running:
+            for item in list(pending):
+                index, task = item
+                if not running:
+                    task = dict(task, nprocs=min(task['nprocs'], max_cores),
+                                mem_gb=min(task['mem_gb'], max_mem_gb))
+                elif task['nprocs'] > free_cores or \
+                        task['mem_gb'] > free_mem:
+                    continue
+                pending.remove(item)
+                process, out_path, err_path = _start_task(
+                    task, rawdata_dir, mriqc_outdir_root, temp_dir,
+                    logs_root_dir, stage)
+                running[index] = (task, process, out_path, err_path,
+                                  time.time())
+                free_cores -= task['nprocs']
+                free_mem -= task['mem_gb']
+                print(f"Started {task['subject']} {task['session']} "
+                      f"({task['nprocs']} cores, {task['mem_gb']} GB)")
+            time.sleep(poll_seconds)
+            for index in list(running):
+                task, process, out_path, err_path, start_time = \
+                    running[index]
+                if process.poll() is None:
+                    continue
+                del running[index]
+                exit_codes[index] = _finish_task(
+                    task, process.returncode, out_path, err_path, start_time)
+                free_cores += task['nprocs']
+                free_mem += task['mem_gb']
+                print(f"Finished {task['subject']} {task['session']} with "
+                      f"exit code {exit_codes[index]}")
+    finally:
+        # Children run in their own sessions, so take their singularity
+        # processes down with them if we are interrupted
+        stop_process_groups([process for _, process, _, _, _ in
+                             running.values()])
+        for task, process, out_path, err_path, start_time in \
+                running.values():
+            _finish_task(task, process.returncode, out_path, err_path,
+                         start_time)
+    return exit_codes
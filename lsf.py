@@ -0,0 +1,10 @@
+# lsf.py
+import os
+import shutil
+
+LSF_BIN_DIR = '/usr/share/lsf/9.1/linux2.6-glibc2.3-x86_64/bin'
+
+
+def lsf_command(name):
+    """Resolve an LSF command (bsub, bjobs, ...) on PATH, else in LSF_BIN_DIR."""
+    return shutil.which(name) or os.path.join(LSF_BIN_DIR, name)
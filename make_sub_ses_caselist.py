@@ -3,26 +3,42 @@ import csv
 import argparse
 from pathlib import Path
 
+from manifest import is_manifest, read_entry_rows
 
-def parse_csv_for_unique_pairs(input_csv_file, output_csv_file):
-    unique_pairs = set()
-    with open(input_csv_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            unique_pairs.add((row['Subject'], row['Session']))
 
+def unique_pairs_from_rows(rows):
+    """Return the sorted unique (Subject, Session) pairs of entry rows."""
+    return sorted({(row[0], row[1]) for row in rows})
+
+
+def write_pairs(pairs, output_csv_file):
     with open(output_csv_file, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['Subject', 'Session'])  # Write header
-        for pair in sorted(unique_pairs):
+        for pair in pairs:
             writer.writerow(pair)
 
 
+def parse_csv_for_unique_pairs(input_csv_file, output_csv_file):
+    if is_manifest(input_csv_file):
+        unique_pairs = set(unique_pairs_from_rows(
+            read_entry_rows(input_csv_file)))
+    else:
+        unique_pairs = set()
+        with open(input_csv_file, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                unique_pairs.add((row['Subject'], row['Session']))
+
+    write_pairs(sorted(unique_pairs), output_csv_file)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Generate a CSV file with unique subject-session pairs for MRIQC.")
     parser.add_argument("-i", "--input_csv",
-                        help="Path to the input CSV file containing the missing cases.")
+                        help="Path to the input CSV file (or .npz manifest) "
+                             "containing the missing cases.")
     parser.add_argument("-o", "--output_csv",
                         help="Path to the output CSV file to store unique subject-session pairs.")
 
@@ -0,0 +1,173 @@
+# manifest.py
+import csv
+
+import numpy as np
+
+from txt_to_csv import parse_line_to_csv_format
+
+# Columns of a file manifest; 'Root' holds the directory above sub-*, and
+# Root/Subject/Session/Folder/File + Extension rebuilds the original path.
+MANIFEST_COLUMNS = ['Root', 'Subject', 'Session', 'Folder', 'File',
+                    'Extension']
+ENTRY_COLUMNS = ['Subject', 'Session', 'Folder', 'File']
+EXTENSIONS = ('.nii.gz', '.json')
+
+
+def is_manifest(path):
+    """Return True if ``path`` names a compact (.npz) manifest."""
+    return str(path).endswith('.npz')
+
+
+def _encode(values):
+    """Dictionary-encode a sequence of strings into (codes, categories)."""
+    categories, codes = np.unique(np.asarray(values, dtype=str),
+                                  return_inverse=True)
+    dtype = np.uint16 if len(categories) <= np.iinfo(np.uint16).max \
+        else np.uint32
+    return codes.astype(dtype), categories
+
+
+def write_table(path, columns):
+    """
+    Write a columnar table to an .npz file.
+
+    String columns are dictionary-encoded into integer codes plus one array
+    of unique values, so repeated subject, session and folder strings are
+    stored once. Numeric columns are stored as they are.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output .npz file.
+    columns : dict
+        Column name -> sequence of values, all of the same length. Column
+        order is preserved.
+    """
+    arrays = {'__columns__': np.asarray(list(columns), dtype=str)}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.dtype.kind in 'biuf':
+            arrays[name] = values
+        else:
+            arrays[name + '.codes'], arrays[name + '.values'] = \
+                _encode(values)
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, **arrays)
+
+
+def read_table(path, decode=True):
+    """
+    Read a table written by ``write_table``.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .npz file.
+    decode : bool
+        If True, string columns are returned as string arrays. Otherwise they
+        are returned as (codes, categories) tuples, which is enough for joins
+        and group-bys and skips materializing every string.
+
+    Returns
+    -------
+    dict
+        Column name -> array (or (codes, categories) when not decoding), in
+        the order they were written.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        table = {}
+        for name in data['__columns__']:
+            name = str(name)
+            if name in data.files:
+                table[name] = data[name]
+            else:
+                codes, categories = data[name + '.codes'], \
+                    data[name + '.values']
+                table[name] = categories[codes] if decode \
+                    else (codes, categories)
+    return table
+
+
+def _split_extension(file_name):
+    for extension in EXTENSIONS:
+        if file_name.endswith(extension):
+            return extension
+    return ''
+
+
+def write_manifest(path, file_paths):
+    """
+    Write file paths as a compact manifest.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output .npz file.
+    file_paths : iterable of str
+        Paths laid out as ``<root>/sub-*/ses-*/<folder>/<file>``; other
+        paths are skipped.
+
+    Returns
+    -------
+    int
+        Number of paths written.
+    """
+    columns = {name: [] for name in MANIFEST_COLUMNS}
+    for file_path in file_paths:
+        file_path = file_path.strip()
+        row = parse_line_to_csv_format(file_path)
+        if row is None:
+            continue
+        subject, session, folder, file_name = row
+        columns['Root'].append(file_path.rsplit('/', 4)[0])
+        columns['Subject'].append(subject)
+        columns['Session'].append(session)
+        columns['Folder'].append(folder)
+        columns['File'].append(file_name)
+        columns['Extension'].append(
+            _split_extension(file_path.rsplit('/', 1)[-1]))
+    write_table(path, columns)
+    return len(columns['File'])
+
+
+def manifest_paths(path):
+    """Rebuild the full file paths stored in a manifest."""
+    table = read_table(path)
+    for root, subject, session, folder, file_name, extension in zip(
+            *(table[name] for name in MANIFEST_COLUMNS)):
+        yield f"{root}/{subject}/{session}/{folder}/{file_name}{extension}"
+
+
+def read_entry_rows(path):
+    """
+    Yield [Subject, Session, Folder, File] rows from a CSV or a manifest.
+
+    Parameters
+    ----------
+    path : str
+        Path to a CSV with a header row, or to an .npz manifest.
+    """
+    if is_manifest(path):
+        table = read_table(path)
+        for row in zip(*(table[name] for name in ENTRY_COLUMNS)):
+            yield [str(value) for value in row]
+        return
+    with open(path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header
+        for row in reader:
+            yield row
+
+
+def write_entry_rows(path, rows):
+    """Write [Subject, Session, Folder, File] rows to a CSV or a manifest."""
+    if is_manifest(path):
+        rows = list(rows)
+        write_table(path, {name: [row[i] for row in rows]
+                           for i, name in enumerate(ENTRY_COLUMNS)})
+        return
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(ENTRY_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
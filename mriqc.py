@@ -3,8 +3,15 @@ import argparse
 from pathlib import Path
 from subprocess import Popen, PIPE
 import re
-import json
 import os
+import shutil
+import hashlib
+
+from sanitize_sidecars import sanitize_sidecar
+from workdir_manager import RUNNING, DONE, FAILED, mark_workdir
+from job_monitor import progress_file, run_monitored
+from scratch_staging import (has_scratch_space, stage_inputs, stage_sessions,
+                             sync_outputs, scratch_base)
 
 
 def remove_DataSetTrailingPadding_from_json_files(
@@ -17,33 +24,61 @@ def remove_DataSetTrailingPadding_from_json_files(
     session_path = rawdata_dir / Path(subject_id) / Path(session_id)
     json_files = list(Path(session_path).glob('*/*json'))
     for json_file in json_files:
-        with open(json_file, 'r') as fp:
-            data = json.load(fp)
-        if 'global' in data.keys():
-            # anat
-            if 'DataSetTrailingPadding' in data['global']['slices'].keys():
-                data['global']['slices']['DataSetTrailingPadding'] = 'removed'
-                os.chmod(json_file, 0o744)
-                with open(json_file, 'w') as fp:
-                    json.dump(data, fp, indent=1)
-                os.chmod(json_file, 0o444)
-
-        if 'time' in data.keys():
-            # fmri
-            if 'DataSetTrailingPadding' in data['time']['samples'].keys():
-                data['time']['samples']['DataSetTrailingPadding'] = 'removed'
-                os.chmod(json_file, 0o744)
-                with open(json_file, 'w') as fp:
-                    json.dump(data, fp, indent=1)
-                os.chmod(json_file, 0o444)
+        # Rewrites each file at most once, and only if it still has padding
+        sanitize_sidecar(json_file)
 
 
-def run_mriqc_on_data(rawdata_dir, subject_id, session_id, mriqc_outdir_root,
-                      temp_dir, bsub, specific_nodes):
-    img_loc =  "/data/predict1/home/rez3/singularity_containers/mriqc-22.0.6.simg"
-    singularity = '/apps/released/gcc-toolchain/gcc-4.x/singularity/' \
-                  'singularity-3.7.0/bin/singularity'
+IMG_LOC = "/data/predict1/home/rez3/singularity_containers/mriqc-22.0.6.simg"
+SINGULARITY = '/apps/released/gcc-toolchain/gcc-4.x/singularity/' \
+              'singularity-3.7.0/bin/singularity'
+FREESURFER_LICENSE = '/data/pnl/soft/pnlpipe3/freesurfer/license.txt'
+
 
+def build_mriqc_command(data_mount, work_mount, out_mount, subject_ids,
+                        session_ids, nprocs=8, mem_gb=24):
+    """
+    Build the singularity command running MRIQC on the given subjects and
+    sessions (IDs including 'sub-' and 'ses-'). MRIQC processes every
+    subject x session combination that exists in the data.
+    """
+    # check if hostname is dna007, or contains eris in the name and if so use singularity variable
+    if 'dna007' in os.uname()[1] or 'eris' in os.uname()[1]:
+        print("Running on DNA007 or ERIS")
+        singularity = SINGULARITY
+    else:
+        print("Running on other nodes")
+        singularity = 'singularity'
+    # e.g. a stub script standing in for the container in tests
+    singularity = os.environ.get('MRIQC_SINGULARITY', singularity)
+    participant_labels = ' '.join(subject_ids)
+    session_labels = ' '.join(session_id.split("-")[1]
+                              for session_id in session_ids)
+    return f'{singularity} run -e \
+        -B {data_mount}:/data:ro \
+        -B {work_mount}:/work \
+        -B {out_mount}:/out \
+        -B {FREESURFER_LICENSE}:/opt/freesurfer/license.txt \
+        {IMG_LOC} \
+        /data /out participant \
+        -w /work --participant-label {participant_labels} \
+        --session-id {session_labels} \
+        --nprocs {nprocs} --mem {mem_gb}G --omp-nthreads {nprocs} \
+        --no-sub \
+        --verbose-reports'
+
+
+def _stream_command(command):
+    """Run a shell command, echoing its output, and return its exit code."""
+    p = Popen(command, shell=True, stdout=PIPE, bufsize=1)
+    for line in iter(p.stdout.readline, b''):
+        print(line.decode(), end='')
+    p.stdout.close()
+    return p.wait()
+
+
+def run_mriqc_on_data(rawdata_dir, subject_id, session_id, mriqc_outdir_root,
+                      temp_dir, bsub, specific_nodes, nprocs=8, mem_gb=24,
+                      stage=False):
     work_dir = Path(temp_dir) / 'mriqc' / subject_id / session_id
     print(f"Working directory: {work_dir}")
     try:
@@ -60,35 +95,24 @@ def run_mriqc_on_data(rawdata_dir, subject_id, session_id, mriqc_outdir_root,
     remove_DataSetTrailingPadding_from_json_files(rawdata_dir, subject_id,
                                                   session_id)
 
-    # check if hostname is dna007, or contains eris in the name and if so use singularity variable
-    if 'dna007' in os.uname()[1] or 'eris' in os.uname()[1]:
-        print("Running on DNA007 or ERIS")
-        command = f'{singularity} run -e \
-            -B {rawdata_dir}:/data:ro \
-            -B {work_dir}:/work \
-            -B {mriqc_outdir_root}:/out \
-            -B /data/pnl/soft/pnlpipe3/freesurfer/license.txt:/opt/freesurfer/license.txt \
-            {img_loc} \
-            /data /out participant \
-            -w /work --participant-label {subject_id} \
-            --session-id {session_id.split("-")[1]} \
-            --nprocs 8 --mem 24G --omp-nthreads 8 \
-            --no-sub \
-            --verbose-reports'
+    # Staging copies the session to node-local scratch and runs MRIQC there
+    # entirely; only its JSON and HTML outputs are synced back at the end
+    scratch = None
+    if stage and not bsub:
+        if has_scratch_space():
+            scratch = stage_inputs(rawdata_dir, subject_id, session_id)
+            print(f"Staged inputs in {scratch}")
+        else:
+            print(f"Not enough space in {scratch_base()}, not staging")
+    if scratch is None:
+        data_mount, work_mount, out_mount = \
+            rawdata_dir, work_dir, mriqc_outdir_root
     else:
-        print("Running on other nodes")
-        command = f'singularity run -e \
-            -B {rawdata_dir}:/data:ro \
-            -B {work_dir}:/work \
-            -B {mriqc_outdir_root}:/out \
-            -B /data/pnl/soft/pnlpipe3/freesurfer/license.txt:/opt/freesurfer/license.txt \
-            {img_loc} \
-            /data /out participant \
-            -w /work --participant-label {subject_id} \
-            --session-id {session_id.split("-")[1]} \
-            --nprocs 8 --mem 24G --omp-nthreads 8 \
-            --no-sub \
-            --verbose-reports'
+        data_mount, work_mount, out_mount = \
+            scratch / 'rawdata', scratch / 'work', scratch / 'out'
+
+    command = build_mriqc_command(data_mount, work_mount, out_mount,
+                                  [subject_id], [session_id], nprocs, mem_gb)
 
     if bsub:
         if not specific_nodes:
@@ -109,11 +133,96 @@ def run_mriqc_on_data(rawdata_dir, subject_id, session_id, mriqc_outdir_root,
     command = re.sub('\s+', ' ', command)
     print(command)
 
-    p = Popen(command, shell=True, stdout=PIPE, bufsize=1)
-    for line in iter(p.stdout.readline, b''):
-        print(line.decode(), end='')
-    p.stdout.close()
-    p.wait()
+    # With bsub this process only submits, so the job owns the work dir
+    if not bsub:
+        mark_workdir(work_dir, subject_id, session_id, RUNNING)
+    if bsub:
+        returncode = _stream_command(command)
+    else:
+        # Node events go to <temp_dir>/mriqc_progress, see job_monitor.py
+        returncode = run_monitored(command, progress_file(
+            temp_dir, subject_id, session_id))
+    if scratch is not None:
+        if returncode == 0:
+            synced = sync_outputs(out_mount, mriqc_outdir_root, subject_id)
+            print(f"Synced {synced} outputs to {mriqc_outdir_root}")
+        shutil.rmtree(scratch, ignore_errors=True)
+    if not bsub:
+        mark_workdir(work_dir, subject_id, session_id,
+                     DONE if returncode == 0 else FAILED, returncode)
+    return returncode
+
+
+def run_mriqc_on_pack(rawdata_dir, pairs, mriqc_outdir_root, temp_dir,
+                      nprocs=8, mem_gb=24, stage=False):
+    """
+    Run one MRIQC invocation over several subject-session pairs.
+
+    The pairs must form a valid pack (see session_packing.py), so that the
+    participant x session labels select exactly these sessions. The run
+    gets its own work dir under ``<temp_dir>/mriqc/<first subject>/``,
+    named after the pairs, so a rerun of the same pack resumes it.
+
+    Returns
+    -------
+    int
+        MRIQC's exit code.
+    """
+    pairs = sorted(pairs)
+    if len(pairs) == 1:
+        return run_mriqc_on_data(rawdata_dir, pairs[0][0], pairs[0][1],
+                                 mriqc_outdir_root, temp_dir, False, [],
+                                 nprocs, mem_gb, stage)
+    subject_ids = sorted(set(subject_id for subject_id, _ in pairs))
+    session_ids = sorted(set(session_id for _, session_id in pairs))
+    digest = hashlib.sha1(' '.join(f'{subject_id}/{session_id}'
+                                   for subject_id, session_id in pairs)
+                          .encode()).hexdigest()[:10]
+    work_dir = Path(temp_dir) / 'mriqc' / subject_ids[0] / f'pack-{digest}'
+    print(f"Working directory: {work_dir}")
+    work_dir.mkdir(exist_ok=True, parents=True)
+    Path(mriqc_outdir_root).mkdir(exist_ok=True, parents=True)
+
+    for subject_id, session_id in pairs:
+        remove_DataSetTrailingPadding_from_json_files(rawdata_dir, subject_id,
+                                                      session_id)
+
+    scratch = None
+    if stage:
+        if has_scratch_space():
+            scratch = stage_sessions(rawdata_dir, pairs)
+            print(f"Staged inputs in {scratch}")
+        else:
+            print(f"Not enough space in {scratch_base()}, not staging")
+    if scratch is None:
+        data_mount, work_mount, out_mount = \
+            rawdata_dir, work_dir, mriqc_outdir_root
+    else:
+        data_mount, work_mount, out_mount = \
+            scratch / 'rawdata', scratch / 'work', scratch / 'out'
+
+    command = build_mriqc_command(data_mount, work_mount, out_mount,
+                                  subject_ids, session_ids, nprocs, mem_gb)
+    command = re.sub('\s+', ' ', command)
+    print(command)
+
+    # The marker lists every pair, so the pack stays alive while any of
+    # its sessions has a job
+    mark_workdir(work_dir, subject_ids[0], work_dir.name, RUNNING,
+                 pairs=pairs)
+    returncode = run_monitored(command, progress_file(
+        temp_dir, subject_ids[0], work_dir.name))
+    if scratch is not None:
+        if returncode == 0:
+            for subject_id in subject_ids:
+                synced = sync_outputs(out_mount, mriqc_outdir_root,
+                                      subject_id)
+                print(f"Synced {synced} {subject_id} outputs to "
+                      f"{mriqc_outdir_root}")
+        shutil.rmtree(scratch, ignore_errors=True)
+    mark_workdir(work_dir, subject_ids[0], work_dir.name,
+                 DONE if returncode == 0 else FAILED, returncode, pairs=pairs)
+    return returncode
 
 
 if __name__ == "__main__":
@@ -133,13 +242,24 @@ if __name__ == "__main__":
                         help="Use bsub to submit jobs")
     parser.add_argument("--specific_nodes", nargs='*', default=[],
                         help="List of specific nodes for job submission")
+    parser.add_argument("--nprocs", type=int, default=8,
+                        help="Number of processes MRIQC may use")
+    parser.add_argument("--mem_gb", type=int, default=24,
+                        help="Memory limit given to MRIQC, in GB")
+    parser.add_argument("--stage", action='store_true',
+                        help="Run MRIQC on a copy of the session in node-"
+                             "local scratch ($TMPDIR or /tmp)")
 
     args = parser.parse_args()
 
-    run_mriqc_on_data(args.rawdata_dir,
-                      args.subject_id,
-                      args.session_id,
-                      args.mriqc_outdir_root,
-                      args.temp_dir,
-                      args.bsub,
-                      args.specific_nodes)
+    returncode = run_mriqc_on_data(args.rawdata_dir,
+                                   args.subject_id,
+                                   args.session_id,
+                                   args.mriqc_outdir_root,
+                                   args.temp_dir,
+                                   args.bsub,
+                                   args.specific_nodes,
+                                   args.nprocs,
+                                   args.mem_gb,
+                                   args.stage)
+    exit(returncode)
@@ -1,6 +1,11 @@
 import os
 import json
 
+# Directories whose modification times make up a session's cache signature:
+# (tree, subdirectory of the session directory, '' for the directory itself)
+SIGNATURE_DIRS = (('logs', ''), ('output', ''), ('output', 'anat'),
+                  ('output', 'func'), ('rawdata', 'anat'), ('rawdata', 'func'))
+
 
 # Return status string and error message, if needed
 def get_status(subject, session, mriqc_log_path, rawdata_path, mriqc_output_path):
@@ -87,8 +92,11 @@ def has_err_and_out_files(ses_dir):
     has_out_file = False
     has_err_file = False
 
-    # Loop through each file in the directory
+    # Loop through each file in the directory, skipping the dangling links
+    # of packed jobs whose report is not written yet
     for filename in os.listdir(ses_dir):
+        if not os.path.exists(os.path.join(ses_dir, filename)):
+            continue
         if filename.endswith(".out"):
             has_out_file = True
         elif filename.endswith(".err"):
@@ -108,3 +116,160 @@ def does_json_have_keys(filepath):
     missing_keys = [key for key in required_keys if key not in data]
     return not missing_keys
 
+
+class TreeIndex:
+    """
+    Directory listings of one tree, each directory scanned at most once.
+
+    Sessions of the same subject share the subject-level listing, and every
+    ``isdir``/``listdir`` question is answered from the scans.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.listings = {}
+
+    def listing(self, *parts):
+        """
+        Return {name: is_dir} of a directory, or None if it is missing.
+
+        Dangling symlinks (the logs of a packed job not written yet) are left
+        out, as ``get_status`` ignores them.
+        """
+        if parts not in self.listings:
+            try:
+                with os.scandir(os.path.join(self.root, *parts)) as it:
+                    self.listings[parts] = {
+                        entry.name: entry.is_dir() for entry in it
+                        if not entry.is_symlink()
+                        or os.path.exists(entry.path)}
+            except OSError:
+                self.listings[parts] = None
+        return self.listings[parts]
+
+    def isdir(self, *parts):
+        parent = self.listing(*parts[:-1])
+        return bool(parent and parent.get(parts[-1]))
+
+    def listdir(self, *parts):
+        return list(self.listing(*parts) or ())
+
+    def mtime_ns(self, *parts):
+        try:
+            return os.stat(os.path.join(self.root, *parts)).st_mtime_ns
+        except OSError:
+            return None
+
+
+def _status_from_index(subject, session, logs, rawdata, output,
+                       mriqc_output_path):
+    """Same checks as ``get_status``, answered from the tree indexes."""
+    if not logs.isdir(subject, session):
+        return "Not Ran", None
+    names = logs.listdir(subject, session)
+    if not (any(name.endswith(".out") for name in names)
+            and any(name.endswith(".err") for name in names)):
+        return "Running", None
+
+    mriqc_sub_ses_dir = mriqc_output_path + subject + '/' + session
+    if not output.isdir(subject, session):
+        return "Errors", "Missing subject/session directory in mriqc output (Should be here: " + mriqc_sub_ses_dir + ")"
+    if not output.isdir(subject, session, 'anat'):
+        return "Errors", 'Missing /anat directory (Should be here: ' + mriqc_sub_ses_dir + '/anat'
+    if not output.isdir(subject, session, 'func'):
+        return "Errors", 'Missing /func directory (Should be here: ' + mriqc_sub_ses_dir + '/func'
+
+    anat_json_list = output.listdir(subject, session, 'anat')
+    func_json_list = output.listdir(subject, session, 'func')
+    if len(anat_json_list) == 2 and len(func_json_list) == 4:
+        if all(does_json_have_keys(mriqc_sub_ses_dir + '/anat/' + file)
+               for file in anat_json_list):
+            return "Completed", None
+        return "Errors", "Missing keys in an /anat json file(s)"
+
+    if not rawdata.isdir(subject, session, 'anat') \
+            or not rawdata.isdir(subject, session, 'func'):
+        return "Errors", "rawdata is missing /anat or /func"
+    anat_rawdata_list = rawdata.listdir(subject, session, 'anat')
+    func_rawdata_list = rawdata.listdir(subject, session, 'func')
+    if len(anat_json_list) > 0 and len(func_json_list) > 1:
+        if (not do_files_correspond(anat_json_list, anat_rawdata_list)
+                or not do_files_correspond(func_json_list, func_rawdata_list)):
+            return "Errors", "Mismatched files in /mriqc output and /rawdata"
+        return ("Completed", "Wrong number of json files: "
+                + str(len(anat_json_list)) + " in /anat "
+                + str(len(func_json_list)) + " in /func")
+    return "Errors", "No json files"
+
+
+def load_status_cache(cache_path):
+    """Load the status cache written by ``save_status_cache``."""
+    try:
+        with open(cache_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_status_cache(cache_path, cache):
+    """Write the status cache through a temporary file and a rename."""
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(cache, file)
+    os.replace(temp_path, cache_path)
+
+
+def get_statuses(pairs, mriqc_log_path, rawdata_path, mriqc_output_path,
+                 cache_path=None):
+    """
+    Return the (status, error) of many subject-session pairs at once.
+
+    Gives the same answers as calling ``get_status`` on each pair, but
+    every directory of the three trees is listed at most once. With a
+    ``cache_path``, a session whose log, output and rawdata directories
+    all have the same modification times as on the previous call keeps
+    its previous result without any listing or JSON parsing. MRIQC
+    outputs and logs are added by creating or renaming files, which
+    updates those times. "Running" results are not cached: the report of
+    a packed job is written to the first session's log directory only,
+    which leaves the other sessions' times unchanged.
+
+    Parameters
+    ----------
+    pairs : iterable of tuple
+        (subject, session) pairs.
+    mriqc_log_path, rawdata_path, mriqc_output_path : str
+        Roots of the three trees, as for ``get_status``.
+    cache_path : str, optional
+        JSON file caching results between calls.
+
+    Returns
+    -------
+    list of tuple
+        (status, error) per pair, in order.
+    """
+    trees = {'logs': TreeIndex(mriqc_log_path),
+             'rawdata': TreeIndex(rawdata_path),
+             'output': TreeIndex(mriqc_output_path)}
+    cache = load_status_cache(cache_path) if cache_path else {}
+    results = []
+    for subject, session in pairs:
+        key = f'{subject},{session}'
+        signature = [trees[tree].mtime_ns(subject, session, subdir)
+                     for tree, subdir in SIGNATURE_DIRS]
+        cached = cache.get(key)
+        if cached is not None and cached['signature'] == signature:
+            results.append((cached['status'], cached['error']))
+            continue
+        status, error = _status_from_index(
+            subject, session, trees['logs'], trees['rawdata'],
+            trees['output'], mriqc_output_path)
+        if status == "Running":
+            cache.pop(key, None)
+        else:
+            cache[key] = {'signature': signature, 'status': status,
+                          'error': error}
+        results.append((status, error))
+    if cache_path:
+        save_status_cache(cache_path, cache)
+    return results
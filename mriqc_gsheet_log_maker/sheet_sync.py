@@ -0,0 +1,196 @@
+import os
+import json
+
+KEY_COLUMNS = ('Subject', 'Session')
+VALUE_INPUT_OPTION = 'USER_ENTERED'
+
+
+def column_letter(number):
+    """Return the A1 column name of a 1-based column number."""
+    letters = ''
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def row_range(first_row, last_row, width):
+    """Return the A1 range of whole table rows ``first_row``-``last_row``."""
+    return f'A{first_row}:{column_letter(width)}{last_row}'
+
+
+class GspreadBackend:
+    """Sheet operations on a gspread worksheet."""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def batch_update(self, updates):
+        self.worksheet.batch_update(updates,
+                                    value_input_option=VALUE_INPUT_OPTION)
+
+    def insert_rows(self, rows, row):
+        self.worksheet.insert_rows(rows, row=row,
+                                   value_input_option=VALUE_INPUT_OPTION)
+
+    def rewrite(self, rows):
+        self.worksheet.clear()
+        self.worksheet.update(rows, 'A1',
+                              value_input_option=VALUE_INPUT_OPTION)
+
+
+class LocalSheetBackend:
+    """
+    Stand-in for a worksheet, kept as a JSON list of rows in a local file.
+
+    It takes the same calls as ``GspreadBackend``, records them in
+    ``calls``, and is used to try the sync offline.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = []
+        try:
+            with open(path) as file:
+                self.rows = json.load(file)
+        except (OSError, ValueError):
+            self.rows = []
+
+    def _save(self):
+        _write_json(self.path, self.rows)
+
+    def batch_update(self, updates):
+        self.calls.append(('batch_update', len(updates)))
+        for update in updates:
+            first, last = update['range'].split(':')
+            first_row = int(first.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+            for offset, values in enumerate(update['values']):
+                index = first_row - 1 + offset
+                while len(self.rows) <= index:
+                    self.rows.append([])
+                self.rows[index] = list(values)
+        self._save()
+
+    def insert_rows(self, rows, row):
+        self.calls.append(('insert_rows', len(rows)))
+        self.rows[row - 1:row - 1] = [list(values) for values in rows]
+        self._save()
+
+    def rewrite(self, rows):
+        self.calls.append(('rewrite', len(rows)))
+        self.rows = [list(values) for values in rows]
+        self._save()
+
+
+def _write_json(path, data):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp_path, path)
+
+
+def _discard_snapshot(snapshot_path):
+    try:
+        os.remove(snapshot_path)
+    except FileNotFoundError:
+        pass
+
+
+def normalize_rows(rows):
+    """Turn table cells into plain JSON values, as stored in the snapshot."""
+    return json.loads(json.dumps(rows, default=str))
+
+
+def load_snapshot(snapshot_path):
+    """Return the table last pushed to the sheet, or None."""
+    try:
+        with open(snapshot_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_sync(old, new, key_columns=KEY_COLUMNS):
+    """
+    Work out how to turn the sheet holding table ``old`` into ``new``.
+
+    Tables are lists of rows, headers first. Rows are matched on their
+    ``key_columns``. If the rows of ``new`` are those of ``old`` in the same
+    order, possibly after new rows at the top (where the newest submissions
+    sort), only the new rows are inserted and the changed rows rewritten,
+    runs of adjacent changed rows as one range. Anything else (another
+    header, removed or reordered rows) rewrites the whole sheet.
+
+    Returns
+    -------
+    tuple
+        ('rewrite', None, None), or ('delta', rows to insert below the
+        header, list of batch updates).
+    """
+    if not old or not new or old[0] != new[0]:
+        return 'rewrite', None, None
+    header = new[0]
+    try:
+        key_index = [header.index(column) for column in key_columns]
+    except ValueError:
+        return 'rewrite', None, None
+
+    def keys(rows):
+        return [tuple(row[i] for i in key_index) for row in rows[1:]]
+
+    old_keys, new_keys = keys(old), keys(new)
+    added = len(new_keys) - len(old_keys)
+    if added < 0 or new_keys[added:] != old_keys:
+        return 'rewrite', None, None
+
+    inserted = new[1:added + 1]
+    updates = []
+    run = None  # [first sheet row, rows]
+    for offset, (old_row, new_row) in enumerate(zip(old[1:],
+                                                    new[added + 1:])):
+        sheet_row = added + offset + 2
+        if old_row == new_row:
+            run = None
+            continue
+        if run is None:
+            run = [sheet_row, []]
+            updates.append(run)
+        run[1].append(new_row)
+    return 'delta', inserted, [
+        {'range': row_range(first, first + len(rows) - 1, len(header)),
+         'values': rows} for first, rows in updates]
+
+
+def sync_table(backend, rows, snapshot_path, full=False):
+    """
+    Bring a sheet up to date with ``rows`` (headers first), sending only
+    what changed since the snapshot of the last push.
+
+    The snapshot is removed before anything is sent and only written again
+    once the whole push succeeded, so after a failed or partial push (e.g.
+    rows inserted but the updates not sent) the next call rewrites the
+    sheet in full. Edits made to the sheet by hand are not seen; ``full``
+    rewrites the sheet regardless.
+
+    Returns
+    -------
+    dict
+        Counts of 'inserted' and 'updated' rows, or of 'rewritten' rows.
+    """
+    rows = normalize_rows(rows)
+    old = None if full else load_snapshot(snapshot_path)
+    mode, inserted, updates = plan_sync(old, rows)
+    _discard_snapshot(snapshot_path)
+    if mode == 'rewrite':
+        backend.rewrite(rows)
+        counts = {'rewritten': len(rows) - 1}
+    else:
+        if inserted:
+            backend.insert_rows(inserted, row=2)
+        if updates:
+            backend.batch_update(updates)
+        counts = {'inserted': len(inserted),
+                  'updated': sum(len(update['values'])
+                                 for update in updates)}
+    _write_json(snapshot_path, rows)
+    return counts
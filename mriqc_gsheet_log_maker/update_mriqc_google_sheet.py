@@ -5,10 +5,19 @@ from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 from tqdm import tqdm
 import argparse
-from get_status import get_status
+from get_status import get_statuses
+from sheet_sync import GspreadBackend, LocalSheetBackend, sync_table
 import os
+import sys
 import datetime
 
+# submission_index.py lives in the pipeline directory above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from submission_index import load_submission_index
+
+DEFAULT_SNAPSHOT_PATH = '/data/predict1/home/rez3/bin/csv_files' \
+                        '/mriqc_sheet_snapshot.json'
+
 
 def authorize_google_sheets(_json_keyfile):
     scope = ['https://spreadsheets.google.com/feeds',
@@ -30,49 +39,38 @@ def main(gspread_id,
          temp_csvs_path,
          mriqc_log_path,
          rawdata_path,
-         mriqc_output_path):
-    # Returns a datetime object from the name of a file in format
-    # 'temp_YYYYMMDD_...'
-    def parse_filename(file_name):
-        date_str = file_name.split('_')[1]
-        return datetime.datetime.strptime(date_str, '%Y%m%d')
-
-    # Returns subject-session string from input csv (to be used as key)
-    def get_subject_session_key(subject_session_csv_path):
-        df = pd.read_csv(subject_session_csv_path)
-        subject = df['Subject'].iloc[0]
-        session = df['Session'].iloc[0]
-        return f"{subject},{session}"
-
-    # Load CSV file paths
-    csv_files = [file for file in os.listdir(temp_csvs_path) if
-                 file.endswith('.csv')]
-    date_dict = {}
-
+         mriqc_output_path,
+         status_cache_path=None,
+         snapshot_path=None,
+         local_sheet_path=None,
+         full_sync=False):
     # Create dictionary, where the key is the subject-session string and the
-    # value is the date
-    for file in csv_files:
-        file_path = os.path.join(temp_csvs_path, file)
-        key = get_subject_session_key(file_path)
-        value = parse_filename(file)
-        date_dict[key] = value
-
-    # Start progress bar
-    tqdm.pandas()
-
-    # Authorize Google Sheets
-    gc = authorize_google_sheets(gspread_key)
-    sheet = gc.open_by_key(gspread_id).worksheet(google_sheet_name)
+    # value is the date of its latest submission; the index is read in one
+    # go, and only CSVs not indexed yet are opened
+    date_dict = {}
+    for timestamp, subject, session, _ in sorted(
+            load_submission_index(temp_csvs_path)):
+        date_dict[f"{subject},{session}"] = datetime.datetime.strptime(
+            timestamp[:8], '%Y%m%d')
+
+    if local_sheet_path:
+        # Offline stand-in for the Google Sheet
+        backend = LocalSheetBackend(local_sheet_path)
+    else:
+        # Authorize Google Sheets
+        gc = authorize_google_sheets(gspread_key)
+        backend = GspreadBackend(
+            gc.open_by_key(gspread_id).worksheet(google_sheet_name))
 
     # Create Status and Error columns
     data = pd.read_csv(rerun_csv_path)
-    data[['Status', 'Error']] = data.progress_apply(
-        lambda row: get_status(row['Subject'], row['Session'],
-                               mriqc_log_path,
-                               rawdata_path,
-                               mriqc_output_path),
-        axis=1, result_type='expand'
-    )
+    # All rows at once: each log, output and rawdata directory is listed at
+    # most once, and unchanged sessions come from the cache
+    pairs = list(zip(data['Subject'], data['Session']))
+    data[['Status', 'Error']] = pd.DataFrame(
+        get_statuses(tqdm(pairs), mriqc_log_path, rawdata_path,
+                     mriqc_output_path, status_cache_path),
+        index=data.index, columns=['Status', 'Error'])
 
     # Insert date column before everything else
     data.insert(0, 'Date', data.apply(
@@ -80,16 +78,22 @@ def main(gspread_id,
                                   f"{row['Session']}",
                                   pd.NaT), axis=1)
                 )
-    data.sort_values('Date', ascending=False, inplace=True)
+    # Stable, so rows of the same date keep their order between refreshes
+    data.sort_values('Date', ascending=False, inplace=True, kind='mergesort')
 
     # Make the datetime into a string
     data['Date'] = "'" + data['Date'].dt.strftime('%Y/%m/%d')
     data.fillna("", inplace=True)
 
-    # Upload to Google Sheet
+    # Upload to Google Sheet, sending only the rows that changed since the
+    # last push when there is a snapshot of it
     formatted = [data.columns.values.tolist()] + data.values.tolist()
-    sheet.clear()
-    sheet.update(formatted, 'A1', value_input_option='USER_ENTERED')
+    if snapshot_path is None:
+        backend.rewrite(formatted)
+        return
+    counts = sync_table(backend, formatted, snapshot_path, full_sync)
+    print(', '.join(f"{count} rows {action}"
+                    for action, count in counts.items()))
 
 
 if __name__ == '__main__':
@@ -136,7 +140,32 @@ if __name__ == '__main__':
                         default='/data/predict1/data_from_nda/MRI_ROOT'
                                 '/rez3_derivatives/mriqc/')
 
+    parser.add_argument('-c', '--status_cache_path',
+                        help='JSON file caching the status of sessions whose '
+                             'directories have not changed',
+                        default='/data/predict1/home/rez3/bin/csv_files'
+                                '/mriqc_status_cache.json')
+
+    parser.add_argument('-s', '--snapshot_path',
+                        help='JSON snapshot of the table last pushed, used to '
+                             'send only changed rows (default: '
+                             f'{DEFAULT_SNAPSHOT_PATH}, or '
+                             '<local_sheet_path>.snapshot.json with '
+                             '--local_sheet_path)')
+
+    parser.add_argument('--local_sheet_path',
+                        help='Write to this local JSON file instead of the '
+                             'Google Sheet (for testing offline)')
+
+    parser.add_argument('--full_sync', action='store_true',
+                        help='Rewrite the whole sheet, e.g. after editing it '
+                             'by hand')
+
     args = parser.parse_args()
+    if args.snapshot_path is None:
+        # An offline run must not touch the real sheet's snapshot
+        args.snapshot_path = f'{args.local_sheet_path}.snapshot.json' \
+            if args.local_sheet_path else DEFAULT_SNAPSHOT_PATH
 
     main(args.spreadsheet_id,
          args.google_sheet_name,
@@ -145,4 +174,8 @@ if __name__ == '__main__':
          args.temp_csvs_path,
          args.mriqc_log_path,
          args.rawdata_path,
-         args.mriqc_output_path)
+         args.mriqc_output_path,
+         args.status_cache_path,
+         args.snapshot_path,
+         args.local_sheet_path,
+         args.full_sync)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import gzip
+import math
+import struct
+import argparse
+from pathlib import Path
+
+# Resources requested when a session has no readable NIfTI headers, which
+# is what every job used to request
+DEFAULT_RESOURCES = {'mem_mb': 18000, 'cores': 2, 'walltime': '72:00',
+                     'queue': 'pri_pnl'}
+
+# Rough cost model of one MRIQC participant run; calibrate against the LSF
+# reports of finished jobs. Voxel counts are in millions (Mvox), and BOLD
+# costs scale with voxels x volumes.
+BASE_MEM_MB = 3000
+ANAT_MEM_MB_PER_MVOX = 400
+BOLD_MEM_MB_PER_MVOX_VOLUME = 10
+BASE_MINUTES = 30
+ANAT_MINUTES_PER_IMAGE = 45
+BOLD_MINUTES_PER_MVOX_VOLUME = 0.5
+MEM_HEADROOM = 1.25
+WALLTIME_HEADROOM = 2.0
+MIN_MEM_MB, MAX_MEM_MB = 4000, 32000
+MAX_CORES = 4
+MAX_WALLTIME_HOURS = 72
+
+_NIFTI1_HEADER_SIZE = 348
+_NIFTI2_HEADER_SIZE = 540
+
+
+def read_nifti_header(nifti_path):
+    """
+    Read the ``dim`` and ``pixdim`` fields of a gzipped NIfTI-1 or NIfTI-2
+    file, decompressing only the header.
+
+    Returns
+    -------
+    tuple of (tuple of int, tuple of float)
+        The used ``dim[1:dim[0]+1]`` and matching ``pixdim`` values.
+
+    Raises
+    ------
+    ValueError
+        If the file does not start with a NIfTI-1 or NIfTI-2 header.
+    """
+    with gzip.open(nifti_path, 'rb') as file:
+        header = file.read(_NIFTI2_HEADER_SIZE)
+    for endian in '<>':
+        if len(header) < 4:
+            continue
+        sizeof_hdr = struct.unpack_from(endian + 'i', header, 0)[0]
+        if sizeof_hdr == _NIFTI1_HEADER_SIZE:
+            dim = struct.unpack_from(endian + '8h', header, 40)
+            pixdim = struct.unpack_from(endian + '8f', header, 76)
+            break
+        if sizeof_hdr == _NIFTI2_HEADER_SIZE \
+                and len(header) == _NIFTI2_HEADER_SIZE:
+            dim = struct.unpack_from(endian + '8q', header, 16)
+            pixdim = struct.unpack_from(endian + '8d', header, 104)
+            break
+    else:
+        raise ValueError(f"{nifti_path} is not a NIfTI-1 or NIfTI-2 file")
+    ndim = max(1, min(int(dim[0]), 7))
+    return tuple(int(d) for d in dim[1:ndim + 1]), \
+        tuple(float(p) for p in pixdim[1:ndim + 1])
+
+
+def image_counts(dim):
+    """Return (voxels per volume, volumes) of an image's ``dim``."""
+    sizes = [max(1, d) for d in dim] + [1] * (4 - len(dim))
+    volumes = 1
+    for d in sizes[3:]:
+        volumes *= d
+    return sizes[0] * sizes[1] * sizes[2], volumes
+
+
+def session_images(rawdata_dir, subject_id, session_id):
+    """
+    Summarize the NIfTI images of one session from their headers.
+
+    Returns
+    -------
+    dict
+        Modality ('anat' or 'bold') -> list of (voxels, volumes), one per
+        image. Unreadable images are skipped.
+    """
+    session_dir = Path(rawdata_dir, subject_id, session_id)
+    images = {'anat': [], 'bold': []}
+    for folder in ('anat', 'func'):
+        for nifti_path in sorted((session_dir / folder).glob('*.nii.gz')):
+            # Same exclusions as collect_files.is_nifti_file, which is not
+            # imported so the submitter keeps to the standard library
+            if any(x in nifti_path.name for x in ['auxiliary', 'sbref']):
+                continue
+            if folder == 'func' and \
+                    not nifti_path.name.endswith('_bold.nii.gz'):
+                continue
+            try:
+                dim, _ = read_nifti_header(nifti_path)
+            except (OSError, EOFError, ValueError, struct.error):
+                continue
+            images['anat' if folder == 'anat' else 'bold'].append(
+                image_counts(dim))
+    return images
+
+
+def format_walltime(minutes):
+    """Format minutes as an LSF -W value (HH:MM), rounded up to the hour."""
+    hours = min(MAX_WALLTIME_HOURS, max(1, math.ceil(minutes / 60)))
+    return f'{hours}:00'
+
+
+def _bold_loads(images):
+    """BOLD runs' voxels x volumes, in millions, largest first."""
+    return sorted((voxels * volumes / 1e6
+                   for voxels, volumes in images.get('bold', [])),
+                  reverse=True)
+
+
+def session_work_minutes(images):
+    """Estimated single-core MRIQC minutes for a session's images."""
+    return (ANAT_MINUTES_PER_IMAGE * len(images.get('anat', []))
+            + BOLD_MINUTES_PER_MVOX_VOLUME * sum(_bold_loads(images)))
+
+
+def predict_resources(images, queue=DEFAULT_RESOURCES['queue']):
+    """
+    Pick memory, cores and walltime for one session's MRIQC job.
+
+    Memory covers the largest anatomical image plus the BOLD runs that can
+    be processed at once, walltime the work of all images spread over the
+    cores, each with headroom. One core is used per image up to
+    ``MAX_CORES``.
+
+    Parameters
+    ----------
+    images : dict
+        Output of ``session_images``.
+
+    Returns
+    -------
+    dict
+        'mem_mb', 'cores', 'walltime' and 'queue', as for bsub; the fallback
+        resources if the session has no images.
+    """
+    anat, bold = images.get('anat', []), images.get('bold', [])
+    if not anat and not bold:
+        return dict(DEFAULT_RESOURCES, queue=queue)
+    cores = max(1, min(MAX_CORES, len(anat) + len(bold)))
+
+    anat_mvox = max((voxels for voxels, _ in anat), default=0) / 1e6
+    bold_loads = _bold_loads(images)
+    mem_mb = (BASE_MEM_MB + ANAT_MEM_MB_PER_MVOX * anat_mvox
+              + BOLD_MEM_MB_PER_MVOX_VOLUME * sum(bold_loads[:cores]))
+    mem_mb = int(math.ceil(mem_mb * MEM_HEADROOM / 1000) * 1000)
+    mem_mb = max(MIN_MEM_MB, min(MAX_MEM_MB, mem_mb))
+
+    minutes = BASE_MINUTES + session_work_minutes(images) / cores
+    return {'mem_mb': mem_mb, 'cores': cores,
+            'walltime': format_walltime(minutes * WALLTIME_HEADROOM),
+            'queue': queue}
+
+
+def predict_session_resources(rawdata_dir, subject_id, session_id,
+                              queue=DEFAULT_RESOURCES['queue']):
+    """Predict the resources of one session from its NIfTI headers."""
+    return predict_resources(
+        session_images(rawdata_dir, subject_id, session_id), queue)
+
+
+def predict_pack_resources(rawdata_dir, pairs,
+                           queue=DEFAULT_RESOURCES['queue']):
+    """
+    Predict the resources of one MRIQC run over several sessions, which
+    costs about as much as a single session holding all of their images.
+    """
+    images = {'anat': [], 'bold': []}
+    for subject_id, session_id in pairs:
+        for modality, counts in session_images(rawdata_dir, subject_id,
+                                               session_id).items():
+            images[modality].extend(counts)
+    return predict_resources(images, queue)
+
+
+def combine_resources(resource_list):
+    """Return resources that cover every set in ``resource_list``."""
+    resource_list = list(resource_list)
+    if not resource_list:
+        return dict(DEFAULT_RESOURCES)
+    return {'mem_mb': max(r['mem_mb'] for r in resource_list),
+            'cores': max(r['cores'] for r in resource_list),
+            'walltime': max((r['walltime'] for r in resource_list),
+                            key=lambda w: int(w.split(':')[0])),
+            'queue': resource_list[0]['queue']}
+
+
+def mriqc_mem_gb(resources):
+    """Memory to give MRIQC's --mem, leaving room below the LSF limit."""
+    return max(1, int(resources['mem_mb'] * 0.9 / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Predict the LSF resources of MRIQC jobs from the NIfTI "
+                    "headers of each subject-session pair.")
+    parser.add_argument("rawdata_dir", help="Path to the BIDS dataset root "
+                                            "directory.")
+    parser.add_argument("pairs", nargs='+',
+                        help="Subject-session pairs as sub-X/ses-Y.")
+    args = parser.parse_args()
+
+    for pair in args.pairs:
+        subject_id, session_id = pair.strip('/').split('/')
+        images = session_images(args.rawdata_dir, subject_id, session_id)
+        resources = predict_resources(images)
+        print(f"{subject_id} {session_id}: {len(images['anat'])} anat, "
+              f"{len(images['bold'])} bold -> {resources['mem_mb']} MB, "
+              f"{resources['cores']} cores, {resources['walltime']}")
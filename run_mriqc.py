@@ -1,8 +1,12 @@
 import csv
+import os
 import argparse
-from mriqc import run_mriqc_on_data
+from mriqc import run_mriqc_on_data, run_mriqc_on_pack
 from pathlib import Path
 
+from session_packing import order_pairs, pack_sessions
+from local_executor import DEFAULT_LOGS_ROOT_DIR, make_tasks, run_local
+
 
 def parse_csv_for_unique_pairs(csv_file):
     unique_pairs = set()
@@ -14,13 +18,46 @@ def parse_csv_for_unique_pairs(csv_file):
     return unique_pairs
 
 
+def read_caselist(csv_file):
+    """Return the unique subject-session pairs of a CSV in file order."""
+    with open(csv_file, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        pairs = [(row['Subject'], row['Session']) for row in reader]
+    return list(dict.fromkeys(pairs))
+
+
+def array_index():
+    """Return this LSF job array element's index, or None outside arrays."""
+    # LSF sets LSB_JOBINDEX to 0 for jobs that are not array elements
+    index = int(os.environ.get('LSB_JOBINDEX', '0') or 0)
+    return index if index > 0 else None
+
+
 def call_mriqc_for_each_pair(unique_pairs, rawdata_dir, mriqc_outdir_root,
-                             temp_dir, bsub, specific_nodes):
-    for subject_id, session_id in unique_pairs:
+                             temp_dir, bsub, specific_nodes, nprocs=8,
+                             mem_gb=24, stage=False):
+    """Run MRIQC on each pair and return their exit codes."""
+    returncodes = []
+    for subject_id, session_id in order_pairs(unique_pairs):
         print(f"Processing {subject_id} {session_id}")
-        run_mriqc_on_data(str(rawdata_dir), subject_id, session_id,
-                          str(mriqc_outdir_root), temp_dir, bsub,
-                          specific_nodes)
+        returncodes.append(run_mriqc_on_data(
+            str(rawdata_dir), subject_id, session_id, str(mriqc_outdir_root),
+            temp_dir, bsub, specific_nodes, nprocs, mem_gb, stage))
+    return returncodes
+
+
+def call_mriqc_for_each_pack(unique_pairs, rawdata_dir, mriqc_outdir_root,
+                             temp_dir, pack_minutes, nprocs=8, mem_gb=24,
+                             stage=False):
+    """Pack the pairs, run MRIQC once per pack and return the exit codes."""
+    returncodes = []
+    for pack in pack_sessions(unique_pairs, str(rawdata_dir), pack_minutes):
+        print("Processing " + ' '.join(f'{subject_id} {session_id}'
+                                       for subject_id, session_id in pack))
+        returncodes.append(run_mriqc_on_pack(
+            str(rawdata_dir), pack, str(mriqc_outdir_root), temp_dir,
+            nprocs, mem_gb, stage))
+    return returncodes
 
 
 if __name__ == "__main__":
@@ -41,13 +78,62 @@ if __name__ == "__main__":
                         help="Use bsub to submit jobs")
     parser.add_argument("--specific_nodes", nargs='*', default=[],
                         help="List of specific nodes for job submission")
+    parser.add_argument("--nprocs", type=int, default=8,
+                        help="Number of processes MRIQC may use")
+    parser.add_argument("--mem_gb", type=int, default=24,
+                        help="Memory limit given to MRIQC, in GB")
+    parser.add_argument("--stage", action="store_true",
+                        help="Run MRIQC on a copy of each session in "
+                             "node-local scratch")
+    parser.add_argument("--pack_minutes", type=float,
+                        help="Group sessions into shared MRIQC runs of about "
+                             "this many estimated minutes")
+    parser.add_argument("--local", action="store_true",
+                        help="Run the sessions concurrently on this node, "
+                             "within --max_cores and --max_mem_gb")
+    parser.add_argument("--max_cores", type=int,
+                        help="With --local, cores to use in total (default: "
+                             "all)")
+    parser.add_argument("--max_mem_gb", type=int,
+                        help="With --local, memory to use in total, in GB "
+                             "(default: what is available)")
+    parser.add_argument("--predict_resources", action="store_true",
+                        help="With --local, size each session from its NIfTI "
+                             "headers instead of --nprocs and --mem_gb")
+    parser.add_argument("--logs_root_dir", default=DEFAULT_LOGS_ROOT_DIR,
+                        help="With --local, root directory for the "
+                             "<subject>/<session> logs")
 
     args = parser.parse_args()
+    if args.local and (args.bsub or args.pack_minutes):
+        parser.error("--local cannot be combined with --bsub or "
+                     "--pack_minutes")
 
     # Convert rawdata_dir and mriqc_outdir_root to Path objects
     rawdata_dir = Path(args.rawdata_dir)
     mriqc_outdir_root = Path(args.mriqc_outdir_root)
 
-    unique_pairs = parse_csv_for_unique_pairs(args.csv_file)
-    call_mriqc_for_each_pair(unique_pairs, rawdata_dir, mriqc_outdir_root,
-                             args.temp_dir, args.bsub, args.specific_nodes)
+    index = array_index()
+    if index is not None:
+        # Job array element: run only this element's row of the caselist
+        unique_pairs = [read_caselist(args.csv_file)[index - 1]]
+        print(f"Array element {index}: {unique_pairs[0]}")
+    else:
+        unique_pairs = parse_csv_for_unique_pairs(args.csv_file)
+    if args.local:
+        tasks = make_tasks(order_pairs(unique_pairs), str(rawdata_dir),
+                           args.nprocs, args.mem_gb, args.predict_resources)
+        returncodes = run_local(tasks, rawdata_dir, mriqc_outdir_root,
+                                args.temp_dir, args.logs_root_dir,
+                                args.max_cores, args.max_mem_gb, args.stage)
+    elif args.pack_minutes and not args.bsub:
+        returncodes = call_mriqc_for_each_pack(
+            unique_pairs, rawdata_dir, mriqc_outdir_root, args.temp_dir,
+            args.pack_minutes, args.nprocs, args.mem_gb, args.stage)
+    else:
+        returncodes = call_mriqc_for_each_pair(
+            unique_pairs, rawdata_dir, mriqc_outdir_root, args.temp_dir,
+            args.bsub, args.specific_nodes, args.nprocs, args.mem_gb,
+            args.stage)
+    # Fail the LSF job if any session failed
+    exit(next((code for code in returncodes if code), 0))
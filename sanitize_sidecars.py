@@ -0,0 +1,197 @@
+# sanitize_sidecars.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+PADDING_KEY = 'DataSetTrailingPadding'
+PADDING_VALUE = 'removed'
+# Blocks of (anat, fmri) sidecars that may hold the padding field
+PADDING_BLOCKS = (('global', 'slices'), ('time', 'samples'))
+DEFAULT_WORKERS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sidecars (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    checked_time REAL
+);
+"""
+
+
+def strip_padding(data):
+    """
+    Replace DataSetTrailingPadding values with 'removed' in a parsed sidecar.
+
+    Returns
+    -------
+    bool
+        True if ``data`` was changed.
+    """
+    changed = False
+    for outer, inner in PADDING_BLOCKS:
+        block = data.get(outer)
+        if not isinstance(block, dict) or \
+                not isinstance(block.get(inner), dict):
+            continue
+        values = block[inner]
+        if PADDING_KEY in values and values[PADDING_KEY] != PADDING_VALUE:
+            values[PADDING_KEY] = PADDING_VALUE
+            changed = True
+    return changed
+
+
+def write_json_atomic(json_file, data, mode=0o444):
+    """
+    Write JSON to a temporary file next to ``json_file`` and rename it over
+    the original, so readers never see a partial file. The rename only needs
+    write access to the directory, so read-only sidecars are replaced
+    without changing their mode first. In directories we cannot write to,
+    the file is rewritten in place instead.
+    """
+    json_file = str(json_file)
+    directory, name = os.path.split(json_file)
+    temp_file = os.path.join(directory, f'.{name}.{os.getpid()}.tmp')
+    try:
+        fp = open(temp_file, 'w')
+    except PermissionError:
+        os.chmod(json_file, 0o744)
+        with open(json_file, 'w') as fp:
+            json.dump(data, fp, indent=1)
+        os.chmod(json_file, mode)
+        return
+    try:
+        with fp:
+            json.dump(data, fp, indent=1)
+        os.chmod(temp_file, mode)
+        os.replace(temp_file, json_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def sanitize_sidecar(json_file):
+    """
+    Strip the trailing padding field of one sidecar, writing it at most once.
+
+    Files that do not mention the field are not parsed at all.
+
+    Returns
+    -------
+    tuple of (bool, bytes)
+        Whether the file was rewritten, and its final content.
+    """
+    with open(json_file, 'rb') as fp:
+        content = fp.read()
+    if PADDING_KEY.encode() not in content:
+        return False, content
+    data = json.loads(content.decode())
+    if not strip_padding(data):
+        return False, content
+    write_json_atomic(json_file, data)
+    with open(json_file, 'rb') as fp:
+        return True, fp.read()
+
+
+def _check_sidecar(task):
+    """
+    Worker: sanitize one sidecar unless its ledger entry is still current.
+
+    Returns
+    -------
+    tuple
+        (path, status, size, mtime_ns, sha256), with status 'skipped',
+        'clean', 'sanitized' or 'error'; the last three are None when
+        skipped or on error.
+    """
+    path, known = task
+    try:
+        stat = os.stat(path)
+        if known is not None and known == (stat.st_size, stat.st_mtime_ns):
+            return path, 'skipped', None, None, None
+        changed, content = sanitize_sidecar(path)
+        if changed:
+            stat = os.stat(path)
+        return (path, 'sanitized' if changed else 'clean', stat.st_size,
+                stat.st_mtime_ns, hashlib.sha256(content).hexdigest())
+    except (OSError, ValueError):
+        return path, 'error', None, None, None
+
+
+def open_ledger(ledger_path):
+    """Open (and create if needed) the SQLite sidecar ledger."""
+    conn = sqlite3.connect(str(ledger_path))
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sanitize_tree(rawdata_dir, ledger_path, workers=DEFAULT_WORKERS,
+                  threads=None):
+    """
+    Sanitize every session sidecar of a BIDS tree with a process pool.
+
+    Sidecars whose size and mtime still match the ledger are skipped without
+    being opened; every other sidecar is checked, rewritten once if needed,
+    and recorded with its new size, mtime and content hash.
+
+    Parameters
+    ----------
+    rawdata_dir : str
+        Path to the rawdata directory.
+    ledger_path : str
+        Path to the SQLite ledger.
+    workers : int
+        Number of worker processes.
+    threads : int, optional
+        Number of subject directories listed concurrently.
+
+    Returns
+    -------
+    dict
+        Number of sidecars per status.
+    """
+    from collect_files import DEFAULT_THREADS, crawl_bids_tree, is_json_file
+    conn = open_ledger(ledger_path)
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in
+             conn.execute("SELECT path, size, mtime_ns FROM sidecars")}
+    tasks = ((path, known.get(path)) for path in crawl_bids_tree(
+        rawdata_dir, is_json_file, threads or DEFAULT_THREADS))
+
+    counts = {'skipped': 0, 'clean': 0, 'sanitized': 0, 'error': 0}
+    now = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as executor, \
+                conn:
+            for path, status, size, mtime_ns, sha256 in executor.map(
+                    _check_sidecar, tasks, chunksize=64):
+                counts[status] += 1
+                if size is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sidecars (path, size, "
+                        "mtime_ns, sha256, checked_time) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (path, size, mtime_ns, sha256, now))
+    finally:
+        conn.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Strip DataSetTrailingPadding from the JSON sidecars of "
+                    "a BIDS tree ahead of MRIQC submission.")
+    parser.add_argument("rawdata_dir", help="Path to the rawdata directory.")
+    parser.add_argument("-l", "--ledger", default="sidecar_ledger.sqlite",
+                        help="Path to the SQLite ledger of checked sidecars.")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of worker processes.")
+    args = parser.parse_args()
+
+    counts = sanitize_tree(args.rawdata_dir, args.ledger, args.workers)
+    print(', '.join(f"{count} {status}" for status, count in counts.items()))
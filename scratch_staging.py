@@ -0,0 +1,132 @@
+# scratch_staging.py
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+# Node-local scratch must have this much free space, or staging is skipped
+MIN_FREE_GB = 20
+# Only these MRIQC outputs are copied back to the shared derivatives tree
+SYNC_SUFFIXES = ('.json', '.html')
+# Hidden staging dir inside the derivatives tree; the crawlers only follow
+# sub-* directories, so nothing in it is ever picked up
+INCOMING_NAME = '.incoming'
+
+
+def scratch_base():
+    """Return the node-local scratch directory: $TMPDIR, else /tmp."""
+    return os.environ.get('TMPDIR') or '/tmp'
+
+
+def has_scratch_space(base=None, min_free_gb=MIN_FREE_GB):
+    """True if the scratch directory has at least ``min_free_gb`` free."""
+    try:
+        free = shutil.disk_usage(base or scratch_base()).free
+    except OSError:
+        return False
+    return free >= min_free_gb * 1024 ** 3
+
+
+def _copy_files(src_dir, dst_dir):
+    """Copy the regular files (not subdirectories) of ``src_dir``."""
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        if entry.is_file():
+            shutil.copy2(entry.path, dst_dir / entry.name)
+
+
+def stage_inputs(rawdata_dir, subject_id, session_id, base=None):
+    """
+    Copy what MRIQC needs for one session into a fresh scratch directory.
+
+    That is the top-level BIDS files (dataset_description.json and any
+    inherited sidecars), the subject- and session-level files, and the
+    session's anat and func folders.
+
+    Returns
+    -------
+    pathlib.Path
+        The scratch directory, holding ``rawdata/``, ``work/`` and ``out/``.
+    """
+    return stage_sessions(rawdata_dir, [(subject_id, session_id)], base)
+
+
+def stage_sessions(rawdata_dir, pairs, base=None):
+    """Stage several sessions (see ``stage_inputs``) into one directory."""
+    subject_id, session_id = pairs[0]
+    scratch = Path(tempfile.mkdtemp(prefix=f'mriqc_{subject_id}_{session_id}_',
+                                    dir=base or scratch_base()))
+    rawdata_dir = Path(rawdata_dir)
+    local_rawdata = scratch / 'rawdata'
+    try:
+        _copy_files(rawdata_dir, local_rawdata)
+        for subject_id, session_id in pairs:
+            if not (local_rawdata / subject_id).exists():
+                _copy_files(rawdata_dir / subject_id,
+                            local_rawdata / subject_id)
+            session_dir = rawdata_dir / subject_id / session_id
+            local_session = local_rawdata / subject_id / session_id
+            _copy_files(session_dir, local_session)
+            for folder in ('anat', 'func'):
+                if (session_dir / folder).is_dir():
+                    shutil.copytree(session_dir / folder,
+                                    local_session / folder)
+        (scratch / 'work').mkdir()
+        (scratch / 'out').mkdir()
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    return scratch
+
+
+def _output_files(local_out, subject_id):
+    """Yield the paths (relative to ``local_out``) of outputs to sync back."""
+    local_out = Path(local_out)
+    # Reports sit at the top level, IQM JSONs under sub-*/ses-*/<folder>/
+    for path in sorted(local_out.glob(f'{subject_id}*')):
+        if path.is_file() and path.name.endswith(SYNC_SUFFIXES):
+            yield path.relative_to(local_out)
+    for path in sorted((local_out / subject_id).rglob('*')):
+        if path.is_file() and path.name.endswith(SYNC_SUFFIXES):
+            yield path.relative_to(local_out)
+    description = local_out / 'dataset_description.json'
+    if description.is_file():
+        yield description.relative_to(local_out)
+
+
+def sync_outputs(local_out, mriqc_outdir_root, subject_id):
+    """
+    Move MRIQC's JSON and HTML outputs into the shared derivatives tree.
+
+    Files are first copied into a private directory under
+    ``<mriqc_outdir_root>/.incoming/``, on the same file system as their
+    destination, and then renamed into place one by one, so each appears
+    whole or not at all. Reports go first and IQM JSONs last, because a
+    session counts as done once its JSONs exist. An existing
+    dataset_description.json is left alone.
+
+    Returns
+    -------
+    int
+        Number of files synced.
+    """
+    mriqc_outdir_root = Path(mriqc_outdir_root)
+    incoming_root = mriqc_outdir_root / INCOMING_NAME
+    incoming_root.mkdir(parents=True, exist_ok=True)
+    incoming = Path(tempfile.mkdtemp(prefix=f'{subject_id}_',
+                                     dir=incoming_root))
+    files = [path for path in _output_files(local_out, subject_id)
+             if not (path.name == 'dataset_description.json'
+                     and (mriqc_outdir_root / path).exists())]
+    files.sort(key=lambda path: path.suffix == '.json')
+    try:
+        for path in files:
+            (incoming / path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(Path(local_out) / path, incoming / path)
+        for path in files:
+            (mriqc_outdir_root / path).parent.mkdir(parents=True,
+                                                    exist_ok=True)
+            os.replace(incoming / path, mriqc_outdir_root / path)
+    finally:
+        shutil.rmtree(incoming, ignore_errors=True)
+    return len(files)
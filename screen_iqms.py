@@ -0,0 +1,162 @@
+# screen_iqms.py
+import csv
+import time
+import argparse
+
+import numpy as np
+
+from aggregate_iqms import MODALITIES, META_COLUMNS, load_group_table
+
+# Modified z-score (Iglewicz and Hoaglin): 0.6745 (x - median) / MAD, with
+# |z| > 3.5 the usual outlier cut-off
+Z_SCALE = 0.6745
+DEFAULT_THRESHOLD = 3.5
+# Fallback when over half the values are equal (MAD of zero): the mean
+# absolute deviation, scaled by sqrt(pi / 2) to match
+MEAN_AD_SCALE = 1.2533
+# Sites with fewer sessions of a modality are scored against all sites
+MIN_SITE_SESSIONS = 10
+SITE_LENGTH = 2
+
+
+def site_of(subjects):
+    """Return the site of each subject label, e.g. 'MT' for 'MT00012'."""
+    return np.asarray([subject[:SITE_LENGTH] for subject in subjects])
+
+
+def robust_z(values):
+    """
+    Modified z-scores of each column of ``values``, ignoring NaNs.
+
+    Columns with a MAD of zero use the mean absolute deviation instead;
+    columns where both are zero score zero.
+    """
+    median = np.nanmedian(values, axis=0)
+    deviation = np.abs(values - median)
+    mad = np.nanmedian(deviation, axis=0)
+    mean_ad = np.nanmean(deviation, axis=0)
+    # Both estimate the standard deviation of normal data
+    scale = np.where(mad > 0, mad / Z_SCALE, mean_ad * MEAN_AD_SCALE)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (values - median) / scale
+    z[:, ~(scale > 0)] = 0
+    return z
+
+
+def screen_table(sites, values, min_site_sessions=MIN_SITE_SESSIONS):
+    """
+    Robust z-scores of a table, computed per site.
+
+    Parameters
+    ----------
+    sites : numpy.ndarray
+        Site of each row.
+    values : numpy.ndarray
+        Rows x IQMs array of floats, NaN where missing.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of z-scores shaped like ``values``.
+    """
+    z = np.zeros_like(values)
+    codes = np.unique(sites, return_inverse=True)[1]
+    counts = np.bincount(codes)
+    small = counts[codes] < min_site_sessions
+    if small.any():
+        z[small] = robust_z(values)[small]
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(counts)[:-1]
+    for rows in np.split(order, bounds):
+        if len(rows) >= min_site_sessions:
+            z[rows] = robust_z(values[rows])
+    return z
+
+
+def screen_iqms(table_dir, threshold=DEFAULT_THRESHOLD, iqms=None,
+                min_site_sessions=MIN_SITE_SESSIONS):
+    """
+    Flag IQM files with values far from their site's, per modality.
+
+    Parameters
+    ----------
+    table_dir : str
+        Directory of the group tables written by aggregate_iqms.py.
+    threshold : float
+        Flag files with any IQM whose |z| exceeds this.
+    iqms : list of str, optional
+        Only screen these IQMs (those present in each table).
+    min_site_sessions : int
+        Sites with fewer files of a modality are scored against all sites.
+
+    Returns
+    -------
+    list of tuple
+        (subject, session, modality, path, IQM, z) for every flagged value,
+        subject and session including their 'sub-'/'ses-' prefix.
+    """
+    flagged = []
+    for modality in MODALITIES:
+        table = load_group_table(table_dir, modality)
+        columns = [column for column in table.columns
+                   if column not in META_COLUMNS
+                   and (iqms is None or column in iqms)]
+        if table.empty or not columns:
+            continue
+        values = table[columns].to_numpy(dtype=np.float64)
+        z = screen_table(site_of(table['sub']), values, min_site_sessions)
+        rows, cols = np.nonzero(np.abs(z) > threshold)
+        for row, col in zip(rows, cols):
+            flagged.append((f"sub-{table['sub'].iat[row]}",
+                            f"ses-{table['ses'].iat[row]}", modality,
+                            table['path'].iat[row], columns[col],
+                            float(z[row, col])))
+    return flagged
+
+
+def write_caselist(path, flagged):
+    """Write the flagged sessions as a Subject,Session CSV."""
+    pairs = sorted(set((subject, session)
+                       for subject, session, *_ in flagged))
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Subject', 'Session'])
+        writer.writerows(pairs)
+    return len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Flag sessions whose IQMs are outliers within their "
+                    "site, writing them as a caselist for "
+                    "automated_mriqc_runner.py.")
+    parser.add_argument("table_dir",
+                        help="Directory of the group tables written by "
+                             "aggregate_iqms.py.")
+    parser.add_argument("-o", "--output_csv", required=True,
+                        help="Subject,Session CSV of flagged sessions.")
+    parser.add_argument("-z", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Flag IQMs whose robust |z| exceeds this.")
+    parser.add_argument("-i", "--iqms", nargs='+',
+                        help="Only screen these IQMs.")
+    parser.add_argument("-m", "--min_site_sessions", type=int,
+                        default=MIN_SITE_SESSIONS,
+                        help="Score smaller sites against all sites.")
+    parser.add_argument("-r", "--report_csv",
+                        help="Also write every flagged value with its "
+                             "z-score to this CSV.")
+    args = parser.parse_args()
+
+    start = time.time()
+    flagged = screen_iqms(args.table_dir, args.threshold, args.iqms,
+                          args.min_site_sessions)
+    count = write_caselist(args.output_csv, flagged)
+    if args.report_csv:
+        with open(args.report_csv, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['Subject', 'Session', 'Modality', 'Path', 'IQM',
+                             'Z'])
+            writer.writerows(flagged)
+    print(f"Flagged {count} sessions ({len(flagged)} values) in "
+          f"{time.time() - start:.2f} s")
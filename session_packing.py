@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from pathlib import Path
+
+from resource_predictor import (ANAT_MINUTES_PER_IMAGE, session_images,
+                                session_work_minutes)
+
+DEFAULT_PACK_MINUTES = 240
+# Every session costs at least one anatomical image, so that sessions
+# estimated at nothing (unreadable headers, no images) still fill packs
+MIN_SESSION_MINUTES = ANAT_MINUTES_PER_IMAGE
+
+
+def order_pairs(pairs):
+    """Return unique subject-session pairs in a fixed (sorted) order."""
+    return sorted(set((subject_id, session_id)
+                      for subject_id, session_id in pairs))
+
+
+def pack_is_valid(subjects, sessions, wanted, rawdata_dir):
+    """
+    True if running MRIQC on ``subjects`` x ``sessions`` runs only the
+    ``wanted`` sessions.
+
+    MRIQC takes the cross product of its participant and session labels, so
+    every combination must either be wanted or not exist in rawdata.
+    """
+    for subject_id in subjects:
+        for session_id in sessions:
+            if (subject_id, session_id) in wanted:
+                continue
+            if os.path.isdir(os.path.join(rawdata_dir, subject_id,
+                                          session_id)):
+                return False
+    return True
+
+
+def pack_sessions(pairs, rawdata_dir, target_minutes=DEFAULT_PACK_MINUTES):
+    """
+    Group subject-session pairs into packs that one MRIQC run can process.
+
+    Sessions are estimated from their NIfTI headers (see
+    resource_predictor.py), at ``MIN_SESSION_MINUTES`` or more, and placed
+    first-fit, most expensive first, into the first pack whose estimated
+    work stays within ``target_minutes`` and whose subjects x sessions cross
+    product holds no session outside the pack. The packing only depends on
+    the pairs and the headers, so it is the same every time it is computed.
+
+    Returns
+    -------
+    list of list of tuple
+        Packs of (subject, session) pairs, each in sorted order.
+    """
+    pairs = order_pairs(pairs)
+    costs = {pair: max(MIN_SESSION_MINUTES, session_work_minutes(
+        session_images(rawdata_dir, *pair))) for pair in pairs}
+    packs = []  # [pairs, subjects, sessions, minutes]
+    for pair in sorted(pairs, key=lambda pair: (-costs[pair], pair)):
+        subject_id, session_id = pair
+        for pack in packs:
+            if pack[3] + costs[pair] > target_minutes:
+                continue
+            subjects = pack[1] | {subject_id}
+            sessions = pack[2] | {session_id}
+            wanted = set(pack[0]) | {pair}
+            if pack_is_valid(subjects, sessions, wanted, rawdata_dir):
+                pack[0].append(pair)
+                pack[1], pack[2] = subjects, sessions
+                pack[3] += costs[pair]
+                break
+        else:
+            packs.append([[pair], {subject_id}, {session_id}, costs[pair]])
+    return [sorted(pack[0]) for pack in packs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show how subject-session pairs would be packed into "
+                    "MRIQC runs.")
+    parser.add_argument("rawdata_dir",
+                        help="Path to the BIDS dataset root directory.")
+    parser.add_argument("pairs", nargs='+',
+                        help="Subject-session pairs as sub-X/ses-Y.")
+    parser.add_argument("-m", "--pack_minutes", type=float,
+                        default=DEFAULT_PACK_MINUTES,
+                        help="Target estimated MRIQC minutes per pack.")
+    args = parser.parse_args()
+
+    pairs = [tuple(Path(pair.strip('/')).parts) for pair in args.pairs]
+    for index, pack in enumerate(pack_sessions(pairs, args.rawdata_dir,
+                                               args.pack_minutes), start=1):
+        print(f"Pack {index}: " + ' '.join(f'{subject_id}/{session_id}'
+                                           for subject_id, session_id in pack))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import os
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Kept in the generated CSV directory, next to the CSVs it indexes
+INDEX_NAME = 'submissions.tsv'
+INDEX_FIELDS = ('timestamp', 'subject', 'session', 'csv_name')
+DEFAULT_THREADS = 16
+
+
+def index_path(csv_dir):
+    return os.path.join(str(csv_dir), INDEX_NAME)
+
+
+def csv_timestamp(csv_name):
+    """
+    Return the timestamp in a generated CSV name such as
+    ``temp_20240518_101530123456_ab12cd34.csv``, or None if it has none.
+    """
+    parts = csv_name.split('_')
+    if len(parts) < 3 or not (parts[1].isdigit() and len(parts[1]) == 8):
+        return None
+    return f'{parts[1]}_{parts[2]}' if parts[2].isdigit() else parts[1]
+
+
+def _format_rows(csv_name, pairs, timestamp):
+    return ''.join(f'{timestamp}\t{subject_id}\t{session_id}\t{csv_name}\n'
+                   for subject_id, session_id in pairs)
+
+
+def _append(csv_dir, text):
+    # One write on an O_APPEND descriptor, so concurrent submitters do not
+    # interleave their rows
+    fd = os.open(index_path(csv_dir), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                 0o644)
+    try:
+        os.write(fd, text.encode())
+    finally:
+        os.close(fd)
+
+
+def append_submission(csv_dir, csv_path, pairs, timestamp=None):
+    """Add the subject-session pairs of a newly written job CSV to the index."""
+    csv_name = os.path.basename(str(csv_path))
+    timestamp = timestamp or csv_timestamp(csv_name)
+    if timestamp is not None and pairs:
+        _append(csv_dir, _format_rows(csv_name, pairs, timestamp))
+
+
+def read_index(csv_dir):
+    """
+    Read the index in one go.
+
+    Returns
+    -------
+    list of tuple
+        (timestamp, subject, session, csv_name) rows, in the order they were
+        added.
+    """
+    try:
+        with open(index_path(csv_dir)) as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [tuple(fields) for fields in (line.split('\t') for line in lines)
+            if len(fields) == len(INDEX_FIELDS)]
+
+
+def _read_job_csv(csv_path):
+    try:
+        with open(csv_path, newline='') as file:
+            return [(row['Subject'], row['Session'])
+                    for row in csv.DictReader(file)]
+    except (OSError, KeyError, csv.Error):
+        return []
+
+
+def backfill_index(csv_dir, threads=DEFAULT_THREADS, rows=None):
+    """
+    Index the generated CSVs that are not in the index yet.
+
+    Only the file names are listed; the CSVs missing from the index (all of
+    them the first time) are read by a pool of threads and appended in a
+    single write.
+
+    Returns
+    -------
+    int
+        Number of CSVs added.
+    """
+    rows = read_index(csv_dir) if rows is None else rows
+    indexed = {row[3] for row in rows}
+    missing = []
+    with os.scandir(str(csv_dir)) as it:
+        for entry in it:
+            if entry.name.endswith('.csv') and entry.name not in indexed \
+                    and csv_timestamp(entry.name) is not None:
+                missing.append(entry.name)
+    if not missing:
+        return 0
+    missing.sort()
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pairs_per_csv = list(executor.map(
+            _read_job_csv, (os.path.join(str(csv_dir), name)
+                            for name in missing)))
+    _append(csv_dir, ''.join(
+        _format_rows(name, pairs, csv_timestamp(name))
+        for name, pairs in zip(missing, pairs_per_csv)))
+    return len(missing)
+
+
+def load_submission_index(csv_dir, threads=DEFAULT_THREADS):
+    """Backfill the index if needed, then return its rows (see read_index)."""
+    rows = read_index(csv_dir)
+    if backfill_index(csv_dir, threads, rows):
+        rows = read_index(csv_dir)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build or update the submission index of a directory of "
+                    "generated job CSVs.")
+    parser.add_argument("csv_dir", help="Directory of generated job CSVs.")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="Number of CSVs read concurrently.")
+    args = parser.parse_args()
+
+    added = backfill_index(args.csv_dir, args.threads)
+    print(f"Indexed {added} CSVs in {index_path(args.csv_dir)}")
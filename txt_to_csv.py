@@ -7,35 +7,73 @@ from tqdm import tqdm
 def parse_line_to_csv_format(line):
     # Split the path into its components
     parts = line.strip().split('/')
+    if len(parts) < 4:
+        return None
     # Extract the relevant parts including 'sub-' and 'ses-'
     subject = parts[-4]
     session = parts[-3]
     folder = parts[-2]
     file_name = parts[-1]
+    # Only participant files (sub-X/ses-Y/<folder>/sub-X_...) make a row;
+    # top-level files such as dataset_description.json do not
+    if not (subject.startswith('sub-') and session.startswith('ses-')
+            and file_name.startswith(subject + '_')):
+        return None
     # Remove extensions
     file_name = file_name.replace('.nii.gz', '').replace('.json', '')
     return [subject, session, folder, file_name]
 
 
+def parse_lines(lines):
+    """Yield the CSV row of each participant file path in ``lines``."""
+    for line in lines:
+        row = parse_line_to_csv_format(line)
+        if row is not None:
+            yield row
+
+
 def convert_txt_to_csv(input_txt_file, output_csv_file):
+    """
+    Convert a list of file paths into Subject/Session/Folder/File rows.
+
+    Either side may be a compact .npz manifest (see ``manifest.py``): a
+    manifest input is read instead of the text file, and a manifest output is
+    written instead of the CSV.
+    """
+    # Imported here because manifest.py builds on parse_line_to_csv_format
+    from manifest import (is_manifest, read_entry_rows, write_entry_rows,
+                          write_manifest)
+
+    if is_manifest(input_txt_file):
+        write_entry_rows(output_csv_file,
+                         tqdm(read_entry_rows(input_txt_file),
+                              desc="Converting manifest"))
+        return
+
     with open(input_txt_file, 'r') as txt_file:
-        lines = txt_file.readlines()
+        if is_manifest(output_csv_file):
+            write_manifest(output_csv_file,
+                           tqdm(txt_file, desc="Converting TXT to manifest"))
+            return
 
-    with open(output_csv_file, 'w', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['Subject', 'Session', 'Folder', 'File'])
+        with open(output_csv_file, 'w', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(['Subject', 'Session', 'Folder', 'File'])
 
-        for line in tqdm(lines, desc="Converting TXT to CSV"):
-            csv_writer.writerow(parse_line_to_csv_format(line))
+            for row in parse_lines(
+                    tqdm(txt_file, desc="Converting TXT to CSV")):
+                csv_writer.writerow(row)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Convert text file paths to CSV format while preserving 'sub-' and 'ses-' prefixes.")
     parser.add_argument("-i", "--input_txt",
-                        help="Path to the input text file with the file paths.")
+                        help="Path to the input text file with the file paths "
+                             "(or an .npz manifest).")
     parser.add_argument("-o", "--output_csv",
-                        help="Path to the output CSV file.")
+                        help="Path to the output CSV file (.npz writes a "
+                             "compact manifest).")
 
     args = parser.parse_args()
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import os
+import csv
+import time
+import uuid
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+DEFAULT_WORK_QUEUE = '/data/predict1/home/rez3/bin/csv_files' \
+                     '/mriqc_work_queue.sqlite'
+# A claimed batch not completed within this long (e.g. the submitter was
+# killed) goes back to the queue
+DEFAULT_LEASE_SECONDS = 1800
+# Sessions whose submission failed this many times in a row are left out
+DEFAULT_MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    seq INTEGER NOT NULL,
+    enqueued_time REAL NOT NULL,
+    claim_id TEXT,
+    lease_expires REAL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    job_id TEXT,
+    error TEXT,
+    updated_time REAL,
+    PRIMARY KEY (subject, session)
+);
+CREATE INDEX IF NOT EXISTS queue_state ON queue (state, seq);
+CREATE INDEX IF NOT EXISTS queue_seq ON queue (seq);
+"""
+
+
+def open_queue(queue_path=DEFAULT_WORK_QUEUE):
+    """
+    Open (and create if needed) the work queue of subject-session pairs.
+
+    Each pair has a single row, so enqueueing is deduplicated. Pairs go
+    pending -> claimed (leased to one submitter) -> done, or back to pending
+    when their submission failed or their lease ran out. Every operation
+    touches only the rows of its batch, in one IMMEDIATE transaction, so
+    overlapping cron runs never claim the same pair.
+    """
+    conn = sqlite3.connect(str(queue_path), timeout=60,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+@contextmanager
+def _transaction(conn):
+    # Take the write lock up front, so the read and the update that follows
+    # it cannot interleave with another writer's
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _next_seq(conn):
+    row = conn.execute("SELECT MAX(seq) FROM queue").fetchone()
+    return (row[0] or 0) + 1
+
+
+def enqueue(conn, pairs):
+    """
+    Add subject-session pairs at the back of the queue, in order.
+
+    Pairs already pending or claimed are left where they are. Pairs done or
+    failed are queued again: they are listed because their outputs are
+    still missing.
+
+    Returns
+    -------
+    int
+        Number of pairs queued (new or again).
+    """
+    now = time.time()
+    queued = 0
+    with _transaction(conn):
+        seq = _next_seq(conn)
+        for subject_id, session_id in dict.fromkeys(pairs):
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO queue (subject, session, seq, "
+                "enqueued_time, updated_time) VALUES (?, ?, ?, ?, ?)",
+                (subject_id, session_id, seq, now, now))
+            if not cursor.rowcount:
+                cursor = conn.execute(
+                    "UPDATE queue SET state = ?, seq = ?, enqueued_time = ?, "
+                    "claim_id = NULL, lease_expires = NULL, "
+                    "updated_time = ? WHERE subject = ? AND session = ? "
+                    "AND state IN (?, ?)",
+                    (PENDING, seq, now, now, subject_id, session_id, DONE,
+                     FAILED))
+            if cursor.rowcount:
+                queued += 1
+                seq += 1
+    return queued
+
+
+def claim(conn, num_pairs, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Lease the next ``num_pairs`` pending pairs to the caller.
+
+    Claims whose lease has run out are returned to the queue first, ahead of
+    later pairs.
+
+    Returns
+    -------
+    tuple of (str, list of tuple)
+        The claim ID to complete or fail the pairs with, and the claimed
+        (subject, session) pairs in queue order.
+    """
+    now = time.time()
+    claim_id = uuid.uuid4().hex
+    limit = -1 if num_pairs == float('inf') else int(num_pairs)
+    with _transaction(conn):
+        conn.execute(
+            "UPDATE queue SET state = ?, claim_id = NULL, "
+            "lease_expires = NULL, updated_time = ? "
+            "WHERE state = ? AND lease_expires < ?",
+            (PENDING, now, CLAIMED, now))
+        pairs = [(row['subject'], row['session']) for row in conn.execute(
+            "SELECT subject, session FROM queue WHERE state = ? "
+            "ORDER BY seq LIMIT ?", (PENDING, limit))]
+        conn.executemany(
+            "UPDATE queue SET state = ?, claim_id = ?, lease_expires = ?, "
+            "updated_time = ? WHERE subject = ? AND session = ?",
+            [(CLAIMED, claim_id, now + lease_seconds, now) + pair
+             for pair in pairs])
+    return claim_id, pairs
+
+
+def complete(conn, claim_id, pairs, job_ids=None):
+    """
+    Mark claimed pairs as submitted, optionally with their job IDs.
+
+    Pairs no longer held by ``claim_id`` (their lease ran out and another
+    submitter took them) are left alone.
+
+    Returns
+    -------
+    int
+        Number of pairs marked done.
+    """
+    now = time.time()
+    job_ids = job_ids or {}
+    with _transaction(conn):
+        return sum(conn.execute(
+            "UPDATE queue SET state = ?, claim_id = NULL, "
+            "lease_expires = NULL, job_id = ?, error = NULL, failures = 0, "
+            "updated_time = ? "
+            "WHERE subject = ? AND session = ? AND claim_id = ?",
+            (DONE, job_ids.get(pair), now) + tuple(pair) + (claim_id,)
+        ).rowcount for pair in pairs)
+
+
+def fail(conn, claim_id, pairs, error=None,
+         max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Put claimed pairs whose submission failed back in their place in the
+    queue, or mark them failed after ``max_attempts`` failures in a row.
+
+    Returns
+    -------
+    int
+        Number of pairs updated.
+    """
+    now = time.time()
+    with _transaction(conn):
+        return sum(conn.execute(
+            "UPDATE queue SET state = CASE WHEN failures + 1 >= ? THEN ? "
+            "ELSE ? END, claim_id = NULL, lease_expires = NULL, error = ?, "
+            "failures = failures + 1, updated_time = ? "
+            "WHERE subject = ? AND session = ? AND claim_id = ?",
+            (max_attempts, FAILED, PENDING, error, now) + tuple(pair)
+            + (claim_id,)).rowcount for pair in pairs)
+
+
+def queue_counts(conn):
+    """Return {state: number of pairs}."""
+    return {row['state']: row['count'] for row in conn.execute(
+        "SELECT state, COUNT(*) AS count FROM queue GROUP BY state")}
+
+
+def pairs_in_state(conn, *states):
+    """Return the (subject, session) pairs in any of ``states``, in order."""
+    placeholders = ', '.join('?' * len(states))
+    return [(row['subject'], row['session']) for row in conn.execute(
+        f"SELECT subject, session FROM queue WHERE state IN ({placeholders}) "
+        f"ORDER BY seq", states)]
+
+
+def import_csv(conn, csv_path):
+    """Enqueue the rows of a Subject,Session CSV (see ``enqueue``)."""
+    with open(csv_path, newline='') as file:
+        pairs = [(row['Subject'], row['Session'])
+                 for row in csv.DictReader(file)]
+    return enqueue(conn, pairs)
+
+
+def export_csv(conn, csv_path, states=(PENDING,)):
+    """
+    Write the pairs in ``states`` as a Subject,Session CSV, e.g. the pending
+    pairs as a caselist or the done ones as the list of reran cases.
+    """
+    pairs = pairs_in_state(conn, *states)
+    temp_path = f'{csv_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Subject', 'Session'])
+        writer.writerows(pairs)
+    os.replace(temp_path, csv_path)
+    return len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Queue of subject-session pairs waiting for MRIQC "
+                    "submission, shared safely by overlapping runs.")
+    parser.add_argument("-w", "--work_queue", default=DEFAULT_WORK_QUEUE,
+                        help="Path to the SQLite work queue.")
+    subparsers = parser.add_subparsers(dest="command")
+    import_parser = subparsers.add_parser(
+        "import", help="Enqueue the pairs of Subject,Session CSVs.")
+    import_parser.add_argument("csv_files", nargs='+',
+                               help="Caselist CSVs, e.g. mriqc_run_cases.csv.")
+    export_parser = subparsers.add_parser(
+        "export", help="Write the pairs in some states as a CSV.")
+    export_parser.add_argument("csv_file", help="Output CSV.")
+    export_parser.add_argument("-t", "--state", nargs='+',
+                               default=[PENDING],
+                               choices=[PENDING, CLAIMED, DONE, FAILED],
+                               help="States to export.")
+    subparsers.add_parser(
+        "requeue-failed", help="Queue the failed pairs again.")
+    subparsers.add_parser("status", help="Print the number of pairs per "
+                                         "state.")
+    args = parser.parse_args()
+
+    conn = open_queue(args.work_queue)
+    if args.command == "import":
+        for csv_file in args.csv_files:
+            print(f"Queued {import_csv(conn, csv_file)} pairs from "
+                  f"{csv_file}")
+    elif args.command == "export":
+        print(f"Wrote {export_csv(conn, args.csv_file, args.state)} pairs")
+    elif args.command == "requeue-failed":
+        print(f"Queued {enqueue(conn, pairs_in_state(conn, FAILED))} pairs")
+    elif args.command == "status":
+        for state, count in sorted(queue_counts(conn).items()):
+            print(f"{state}\t{count}")
+    else:
+        parser.print_help()
+    conn.close()
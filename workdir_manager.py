@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from sanitize_sidecars import write_json_atomic
+
+DEFAULT_WORK_ROOT = '/data/predict1/home/rez3/tmp/mriqc'
+DEFAULT_QUOTA_GB = 500
+DEFAULT_FAILED_QUOTA_GB = 200
+DEFAULT_DELETE_WORKERS = 2
+# A 'running' work dir whose job cannot be checked is trusted this long,
+# a little over the 72 hour walltime limit
+STALE_RUNNING_HOURS = 96
+
+# Written by run_mriqc_on_data into each work dir; hidden, so nipype and
+# the directory walk below ignore it
+MARKER_NAME = '.workdir_status.json'
+TRASH_NAME = '.trash'
+RUNNING, DONE, FAILED, UNKNOWN = 'running', 'done', 'failed', 'unknown'
+# Eviction order once over quota: completed first, then dirs of unknown
+# origin, failed (resumable) ones last
+EVICTION_ORDER = (DONE, UNKNOWN, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workdirs (
+    path TEXT PRIMARY KEY,
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    job_id TEXT,
+    status TEXT NOT NULL,
+    size_bytes INTEGER,
+    last_used REAL,
+    marker_mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS workdirs_status ON workdirs (status, last_used);
+"""
+
+
+def mark_workdir(work_dir, subject_id, session_id, status, returncode=None,
+                 pairs=None):
+    """
+    Record the state of a work dir from inside the job using it.
+
+    The marker file is replaced atomically, so the manager never reads a
+    partial one. LSB_JOBID (and LSB_JOBINDEX for array elements) identify
+    the owning job; runs outside LSF are identified by host and pid. Work
+    dirs shared by a pack of sessions list them all in ``pairs``.
+    """
+    job_id = os.environ.get('LSB_JOBID')
+    index = os.environ.get('LSB_JOBINDEX', '0')
+    if job_id and index not in ('', '0'):
+        job_id = f'{job_id}[{index}]'
+    marker = {
+        'subject': subject_id, 'session': session_id, 'job_id': job_id,
+        'status': status, 'returncode': returncode, 'time': time.time(),
+        'host': os.uname()[1], 'pid': os.getpid()}
+    if pairs:
+        marker['pairs'] = [list(pair) for pair in pairs]
+    write_json_atomic(os.path.join(str(work_dir), MARKER_NAME), marker,
+                      mode=0o644)
+
+
+def read_marker(work_dir):
+    """Return the parsed marker of a work dir and its mtime, or (None, None)."""
+    marker = os.path.join(work_dir, MARKER_NAME)
+    try:
+        mtime_ns = os.stat(marker).st_mtime_ns
+        with open(marker) as fp:
+            return json.load(fp), mtime_ns
+    except (OSError, ValueError):
+        return None, None
+
+
+def dir_size(path):
+    """Return the total size of the files below ``path`` in bytes."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+def _subdirs(path):
+    try:
+        with os.scandir(path) as it:
+            return sorted((entry for entry in it
+                           if entry.is_dir(follow_symlinks=False)
+                           and not entry.name.startswith('.')),
+                          key=lambda entry: entry.name)
+    except OSError:
+        return []
+
+
+def _running_alive(marker, now):
+    """
+    Tell whether a 'running' marker's process may still be running, without
+    the registry's word on it.
+
+    A marker written on this host by a run outside LSF names its process,
+    which is checked directly; any other marker is trusted for
+    ``STALE_RUNNING_HOURS``.
+    """
+    if now - marker['time'] >= STALE_RUNNING_HOURS * 3600:
+        return False
+    pid = marker.get('pid')
+    if marker.get('job_id') or not pid or marker.get('host') != os.uname()[1]:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def open_db(db_path):
+    """Open (and create if needed) the work-dir database."""
+    conn = sqlite3.connect(str(db_path), timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sync_workdirs(conn, work_root, active_pairs=None, threads=8,
+                  known_jobs=None):
+    """
+    Bring the database in line with the ``<subject>/<session>`` work dirs.
+
+    A dir's status comes from its marker; a 'running' marker whose job is
+    no longer active means the job died, and the dir is treated as failed.
+    The registry only decides for jobs it knows: markers of local runs and
+    of jobs submitted by hand are checked by pid when written on this host,
+    and otherwise expire after ``STALE_RUNNING_HOURS``. Sizes are only
+    recomputed when the marker changed.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by ``open_db``.
+    work_root : str
+        Directory holding the per-subject work dirs.
+    active_pairs : set of tuple, optional
+        (subject, session) pairs with a pending or running job.
+    threads : int
+        Number of directories sized concurrently.
+    known_jobs : set of str, optional
+        IDs of all the jobs in the registry, in any state; required for
+        ``active_pairs`` to be used on 'running' markers.
+    """
+    known = {row['path']: row for row in conn.execute(
+        "SELECT * FROM workdirs")}
+    now = time.time()
+    found = {}
+    for subject in _subdirs(work_root):
+        for session in _subdirs(subject.path):
+            marker, marker_mtime_ns = read_marker(session.path)
+            pairs = {(subject.name, session.name)}
+            if marker is None:
+                status, job_id, last_used = UNKNOWN, None, \
+                    session.stat().st_mtime
+            else:
+                status, job_id, last_used = marker['status'], \
+                    marker.get('job_id'), marker['time']
+                # Pack work dirs serve all the sessions of the pack
+                pairs.update(tuple(pair) for pair in marker.get('pairs', []))
+            active = active_pairs is not None and \
+                not pairs.isdisjoint(active_pairs)
+            if status == RUNNING:
+                if active_pairs is not None and known_jobs is not None \
+                        and job_id in known_jobs:
+                    alive = active
+                else:
+                    alive = _running_alive(marker, now)
+                if not alive:
+                    status = FAILED
+            elif active:
+                # A resubmitted job has not reached MRIQC yet
+                status = RUNNING
+            found[session.path] = (subject.name, session.name, job_id,
+                                   status, last_used, marker_mtime_ns)
+
+    def needs_size(path):
+        row = known.get(path)
+        return found[path][3] != RUNNING and (
+            row is None or row['size_bytes'] is None
+            or row['marker_mtime_ns'] != found[path][5])
+
+    to_size = [path for path in found if needs_size(path)]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        sizes = dict(zip(to_size, executor.map(dir_size, to_size)))
+
+    with conn:
+        conn.executemany("DELETE FROM workdirs WHERE path = ?",
+                         [(path,) for path in set(known) - set(found)])
+        for path, (subject, session, job_id, status, last_used,
+                   marker_mtime_ns) in found.items():
+            size = sizes.get(path, known[path]['size_bytes']
+                             if path in known else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO workdirs (path, subject, session, "
+                "job_id, status, size_bytes, last_used, marker_mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, subject, session, job_id, status, size, last_used,
+                 marker_mtime_ns))
+
+
+def plan_eviction(conn, quota_bytes, failed_quota_bytes):
+    """
+    Choose the work dirs to delete.
+
+    Failed dirs are kept for resuming as long as they fit in
+    ``failed_quota_bytes``, the least recently used going first. If all
+    kept dirs still exceed ``quota_bytes``, dirs are evicted in
+    ``EVICTION_ORDER``, least recently used first. Running dirs are never
+    evicted.
+
+    Returns
+    -------
+    list of sqlite3.Row
+        The rows to evict.
+    """
+    rows = conn.execute(
+        "SELECT * FROM workdirs WHERE status != ? ORDER BY last_used",
+        (RUNNING,)).fetchall()
+    evict, evicted = [], set()
+    failed_total = sum(row['size_bytes'] or 0 for row in rows
+                       if row['status'] == FAILED)
+    for row in rows:
+        if failed_total <= failed_quota_bytes:
+            break
+        if row['status'] == FAILED:
+            evict.append(row)
+            evicted.add(row['path'])
+            failed_total -= row['size_bytes'] or 0
+
+    total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM workdirs"
+                         ).fetchone()[0]
+    total -= sum(row['size_bytes'] or 0 for row in evict)
+    for status in EVICTION_ORDER:
+        for row in rows:
+            if total <= quota_bytes:
+                return evict
+            if row['status'] == status and row['path'] not in evicted:
+                evict.append(row)
+                evicted.add(row['path'])
+                total -= row['size_bytes'] or 0
+    return evict
+
+
+def _remove_tree(path, pause):
+    shutil.rmtree(path, ignore_errors=True)
+    if pause:
+        time.sleep(pause)
+
+
+def evict_workdirs(conn, work_root, rows, workers=DEFAULT_DELETE_WORKERS,
+                   pause=0.0):
+    """
+    Delete work dirs through a small, throttled pool.
+
+    Each dir is first renamed into ``<work_root>/.trash``, which is instant
+    and frees its path for a new job at once; the slow recursive deletes
+    then run on ``workers`` threads with ``pause`` seconds between dirs,
+    to go easy on the file server. Leftovers of interrupted runs in the
+    trash are deleted too.
+
+    Returns
+    -------
+    int
+        Bytes freed.
+    """
+    trash = os.path.join(work_root, TRASH_NAME)
+    os.makedirs(trash, exist_ok=True)
+    freed = 0
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    with conn:
+        for row in rows:
+            target = os.path.join(
+                trash, f"{row['subject']}_{row['session']}_{stamp}")
+            try:
+                os.rename(row['path'], target)
+            except OSError:
+                continue
+            conn.execute("DELETE FROM workdirs WHERE path = ?", (row['path'],))
+            freed += row['size_bytes'] or 0
+            subject_dir = os.path.dirname(row['path'])
+            try:
+                os.rmdir(subject_dir)
+            except OSError:
+                pass
+    doomed = [entry.path for entry in os.scandir(trash)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(lambda path: _remove_tree(path, pause), doomed))
+    return freed
+
+
+def _format_gb(size_bytes):
+    return f"{(size_bytes or 0) / 1024 ** 3:.1f} GB"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Track MRIQC work dirs and evict them within a disk "
+                    "quota, keeping failed sessions' dirs for resuming.")
+    parser.add_argument("-d", "--work_root", default=DEFAULT_WORK_ROOT,
+                        help="Directory holding <subject>/<session> work "
+                             "dirs.")
+    parser.add_argument("-b", "--db",
+                        help="Path to the SQLite work-dir database (default: "
+                             "workdirs.sqlite next to the work root).")
+    parser.add_argument("-g", "--registry",
+                        help="Job registry (see job_registry.py) used to tell "
+                             "live jobs from dead ones.")
+    parser.add_argument("-q", "--quota_gb", type=float,
+                        default=DEFAULT_QUOTA_GB,
+                        help="Total size the work dirs may use.")
+    parser.add_argument("-f", "--failed_quota_gb", type=float,
+                        default=DEFAULT_FAILED_QUOTA_GB,
+                        help="Size the failed sessions' dirs may use.")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=DEFAULT_DELETE_WORKERS,
+                        help="Number of concurrent deletes.")
+    parser.add_argument("-p", "--pause", type=float, default=0.0,
+                        help="Seconds each delete worker waits between dirs.")
+    parser.add_argument("-n", "--dry_run", action="store_true",
+                        help="Only print what would be evicted.")
+    parser.add_argument("command", choices=["status", "clean"],
+                        help="'status' prints a summary, 'clean' evicts.")
+    args = parser.parse_args()
+
+    work_root = os.path.abspath(args.work_root)
+    db_path = args.db or os.path.join(os.path.dirname(work_root),
+                                      'workdirs.sqlite')
+    active_pairs = known_jobs = None
+    if args.registry:
+        from job_registry import open_registry, jobs_in_state, ACTIVE_STATES
+        registry = open_registry(args.registry)
+        active_pairs = {(row['subject'], row['session']) for row in
+                        jobs_in_state(registry, *ACTIVE_STATES)}
+        known_jobs = {row['job_id'] for row in registry.execute(
+            "SELECT DISTINCT job_id FROM jobs")}
+        registry.close()
+
+    conn = open_db(db_path)
+    sync_workdirs(conn, work_root, active_pairs, known_jobs=known_jobs)
+    if args.command == "status":
+        for row in conn.execute(
+                "SELECT status, COUNT(*), SUM(size_bytes) FROM workdirs "
+                "GROUP BY status ORDER BY status"):
+            print(f"{row[0]}: {row[1]} dirs, {_format_gb(row[2])}")
+    else:
+        rows = plan_eviction(conn, args.quota_gb * 1024 ** 3,
+                             args.failed_quota_gb * 1024 ** 3)
+        for row in rows:
+            print(f"Evicting {row['path']} ({row['status']}, "
+                  f"{_format_gb(row['size_bytes'])})")
+        if not args.dry_run:
+            freed = evict_workdirs(conn, work_root, rows, args.workers,
+                                   args.pause)
+            print(f"Freed {_format_gb(freed)}")
+    conn.close()
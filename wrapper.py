@@ -1,10 +1,20 @@
 # wrapper.py
+import csv
+import os
 import subprocess
 import argparse
 from tqdm import tqdm
 from pathlib import Path
-import pandas as pd
 
+from collect_files import (DEFAULT_THREADS, crawl_bids_tree,
+                           crawl_bids_trees, is_json_file, is_nifti_file)
+from txt_to_csv import parse_lines
+from find_missing_entries import MISSING, merge_entries, write_entries
+from make_sub_ses_caselist import unique_pairs_from_rows, write_pairs
+from manifest import write_manifest
+from sanitize_sidecars import DEFAULT_WORKERS, sanitize_tree
+from work_queue import open_queue, enqueue, import_csv
+from instrumentation import RunRecorder, count_lines
 
 
 def run_collect_files(rawdata_dir, mriqc_output_dirs, nifti_output_txt,
@@ -35,14 +45,142 @@ def run_make_sub_ses_caselist(input_csv, output_csv):
         ['python', '/data/predict1/home/rez3/bin/code/mriqc_pipeline'
                    '/make_sub_ses_caselist.py', '--input_csv', input_csv,
          '--output_csv', output_csv])
-    
+
+
 def merge_unique_csv_files(csv_file_1, csv_file_2, output_csv):
+    import pandas as pd
     df1 = pd.read_csv(csv_file_1)
     df2 = pd.read_csv(csv_file_2)
     merged_df = pd.concat([df1, df2]).drop_duplicates().reset_index(drop=True)
     merged_df.to_csv(output_csv, index=False)
 
 
+def merge_unique_pairs(pairs, rerun_csv, output_csv):
+    """
+    Same as ``merge_unique_csv_files`` for in-memory pairs: the new pairs
+    come first, followed by the rerun CSV rows not already present.
+    """
+    merged = list(pairs)
+    if os.path.exists(rerun_csv):
+        with open(rerun_csv, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            merged.extend((row['Subject'], row['Session']) for row in reader)
+    write_pairs(list(dict.fromkeys(merged)), output_csv)
+
+
+def enqueue_caselist(csv_path, work_queue_path):
+    """Add the pairs of a caselist CSV to the work queue (see work_queue.py)."""
+    conn = open_queue(work_queue_path)
+    try:
+        import_csv(conn, csv_path)
+    finally:
+        conn.close()
+
+
+def _tee_to_txt(paths, output_txt):
+    """Pass paths through while writing them to a text file."""
+    with open(output_txt, 'w') as txt_file:
+        for path in paths:
+            txt_file.write(path + '\n')
+            yield path
+
+
+def _tee_to_csv(rows, output_csv):
+    """Pass entry rows through while writing them to a CSV file."""
+    with open(output_csv, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Subject', 'Session', 'Folder', 'File'])
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def _tee_to_manifest(paths, manifest_path):
+    """Pass paths through and write them as a compact manifest at the end."""
+    collected = []
+    for path in paths:
+        collected.append(path)
+        yield path
+    write_manifest(manifest_path, collected)
+
+
+def run_streaming_pipeline(rawdata_dir, mriqc_output_dirs, unique_pairs_csv,
+                           rerun_csv, threads=DEFAULT_THREADS,
+                           intermediates=None, work_queue_path=None):
+    """
+    Run crawl -> parse -> diff -> unique pairs -> merge in this process.
+
+    Stages are chained as generators, so no interpreter is started per stage
+    and nothing is written to disk except the final caselist and rerun CSV.
+
+    Parameters
+    ----------
+    rawdata_dir : str
+        Path to the rawdata directory.
+    mriqc_output_dirs : list of str
+        Paths to the MRIQC output directories.
+    unique_pairs_csv : str
+        Path to output CSV file for unique subject-session pairs.
+    rerun_csv : str
+        Path to the CSV file for cases to rerun, merged in place.
+    threads : int
+        Number of subject directories listed concurrently by the crawler.
+    intermediates : dict, optional
+        Paths of the intermediate files to also write, keyed by
+        'nifti_txt', 'json_txt', 'nifti_csv', 'json_csv', 'nifti_manifest',
+        'json_manifest' and 'missing_csv'. Missing keys are not written.
+    work_queue_path : str, optional
+        Enqueue the pairs in this work queue instead of merging them into
+        ``rerun_csv``.
+
+    Returns
+    -------
+    list of tuple
+        The unique (Subject, Session) pairs with missing outputs.
+    """
+    intermediates = intermediates or {}
+
+    nifti_paths = crawl_bids_tree(rawdata_dir, is_nifti_file, threads)
+    json_paths = crawl_bids_trees(mriqc_output_dirs, is_json_file, threads)
+    if 'nifti_txt' in intermediates:
+        nifti_paths = _tee_to_txt(nifti_paths, intermediates['nifti_txt'])
+    if 'json_txt' in intermediates:
+        json_paths = _tee_to_txt(json_paths, intermediates['json_txt'])
+    if 'nifti_manifest' in intermediates:
+        nifti_paths = _tee_to_manifest(nifti_paths,
+                                       intermediates['nifti_manifest'])
+    if 'json_manifest' in intermediates:
+        json_paths = _tee_to_manifest(json_paths,
+                                      intermediates['json_manifest'])
+
+    nifti_rows = parse_lines(nifti_paths)
+    json_rows = parse_lines(json_paths)
+    if 'nifti_csv' in intermediates:
+        nifti_rows = _tee_to_csv(nifti_rows, intermediates['nifti_csv'])
+    if 'json_csv' in intermediates:
+        json_rows = _tee_to_csv(json_rows, intermediates['json_csv'])
+
+    json_entries = ((tuple(row), None) for row in json_rows)
+    missing = [entry for status, entry, _ in
+               merge_entries(nifti_rows, [json_entries])
+               if status == MISSING]
+    if 'missing_csv' in intermediates:
+        write_entries(missing, intermediates['missing_csv'])
+
+    pairs = unique_pairs_from_rows(missing)
+    Path(unique_pairs_csv).parent.mkdir(parents=True, exist_ok=True)
+    write_pairs(pairs, unique_pairs_csv)
+    if work_queue_path:
+        conn = open_queue(work_queue_path)
+        try:
+            enqueue(conn, pairs)
+        finally:
+            conn.close()
+    else:
+        merge_unique_pairs(pairs, rerun_csv, rerun_csv)
+    return pairs
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Wrapper script to automate the process.")
@@ -77,37 +215,127 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--rerun_csv",
                         default="/data/predict1/home/rez3/bin/csv_files"
                                 "/mriqc_subs_to_rerun.csv",
-                        help="Path to CSV file for cases to rerun.")    
-
+                        help="Path to CSV file for cases to rerun.")
+    parser.add_argument("--in_process", action="store_true",
+                        help="Run all stages in this process as one "
+                             "streaming pipeline instead of one script per "
+                             "stage.")
+    parser.add_argument("--keep_intermediate", action="store_true",
+                        help="With --in_process, also write the NIfTI/JSON "
+                             "txt and CSV files and the missing entries CSV.")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS,
+                        help="Number of subject directories listed "
+                             "concurrently (with --in_process).")
+    parser.add_argument("--compact", action="store_true",
+                        help="Store the NIfTI and JSON lists as compact .npz "
+                             "manifests (next to the txt paths) instead of "
+                             "paired txt and CSV files.")
+    parser.add_argument("-s", "--sanitize_ledger",
+                        help="Strip DataSetTrailingPadding from all rawdata "
+                             "sidecars first, tracking checked files in this "
+                             "SQLite ledger (see sanitize_sidecars.py).")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of processes sanitizing sidecars.")
+    parser.add_argument("--run_log", default="wrapper_runs.jsonl",
+                        help="JSON-lines file each stage's wall and CPU "
+                             "time, peak RSS, items and I/O are appended "
+                             "to (see instrumentation.py).")
+    parser.add_argument("--metrics_textfile",
+                        help="Also write the stage metrics of this run to "
+                             "this Prometheus textfile (.prom).")
+    parser.add_argument("--profile", metavar="PROFILE_DIR",
+                        help="Run each stage under cProfile and save its "
+                             ".prof stats and a text summary here.")
+    parser.add_argument("--work_queue",
+                        help="Add the caselist to this SQLite work queue "
+                             "(see work_queue.py) instead of merging it into "
+                             "the rerun CSV.")
 
     args = parser.parse_args()
 
-    # Define the steps and their descriptions
+    nifti_manifest = str(Path(args.nifti_output_txt).with_suffix('.npz'))
+    json_manifest = str(Path(args.json_output_txt).with_suffix('.npz'))
+
+    intermediates = {}
+    if args.keep_intermediate and args.compact:
+        intermediates = {'nifti_manifest': nifti_manifest,
+                         'json_manifest': json_manifest,
+                         'missing_csv': args.output_diff_file}
+    elif args.keep_intermediate:
+        intermediates = {'nifti_txt': args.nifti_output_txt,
+                         'json_txt': args.json_output_txt,
+                         'nifti_csv': args.nifti_csv,
+                         'json_csv': args.json_csv,
+                         'missing_csv': args.output_diff_file}
+
+    # Define the steps and their descriptions; "items" counts what a step
+    # produced, for the run log
     steps = [
         {"function": run_collect_files, "args": (
         args.rawdata_dir, args.mriqc_output_dirs, args.nifti_output_txt,
-        args.json_output_txt), "description": "Collecting files"},
+        args.json_output_txt), "description": "Collecting files",
+         "items": lambda _: count_lines(args.nifti_output_txt,
+                                        args.json_output_txt)},
         {"function": run_convert_txt_to_csv,
          "args": (args.nifti_output_txt, args.nifti_csv),
-         "description": "Converting NIfTI txt to CSV"},
+         "description": "Converting NIfTI txt to CSV",
+         "items": lambda _: count_lines(args.nifti_csv)},
         {"function": run_convert_txt_to_csv,
          "args": (args.json_output_txt, args.json_csv),
-         "description": "Converting JSON txt to CSV"},
+         "description": "Converting JSON txt to CSV",
+         "items": lambda _: count_lines(args.json_csv)},
         {"function": run_find_missing_entries,
          "args": (args.nifti_csv, args.json_csv, args.output_diff_file),
-         "description": "Finding missing entries"},
+         "description": "Finding missing entries",
+         "items": lambda _: count_lines(args.output_diff_file)},
         {"function": run_make_sub_ses_caselist,
          "args": (args.output_diff_file, args.unique_pairs_csv),
-         "description": "Generating unique subject-session pairs"},
+         "description": "Generating unique subject-session pairs",
+         "items": lambda _: count_lines(args.unique_pairs_csv)},
         {"function": merge_unique_csv_files,
          "args": (args.unique_pairs_csv, args.rerun_csv, args.rerun_csv),
-         "description": "Merging with existing rerun CSV"}
+         "description": "Merging with existing rerun CSV",
+         "items": lambda _: count_lines(args.rerun_csv)}
     ]
+    if args.compact:
+        steps = [
+            {"function": run_collect_files, "args": (
+                args.rawdata_dir, args.mriqc_output_dirs, nifti_manifest,
+                json_manifest), "description": "Collecting files"},
+            {"function": run_find_missing_entries,
+             "args": (nifti_manifest, json_manifest, args.output_diff_file),
+             "description": "Finding missing entries",
+             "items": lambda _: count_lines(args.output_diff_file)}
+        ] + steps[4:]
+    if args.work_queue:
+        steps[-1] = {"function": enqueue_caselist,
+                     "args": (args.unique_pairs_csv, args.work_queue),
+                     "description": "Adding pairs to the work queue",
+                     "items": lambda _: count_lines(args.unique_pairs_csv)}
+    if args.in_process:
+        steps = [
+            {"function": run_streaming_pipeline, "args": (
+                args.rawdata_dir, args.mriqc_output_dirs,
+                args.unique_pairs_csv, args.rerun_csv, args.threads,
+                intermediates, args.work_queue),
+             "description": "Running streaming pipeline"}
+        ]
+    if args.sanitize_ledger:
+        steps.insert(0, {"function": sanitize_tree, "args": (
+            args.rawdata_dir, args.sanitize_ledger, args.workers,
+            args.threads), "description": "Sanitizing sidecars",
+            "items": lambda counts: sum(counts.values())})
 
-    # Run each step with a progress bar
-    for step in tqdm(steps, desc="Overall Progress", unit="step"):
-        tqdm.write(step["description"])
-        step["function"](*step["args"])
+    # Run each step with a progress bar, recording how long it took
+    recorder = RunRecorder(args.run_log, args.metrics_textfile, args.profile)
+    try:
+        for step in tqdm(steps, desc="Overall Progress", unit="step"):
+            tqdm.write(step["description"])
+            recorder.run_stage(step["description"], step["function"],
+                               step["args"], step.get("items"))
+    finally:
+        recorder.write_metrics()
+    print(recorder.summary())
 
     print(
         f"Process completed. Final caselist is at {args.unique_pairs_csv}")